@@ -1,44 +1,232 @@
 import base64
+import json
 import os
+import threading
 
-import requests
-from openai import OpenAI
+from openai import BadRequestError
 
+import clients
+from agents.cache import embedding_cache, narration_cache, response_cache
+from agents.hedging import hedger
+from agents.limits import DeadlineExceededError, deadline, limiter, remaining
 
-client = OpenAI()
+
+client = clients.openai
+
+# provider limits for a single embeddings request
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", default=2048))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", default=300000))
+EMBEDDING_BATCH_ATTEMPTS = int(os.getenv("EMBEDDING_BATCH_ATTEMPTS", default=3))
+# json mode completions are cached apart from plain ones for the same prompts
+JSON_RESPONSE_CACHE_MODEL = "gpt-3.5-turbo:json"
+# image bytes base64 encoded per read of a vision request body, a multiple of 3 so the pieces concatenate
+VISION_ENCODE_CHUNK = 3 * 16 * 1024
+_IMAGE_PLACEHOLDER = "\0image\0"
+DEFAULT_VOICE_ID = "xNx17ebeAzBxoUz7iepQ"
+DEFAULT_VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.5}
+
+
+def estimate_tokens(text):
+    # conservative upper bound without a tokenizer, english averages ~4 characters per token
+    return len(text) // 3 + 1
+
+
+def chunk_embedding_inputs(texts, max_items=EMBEDDING_BATCH_MAX_ITEMS, max_tokens=EMBEDDING_BATCH_MAX_TOKENS):
+    """Split texts into consecutive (start index, texts) batches that fit the request limits."""
+    batches = []
+    start = 0
+    batch = []
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_items or batch_tokens + tokens > max_tokens):
+            batches.append((start, batch))
+            start, batch, batch_tokens = i, [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append((start, batch))
+    return batches
+
+
+class Base64JsonBody:
+    """
+    Request body of JSON around one base64 encoded image, encoded as the body is read.
+
+    Only VISION_ENCODE_CHUNK of the image is ever held encoded, instead of a base64 copy, a
+    string copy and the dumped JSON of the whole image. The length is known up front, so the
+    request is sent with a Content-Length rather than chunked.
+    """
+
+    def __init__(self, payload, image):
+        """
+        :param payload: JSON payload containing _IMAGE_PLACEHOLDER once where the base64 goes
+        :param image: bytes-like image, read through a memoryview without copying
+        """
+        prefix, suffix = json.dumps(payload).split(json.dumps(_IMAGE_PLACEHOLDER)[1:-1])
+        self._image = memoryview(image)
+        self._prefix, self._suffix = prefix.encode(), suffix.encode()
+        self._length = len(self._prefix) + 4 * ((len(self._image) + 2) // 3) + len(self._suffix)
+        self._pieces = self._generate()
+        self._buffer = b""
+
+    def _generate(self):
+        yield self._prefix
+        for start in range(0, len(self._image), VISION_ENCODE_CHUNK):
+            yield base64.b64encode(self._image[start:start + VISION_ENCODE_CHUNK])
+        yield self._suffix
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        pieces = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            piece = next(self._pieces, None)
+            if piece is None:
+                break
+            pieces.append(piece)
+            length += len(piece)
+        data = b"".join(pieces)
+        if size < 0:
+            self._buffer = b""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+class ProviderAudio:
+    """
+    Audio chunks streamed from a tts response.
+
+    A generator closed before its first chunk never runs its finally, so the response is closed
+    here, which also covers a client that disconnects before any audio arrived.
+    """
+
+    def __init__(self, response, chunks):
+        self._response = response
+        self._chunks = chunks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        try:
+            self._chunks.close()
+        finally:
+            self._response.close()
 
 
 class Agent:
     def __init__(self):
-        pass
+        # token usage summed over every completion made by this agent
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        self._usage_lock = threading.Lock()
 
-    def generate_response(self, system_prompt, prompt):
-        try:
-            completion = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system",
-                     "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ]
-            )
+    def _record_usage(self, usage):
+        if usage is None:
+            return
+        with self._usage_lock:
+            self.usage["prompt_tokens"] += usage.prompt_tokens
+            self.usage["completion_tokens"] += usage.completion_tokens
+
+    def _call_openai(self, create, model, attempts=None, **kwargs):
+        """
+        Call an openai endpoint under the model's adaptive limiter.
+
+        :param create: a with_raw_response method, so the rate limit headers can be read
+        :raises ProviderError: if retryable failures outlast the attempts
+        """
+        def call():
+            left = remaining()
+            if left is not None and left <= 0:
+                raise DeadlineExceededError(f"{model}: deadline passed")
+            # each attempt gets whatever is left of the request's budget
+            response = create(model=model, **kwargs) if left is None else create(model=model, timeout=left, **kwargs)
+            return response.parse(), response.headers
+
+        if attempts is None:
+            return limiter(model).call(call)
+        return limiter(model).call(call, attempts=attempts)
+
+    def generate_response(self, system_prompt, prompt, cached=True, timeout=None, hedge=None):
+        """
+        :param cached: reuse an earlier completion of the same prompts, pass False for creative prompts
+        :param timeout: seconds this call may take, within any deadline already set by the request
+        :param hedge: send a duplicate request if the first is slow, defaults to HEDGE_ENABLED
+        :raises ProviderError: instead of returning the error as the completion
+        """
+        def complete():
+            return hedger("chat.gpt-3.5-turbo").call(lambda: self._generate_response(system_prompt, prompt),
+                                                     hedge=hedge)
 
-            return completion.choices[0].message.content
-        except Exception as e:
-            return str(e)
+        with deadline(timeout):
+            if not cached:
+                return complete()
+            return response_cache.get_or_create("gpt-3.5-turbo", system_prompt, prompt, complete)
 
-    def get_transcript(self, audio_stream):
-        transcript = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_stream,
-            response_format="text"
+    def _generate_response(self, system_prompt, prompt):
+        completion = self._call_openai(
+            client.chat.completions.with_raw_response.create,
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system",
+                 "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ]
         )
-        return transcript
+        self._record_usage(completion.usage)
+        return completion.choices[0].message.content
 
-    def generate_vision_response(self, image_bytes, prompt):
+    def generate_json_response(self, system_prompt, prompt, cached=True):
+        if not cached:
+            return self._generate_json_response(system_prompt, prompt)
+        return response_cache.get_or_create(JSON_RESPONSE_CACHE_MODEL, system_prompt, prompt,
+                                            lambda: self._generate_json_response(system_prompt, prompt))
+
+    def _generate_json_response(self, system_prompt, prompt):
+        completion = self._call_openai(
+            client.chat.completions.with_raw_response.create,
+            model="gpt-3.5-turbo",
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system",
+                 "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ]
+        )
+        self._record_usage(completion.usage)
+        return completion.choices[0].message.content
+
+    def get_transcript(self, audio_stream, filename="audio.m4a", mimetype=None, timeout=None, hedge=None):
+        """
+        :param audio_stream: recording as bytes or a readable file, e.g. the request's upload stream
+        :param filename: the endpoint detects the format from its extension
+        :param timeout: and hedge as for generate_response
+        """
+        # read once so a hedged duplicate doesn't race the first request over the same file
+        content = audio_stream.read() if hasattr(audio_stream, "read") else audio_stream
+        audio = (filename, content, mimetype) if mimetype else (filename, content)
+
+        def transcribe():
+            return self._call_openai(
+                client.audio.transcriptions.with_raw_response.create,
+                model="whisper-1",
+                file=audio,
+                response_format="text"
+            )
 
-        # Getting the base64 string
-        base64_image = base64.b64encode(image_bytes.read()).decode('utf-8')
+        with deadline(timeout):
+            return hedger("transcription.whisper-1").call(transcribe, hedge=hedge)
+
+    def generate_vision_response(self, image_bytes, prompt, mime_type="image/jpeg"):
+        """:param image_bytes: the image as bytes, a memoryview or a readable file"""
+        if hasattr(image_bytes, "read"):
+            image_bytes = image_bytes.read()
 
         headers = {
             "Content-Type": "application/json",
@@ -58,7 +246,7 @@ class Agent:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": f"data:{mime_type};base64,{_IMAGE_PLACEHOLDER}"
                             }
                         }
                     ]
@@ -67,15 +255,54 @@ class Agent:
             "max_tokens": 1000
         }
 
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        return response.json()['choices'][0]['message']['content']
+        def call():
+            # a fresh body per attempt, a retry can't reuse one that has been read
+            response = clients.session("openai").post("https://api.openai.com/v1/chat/completions", headers=headers,
+                                                       data=Base64JsonBody(payload, image_bytes))
+            response.raise_for_status()
+            return response.json(), response.headers
+
+        return limiter(payload["model"]).call(call)['choices'][0]['message']['content']
+
+    def get_embedding(self, text, model="text-embedding-3-large", cached=True, timeout=None, hedge=None):
+        """:param timeout: and hedge as for generate_response"""
+        def embed(value):
+            return hedger(f"embedding.{model}").call(lambda: self.get_embeddings([value], model=model)[0], hedge=hedge)
+
+        with deadline(timeout):
+            if not cached:
+                return embed(text)
+            return embedding_cache.get_or_create(text, model, embed)
+
+    def get_embeddings(self, texts, model="text-embedding-3-large"):
+        """
+        Embed many texts with as few requests as the provider limits allow.
 
-    def get_embedding(self, text, model="text-embedding-3-large"):
-        text = text.replace("\n", " ")
-        return client.embeddings.create(input=[text], model=model).data[0].embedding
+        :param texts: strings to embed
+        :param model: embedding model
+        :return: embeddings in the same order as texts
+        """
+        texts = [text.replace("\n", " ") for text in texts]
+        embeddings = [None] * len(texts)
+        for start, batch in chunk_embedding_inputs(texts):
+            embeddings[start:start + len(batch)] = self._embed_batch(batch, model)
+        return embeddings
+
+    def _embed_batch(self, batch, model):
+        try:
+            response = self._call_openai(client.embeddings.with_raw_response.create, model=model, input=batch,
+                                         attempts=EMBEDDING_BATCH_ATTEMPTS)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except BadRequestError:
+            # usually a token estimate that was too optimistic, halve the batch rather than resend it
+            if len(batch) == 1:
+                raise
+            middle = len(batch) // 2
+            return self._embed_batch(batch[:middle], model) + self._embed_batch(batch[middle:], model)
 
     def get_image_variations(self, byte_array):
-        response = client.images.create_variation(
+        response = self._call_openai(
+            client.images.with_raw_response.create_variation,
             image=byte_array,
             n=1,
             model="dall-e-2",
@@ -83,18 +310,44 @@ class Agent:
         )
         return response.data[0].url
 
-    def text_to_speech(self, text, voice_id="xNx17ebeAzBxoUz7iepQ", model_id="eleven_multilingual_v2"):
+    def narrate(self, text, voice_id=DEFAULT_VOICE_ID, model_id="eleven_multilingual_v2", voice_settings=None,
+                chunk_size=16 * 1024):
+        """
+        Narration of text from the narration cache, synthesizing and caching it on a miss.
+
+        :return: (cache key, the cached mp3 opened for reading, None) on a hit and (cache key, None, mp3
+            chunks streamed from the provider) on a miss, the narration is cached once the chunks are consumed
+        """
+        voice_settings = voice_settings or DEFAULT_VOICE_SETTINGS
+        key = narration_cache.key(text, voice_id, model_id, voice_settings)
+        file = narration_cache.get(key)
+        if file:
+            return key, file, None
+        response = self.text_to_speech(text, voice_id=voice_id, model_id=model_id, voice_settings=voice_settings,
+                                       stream=True)
+        return key, None, ProviderAudio(response, narration_cache.store(key, response.iter_content(chunk_size)))
+
+    def text_to_speech(self, text, voice_id=DEFAULT_VOICE_ID, model_id="eleven_multilingual_v2", voice_settings=None,
+                       stream=False):
+        """
+        :param stream: use the streaming endpoint and leave the body unread, iter_content then
+            yields audio as it is generated instead of once the whole narration exists
+        :return: requests.Response of audio/mpeg
+        """
         url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+        if stream:
+            url = f"{url}/stream"
 
         payload = {
             "model_id": model_id,
             "text": text,
-            "voice_settings":  {
-                "stability": 0.5,
-                "similarity_boost": 0.5
-            }
+            "voice_settings": voice_settings or DEFAULT_VOICE_SETTINGS
         }
         headers = {"Content-Type": "application/json", 'xi-api-key': os.getenv("ELEVEN_LABS_KEY")}
 
-        response = requests.request("POST", url, json=payload, headers=headers)
-        return response
+        def call():
+            response = clients.session("elevenlabs").post(url, json=payload, headers=headers, stream=stream)
+            response.raise_for_status()
+            return response, response.headers
+
+        return limiter(model_id).call(call)
@@ -0,0 +1,418 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import has_app_context
+from sqlalchemy import text
+
+import clients
+import metrics
+from data.models import db
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", default=10000))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", default=24 * 60 * 60))
+# rows in embedding_cache older than this are ignored and pruned, embeddings only change with the model
+EMBEDDING_CACHE_DB_TTL = int(os.getenv("EMBEDDING_CACHE_DB_TTL", default=30 * 24 * 60 * 60))
+EMBEDDING_CACHE_PRUNE_EVERY = 100
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", default=2000))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", default=7 * 24 * 60 * 60))
+# rows kept in response_cache, least recently used rows past this are evicted
+RESPONSE_CACHE_MAX_ROWS = int(os.getenv("RESPONSE_CACHE_MAX_ROWS", default=100000))
+RESPONSE_CACHE_EVICT_EVERY = 100
+NARRATION_CACHE_DIR = os.getenv("NARRATION_CACHE_DIR", default="/tmp/narration-cache")
+NARRATION_CACHE_MAX_BYTES = int(os.getenv("NARRATION_CACHE_MAX_BYTES", default=512 * 1024 * 1024))
+# mirror narrations to the image bucket so other workers and fresh deploys start warm
+NARRATION_CACHE_S3 = os.getenv("NARRATION_CACHE_S3", default="false").lower() == "true"
+NARRATION_CACHE_S3_PREFIX = "narration/"
+PITCH_CACHE_SIZE = int(os.getenv("PITCH_CACHE_SIZE", default=1000))
+PITCH_CACHE_TTL = int(os.getenv("PITCH_CACHE_TTL", default=60 * 60))
+# cosine similarity a request needs with an earlier one for the same recipes to reuse its pitch
+PITCH_CACHE_SIMILARITY = float(os.getenv("PITCH_CACHE_SIMILARITY", default=0.85))
+# differently worded requests remembered per recipe set
+PITCH_CACHE_PER_SET = 8
+
+
+def normalize_text(value):
+    return " ".join(value.lower().split())
+
+
+def hash_key(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """Thread-safe in-process LRU whose entries also expire after ttl seconds."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class EmbeddingCache:
+    """
+    Query embeddings cached in process and in the embedding_cache table.
+
+    Keys are the model plus a hash of the lowercased, whitespace collapsed text so
+    trivially different spellings of the same query share an entry. Rows expire after db_ttl.
+    """
+
+    def __init__(self, max_size=EMBEDDING_CACHE_SIZE, ttl=EMBEDDING_CACHE_TTL, db_ttl=EMBEDDING_CACHE_DB_TTL):
+        self.memory = TTLCache(max_size, ttl)
+        self.db_ttl = db_ttl
+        self._stores = 0
+        self._lock = threading.Lock()
+
+    def get_or_create(self, value, model, embed):
+        text_hash = hash_key(model, normalize_text(value))
+
+        embedding = self.memory.get(text_hash)
+        if embedding is not None:
+            metrics.increment("embedding_cache.memory.hits")
+            return embedding
+
+        embedding = self._load(model, text_hash)
+        if embedding is not None:
+            metrics.increment("embedding_cache.db.hits")
+            self.memory.set(text_hash, embedding)
+            return embedding
+
+        metrics.increment("embedding_cache.misses")
+        embedding = embed(value)
+        self.memory.set(text_hash, embedding)
+        self._store(model, text_hash, embedding)
+        return embedding
+
+    def _load(self, model, text_hash):
+        if not has_app_context():
+            return None
+        try:
+            # own connection so cache traffic never commits or rolls back the request's session
+            with db.engine.connect() as connection:
+                row = connection.execute(text("""
+                    SELECT embeddings::real[] AS embeddings FROM embedding_cache
+                    WHERE model = :model AND text_hash = :text_hash
+                    AND created_at > NOW() - make_interval(secs => :ttl);
+                """), {"model": model, "text_hash": text_hash, "ttl": self.db_ttl}).first()
+            return list(row.embeddings) if row else None
+        except Exception as e:
+            print(f"error reading embedding cache: {e}")
+            return None
+
+    def _store(self, model, text_hash, embedding):
+        if not has_app_context():
+            return
+        with self._lock:
+            self._stores += 1
+            prune = self._stores % EMBEDDING_CACHE_PRUNE_EVERY == 0
+        try:
+            with db.engine.begin() as connection:
+                # an expired row is replaced rather than kept, _load would never return it again
+                connection.execute(text("""
+                    INSERT INTO embedding_cache (model, text_hash, embeddings, created_at)
+                    VALUES (:model, :text_hash, CAST(:embeddings AS vector), NOW())
+                    ON CONFLICT (model, text_hash) DO UPDATE
+                    SET embeddings = EXCLUDED.embeddings, created_at = EXCLUDED.created_at;
+                """), {"model": model, "text_hash": text_hash, "embeddings": embedding})
+                if prune:
+                    connection.execute(text("""
+                        DELETE FROM embedding_cache WHERE created_at < NOW() - make_interval(secs => :ttl);
+                    """), {"ttl": self.db_ttl})
+        except Exception as e:
+            print(f"error writing embedding cache: {e}")
+
+
+class ResponseCache:
+    """
+    Completions cached in process and in the response_cache table, keyed by model and both prompts.
+
+    Only meant for deterministic prompts such as extraction, callers opt out for creative ones.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, max_rows=RESPONSE_CACHE_MAX_ROWS):
+        self.memory = TTLCache(max_size, ttl)
+        self.max_rows = max_rows
+        self._stores = 0
+        self._lock = threading.Lock()
+
+    def get_or_create(self, model, system_prompt, prompt, complete):
+        prompt_hash = hash_key(model, system_prompt, prompt)
+
+        response = self.memory.get(prompt_hash)
+        if response is not None:
+            metrics.increment("response_cache.memory.hits")
+            return response
+
+        response = self._load(model, prompt_hash)
+        if response is not None:
+            metrics.increment("response_cache.db.hits")
+            self.memory.set(prompt_hash, response)
+            return response
+
+        metrics.increment("response_cache.misses")
+        # a failed completion raises, so only real completions are ever cached
+        response = complete()
+        self.memory.set(prompt_hash, response)
+        self._store(model, prompt_hash, response)
+        return response
+
+    def invalidate(self, model, system_prompt, prompt):
+        """Drop a cached completion the caller found unusable so the next call asks again."""
+        prompt_hash = hash_key(model, system_prompt, prompt)
+        self.memory.delete(prompt_hash)
+        if not has_app_context():
+            return
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(text("""
+                    DELETE FROM response_cache WHERE model = :model AND prompt_hash = :prompt_hash;
+                """), {"model": model, "prompt_hash": prompt_hash})
+        except Exception as e:
+            print(f"error invalidating response cache: {e}")
+
+    def _load(self, model, prompt_hash):
+        if not has_app_context():
+            return None
+        try:
+            with db.engine.begin() as connection:
+                row = connection.execute(text("""
+                    UPDATE response_cache SET last_used_at = NOW()
+                    WHERE model = :model AND prompt_hash = :prompt_hash
+                    RETURNING response;
+                """), {"model": model, "prompt_hash": prompt_hash}).first()
+            return row.response if row else None
+        except Exception as e:
+            print(f"error reading response cache: {e}")
+            return None
+
+    def _store(self, model, prompt_hash, response):
+        if not has_app_context():
+            return
+        with self._lock:
+            self._stores += 1
+            evict = self._stores % RESPONSE_CACHE_EVICT_EVERY == 0
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(text("""
+                    INSERT INTO response_cache (model, prompt_hash, response, created_at, last_used_at)
+                    VALUES (:model, :prompt_hash, :response, NOW(), NOW())
+                    ON CONFLICT (model, prompt_hash) DO NOTHING;
+                """), {"model": model, "prompt_hash": prompt_hash, "response": response})
+                if evict:
+                    connection.execute(text("""
+                        DELETE FROM response_cache WHERE id IN (
+                            SELECT id FROM response_cache ORDER BY last_used_at DESC OFFSET :max_rows
+                        );
+                    """), {"max_rows": self.max_rows})
+        except Exception as e:
+            print(f"error writing response cache: {e}")
+
+
+class NarrationCache:
+    """
+    Synthesized mp3s on local disk, named by a hash of the text, voice, model and voice settings.
+
+    Files are written next to their final name and moved into place once the whole narration
+    has streamed, so a disconnect mid stream never leaves a truncated entry. Hits bump the
+    file's mtime and eviction removes the oldest files once the directory passes max_bytes.
+    Hits are handed out as open files, so eviction never pulls a file out from under a response.
+    """
+
+    def __init__(self, directory=NARRATION_CACHE_DIR, max_bytes=NARRATION_CACHE_MAX_BYTES, mirror=NARRATION_CACHE_S3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mirror = mirror
+        self._mirror_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="narration-mirror")
+
+    @staticmethod
+    def key(text, voice_id, model_id, voice_settings):
+        return hash_key(voice_id, model_id, json.dumps(voice_settings, sort_keys=True), text)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def get(self, key):
+        """
+        :return: the cached narration opened for binary reading, or None. An open file keeps its
+            contents if another worker's eviction removes it before the caller has sent it.
+        """
+        file = self._open(key)
+        if file is not None:
+            metrics.increment("narration_cache.disk.hits")
+            return file
+        if self.mirror and self._download(key):
+            file = self._open(key)
+            if file is not None:
+                metrics.increment("narration_cache.s3.hits")
+                return file
+        metrics.increment("narration_cache.misses")
+        return None
+
+    def _open(self, key):
+        try:
+            file = open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+        # hits bump the mtime that eviction orders by
+        os.utime(file.fileno())
+        return file
+
+    def store(self, key, chunks):
+        """Yield chunks through while writing them to the cache, the entry only appears if all of them arrive."""
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        complete = False
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                os.replace(temporary, self.path(key))
+                self.evict()
+                if self.mirror:
+                    self._mirror_executor.submit(self._upload, key)
+            else:
+                os.remove(temporary)
+
+    def evict(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".mp3")]
+            entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries))
+        except FileNotFoundError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                metrics.increment("narration_cache.evictions")
+            except FileNotFoundError:
+                pass
+
+    def _s3_key(self, key):
+        return f"{NARRATION_CACHE_S3_PREFIX}{key}.mp3"
+
+    def _upload(self, key):
+        try:
+            clients.s3().upload_file(self.path(key), os.getenv("IMAGE_BUCKET_NAME"), self._s3_key(key),
+                                     ExtraArgs={"ContentType": "audio/mpeg"})
+        except Exception as e:
+            print(f"error mirroring narration {key}: {e}")
+
+    def _download(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                clients.s3().download_fileobj(os.getenv("IMAGE_BUCKET_NAME"), self._s3_key(key), file)
+            os.replace(temporary, self.path(key))
+            self.evict()
+            return True
+        except Exception:
+            # usually not mirrored yet
+            os.remove(temporary)
+            return False
+
+
+class PitchCache:
+    """
+    Recipe pitches cached in process, reused for paraphrased requests that retrieved the same recipes.
+
+    Pitches are grouped by the retrieved recipes' ids, titles and descriptions, which is everything
+    the pitch prompt sees of them, so editing a recipe leaves every pitch written from its old text
+    unreachable in every worker. Within a group a pitch is reused when the request's embedding is
+    within PITCH_CACHE_SIMILARITY of the one it was written for, since the same recipes can still be
+    pitched differently to "something vegetarian" than to "something quick".
+    """
+
+    def __init__(self, max_size=PITCH_CACHE_SIZE, ttl=PITCH_CACHE_TTL, similarity=PITCH_CACHE_SIMILARITY,
+                 per_set=PITCH_CACHE_PER_SET):
+        self.memory = TTLCache(max_size, ttl)
+        self.ttl = ttl
+        self.similarity = similarity
+        self.per_set = per_set
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(recipes):
+        return hash_key(*(f"{recipe['id']}\x1e{recipe['title']}\x1e{recipe['description']}"
+                          for recipe in sorted(recipes, key=lambda recipe: recipe["id"])))
+
+    def get_or_create(self, recipes, embedding, pitch):
+        """
+        :param recipes: retrieved recipes, dicts with id, title and description
+        :param embedding: embedding of the request
+        :param pitch: writes the pitch on a miss
+        """
+        key = self.key(recipes)
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        best, best_similarity = None, -1.0
+        for entry in self._entries(key):
+            similarity = float(entry["embedding"] @ query)
+            if similarity > best_similarity:
+                best, best_similarity = entry, similarity
+        if best is not None and best_similarity >= self.similarity:
+            metrics.increment("pitch_cache.hits")
+            metrics.observe("pitch_cache.saved", best["latency"])
+            return best["pitch"]
+
+        metrics.increment("pitch_cache.misses")
+        start = time.perf_counter()
+        # a failed completion raises, so only real pitches are ever cached
+        response = pitch()
+        entry = {"embedding": query, "pitch": response, "latency": time.perf_counter() - start,
+                 "expires_at": time.monotonic() + self.ttl}
+        with self._lock:
+            self.memory.set(key, [entry] + self._entries(key)[:self.per_set - 1])
+        return response
+
+    def _entries(self, key):
+        """Unexpired pitches of a recipe set, newest first, the group's own ttl restarts with every pitch."""
+        now = time.monotonic()
+        return [entry for entry in self.memory.get(key) or [] if entry["expires_at"] > now]
+
+
+embedding_cache = EmbeddingCache()
+response_cache = ResponseCache()
+narration_cache = NarrationCache()
+pitch_cache = PitchCache()
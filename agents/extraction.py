@@ -0,0 +1,272 @@
+import contextvars
+import json
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError
+
+import metrics
+from agents.baseAgent import Agent, JSON_RESPONSE_CACHE_MODEL
+from agents.cache import response_cache
+
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", default=8))
+# per_field, structured, or ab to split recipes evenly between the two
+EXTRACTION_MODE = os.getenv("RECIPE_EXTRACTION_MODE", default="per_field")
+
+# shared by every request in this worker so the cap bounds total in-flight LLM calls
+executor = ThreadPoolExecutor(max_workers=EXTRACTION_CONCURRENCY, thread_name_prefix="extraction")
+
+
+def submit(fn, *args):
+    # runs in the caller's context so the app context, and with it the persistent caches, is available
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+# field -> (system prompt, prefix prepended to the ocr text)
+FIELD_PROMPTS = {
+    "ingredients": (
+        f"You are an food recipe ingredients extraction agent. Your goal is to extract the ingredients from the "
+        f"recipe provided by the user. You must use the exact wordage of the ingredient and measurement in the "
+        f"recipe, but return a bulleted list of all ingredients needed. If the provided text is unintelligible return <none>.",
+        ""),
+    "steps": (
+        f"You are an food recipe steps extraction agent. Your goal is to extract the steps from the recipe provided "
+        f"by the user. You must use the exact wordage of the steps in the recipe, but return a bulletted list of all "
+        f"steps. If the provided text is unintelligible return <none>.",
+        ""),
+    "equipment": (
+        f"You are an food recipe equipment extraction agent. Your goal is to extract the equipment from the recipe "
+        f"provided by the user. You must use the exact wordage of the equipment in the recipe, but return a bulletted "
+        f"list of all equipment. If the provided text is unintelligible return <none>.",
+        ""),
+    "servings": (
+        f"""You are an food recipe servings extraction agent. Your goal is to extract the servings from the recipe provided by the user. You must use the exact wordage of the servings in the recipe, if amount fo servings not specified than make an educated guess. You must only return a number range e.g. `2-4`
+            Example:
+            [user]: How many servings is this dish given the following information: This recipe serves a family of 2-4, but can be stretched to feed more by scaling.
+            [assistant]: 2-4
+            """,
+        "How many servings is this dish given the following information: "),
+    "time": (
+        f"""You are a recipe time extraction and estimation agent. Your goal is to return the total number of minutes it will take to complete the recipe. You must use the exact minutes estimate if provided, but if none is provided do your best to accurately estimate the time it will take. You must only return the number of minutes e.g. `35`
+            Example:
+            [user]: How much minutes will it take to make this dish given the following information: This recipe takes 15 minutes of prep time and 20 minutes of cooking time.
+            [assistant]: 35
+            [user]: How much minutes will it take to make this dish given the following information: The estimated total time for this Zesty Lemon Garlic Shrimp Pasta recipe is 45 minutes.
+            [assistant]: 45
+            """,
+        "How many minutes will it take to make this dish given the following information: "),
+    "description": (
+        f"You are a recipe description agent. Your goal is to return a very descriptive 15-30 word description of the "
+        f"dish in the recipe. You must describe the type of food it is, taste, cuisine (e.g. italian), seasonality, "
+        f"ingredients, and ease. If the provided text is unintelligible return <none>.",
+        ""),
+    "title": (
+        f"You are a recipe titling agent. Your goal is to return a succinct yet descriptive title for a dish. The title must be accurate. If the provided text is unintelligible return <none>.",
+        ""),
+    "author": (
+        "Extract the author or writer of the recipe. If there is none return <none>",
+        ""),
+}
+
+# fields whose text is embedded and stored alongside the recipe
+EMBEDDED_FIELDS = ("description", "ingredients")
+
+
+class ServingsRange(BaseModel):
+    start: int
+    end: int
+
+
+class RecipeExtraction(BaseModel):
+    ingredients: str
+    steps: str
+    equipment: str
+    servings: Optional[ServingsRange] = None
+    time: Optional[int] = None
+    description: str
+    title: str
+    author: Optional[str] = None
+
+    def to_fields(self):
+        """Render as the raw text the per-field agents return so both modes parse the same way."""
+        servings = f"{self.servings.start}-{self.servings.end}" if self.servings else ""
+        return {
+            "ingredients": self.ingredients,
+            "steps": self.steps,
+            "equipment": self.equipment,
+            "servings": servings,
+            "time": str(self.time) if self.time is not None else "",
+            "description": self.description,
+            "title": self.title,
+            "author": self.author or "<none>",
+        }
+
+
+STRUCTURED_PROMPT = (
+    f"You are a food recipe extraction agent. Extract the recipe provided by the user and respond with a single JSON "
+    f"object matching this JSON schema: {json.dumps(RecipeExtraction.model_json_schema())}\n"
+    f"ingredients: a bulleted list of all ingredients using the exact wordage and measurements in the recipe.\n"
+    f"steps: a bulleted list of all steps using the exact wordage in the recipe.\n"
+    f"equipment: a bulleted list of all equipment using the exact wordage in the recipe.\n"
+    f"servings: the servings range, make an educated guess if it is not specified.\n"
+    f"time: the total number of minutes to complete the recipe, estimate it if none is provided.\n"
+    f"description: a very descriptive 15-30 word description of the dish covering the type of food, taste, cuisine "
+    f"(e.g. italian), seasonality, ingredients, and ease.\n"
+    f"title: a succinct yet descriptive and accurate title for the dish.\n"
+    f"author: the author or writer of the recipe, null if there is none.\n"
+    f"If the provided text is unintelligible use <none> for every text field."
+)
+
+
+def extract_fields(ocr_text, fields=None, agent=None, previous=None):
+    """
+    Run the per-field extraction agents concurrently.
+
+    Embeddings for EMBEDDED_FIELDS are requested in one batch as soon as their
+    text comes back instead of waiting for the slowest field.
+
+    :param ocr_text: transcribed recipe text
+    :param fields: fields to extract, defaults to every field in FIELD_PROMPTS
+    :param agent: Agent to use
+    :param previous: dict of field -> stored text, embedded fields whose text is unchanged are not re-embedded
+    :return: (dict of field -> raw text, dict of field -> embedding)
+    """
+    agent = agent or Agent()
+    fields = fields or list(FIELD_PROMPTS.keys())
+
+    text_futures = {}
+    for field in fields:
+        system_prompt, prefix = FIELD_PROMPTS[field]
+        future = submit(agent.generate_response, system_prompt, prefix + ocr_text)
+        text_futures[future] = field
+
+    embedded_fields = [field for field in EMBEDDED_FIELDS if field in fields]
+    results = {}
+    embeddings_future = None
+    for future in as_completed(text_futures):
+        field = text_futures[future]
+        results[field] = future.result()
+        if previous and field in embedded_fields and results[field] == previous.get(field):
+            embedded_fields.remove(field)
+        if embedded_fields and embeddings_future is None and all(field in results for field in embedded_fields):
+            # one batched request for every embedded field, started while slower fields are still running
+            embeddings_future = submit(agent.get_embeddings, [results[field] for field in embedded_fields])
+
+    embeddings = dict(zip(embedded_fields, embeddings_future.result())) if embeddings_future else {}
+    return results, embeddings
+
+
+# cheap signals that a page holds the source text of a field. Words like "add" or "minutes" turn up on
+# nearly every page of a recipe, so each signal needs a section heading or the shape the field is written
+# in: a quantity and unit, an instruction starting a line, a number of servings or minutes.
+_QUANTITY = r"(\d+(?:[./]\d+)?|\d*\s?[½⅓⅔¼¾⅛])"
+_LINE_START = r"^[\s\-•*]*(?:(?:step\s*)?\d+[.):]?\s+)?"
+FIELD_SIGNALS = {
+    "ingredients": re.compile(
+        rf"^\s*ingredients\b|{_QUANTITY}\s*(cups?|tbsps?|tablespoons?|tsps?|teaspoons?|g|grams?|kg|oz|ounces?|"
+        r"lbs?|pounds?|ml|l|liters?|litres?|cloves?|pinch(?:es)?|cans?|sticks?)\b",
+        re.IGNORECASE | re.MULTILINE),
+    "steps": re.compile(
+        r"^\s*(method|directions|instructions|preparation)\b|"
+        rf"{_LINE_START}(preheat|stir|mix|whisk|bake|boil|simmer|cook|heat|add|combine|serve|chop|fold|place|pour|"
+        r"transfer|season|bring|reduce|cover|remove|melt|beat|roast|saute|sauté|slice|let)\b",
+        re.IGNORECASE | re.MULTILINE),
+    "equipment": re.compile(
+        r"^\s*(equipment|tools|you will need)\b|\b(skillet|dutch oven|stand mixer|hand mixer|food processor|"
+        r"blender|sheet pan|baking sheet|loaf pan|cake pan|springform|ramekins?|thermometer|"
+        r"\d+[- ](?:inch|in\.|cm|quart|qt)[- ](?:pan|pot|dish|skillet))\b",
+        re.IGNORECASE | re.MULTILINE),
+    "servings": re.compile(rf"\b(serves|servings?|yields?|portions?|makes(?: about)?)\s*:?\s*{_QUANTITY}",
+                           re.IGNORECASE),
+    "time": re.compile(rf"\b(prep|cook|cooking|bake|baking|total|active|ready in)(?: time)?\s*:?\s*{_QUANTITY}\s*"
+                       r"(minutes?|mins?|hours?|hrs?)\b", re.IGNORECASE),
+    # names are capitalised, so only the lead-in ignores case
+    "author": re.compile(r"^\s*(?i:by|recipe by|from|adapted from|recipe courtesy of)\s+[A-Z]", re.MULTILINE),
+}
+# fields generated from the rest of the recipe rather than transcribed from a page
+DERIVED_FIELDS = {"description": ("title", "ingredients", "steps"), "time": ("steps",), "servings": ("ingredients",)}
+
+
+def fields_affected_by_pages(old_md5s, new_md5s, page_texts):
+    """
+    Pick the fields worth re-extracting when a recipe's pages change.
+
+    A field is affected when a removed or added page carries its signals, the title when the first
+    page changed, and derived fields when a field they are generated from is affected.
+
+    :param old_md5s: page md5s of the stored submission, in order
+    :param new_md5s: page md5s of the update, in order
+    :param page_texts: dict of page md5 -> ocr text covering every changed page
+    :return: list of fields, empty when the pages are the same
+    """
+    if old_md5s == new_md5s:
+        return []
+    changed_text = "\n".join(page_texts.get(md5, "") for md5 in set(old_md5s) ^ set(new_md5s))
+    affected = {field for field, signal in FIELD_SIGNALS.items() if signal.search(changed_text)}
+    if set(old_md5s) == set(new_md5s):
+        # only reordered, the steps are the one transcribed field whose order matters
+        affected.add("steps")
+    if not old_md5s or not new_md5s or old_md5s[0] != new_md5s[0]:
+        affected |= {"title", "author"}
+    if not affected:
+        # pages changed without any recognisable signal, re-read the list fields
+        affected = {"ingredients", "steps", "equipment"}
+    for field, sources in DERIVED_FIELDS.items():
+        if affected & set(sources):
+            affected.add(field)
+    return [field for field in FIELD_PROMPTS if field in affected]
+
+
+def extract_structured(ocr_text, agent=None):
+    """
+    Extract every field with one JSON constrained completion.
+
+    :return: (dict of field -> raw text, dict of field -> embedding)
+    :raises ValidationError: if the completion does not match RecipeExtraction
+    """
+    agent = agent or Agent()
+    extraction = RecipeExtraction.model_validate_json(agent.generate_json_response(STRUCTURED_PROMPT, ocr_text))
+    results = extraction.to_fields()
+
+    embeddings = dict(zip(EMBEDDED_FIELDS, agent.get_embeddings([results[field] for field in EMBEDDED_FIELDS])))
+    return results, embeddings
+
+
+def extract_recipe(ocr_text, mode=None):
+    """
+    Extract a recipe with the configured mode, recording latency, token usage and parse failures per mode.
+
+    :param ocr_text: transcribed recipe text
+    :param mode: per_field or structured, defaults to RECIPE_EXTRACTION_MODE
+    :return: (dict of field -> raw text, dict of field -> embedding)
+    """
+    mode = mode or EXTRACTION_MODE
+    if mode == "ab":
+        mode = random.choice(("per_field", "structured"))
+
+    agent = Agent()
+    start = time.perf_counter()
+    if mode == "structured":
+        try:
+            results, embeddings = extract_structured(ocr_text, agent=agent)
+        except (ValidationError, ValueError) as e:
+            print(f"structured extraction failed, falling back to per field: {e}")
+            metrics.increment("extraction.structured.parse_failures")
+            response_cache.invalidate(JSON_RESPONSE_CACHE_MODEL, STRUCTURED_PROMPT, ocr_text)
+            results, embeddings = extract_fields(ocr_text, agent=agent)
+    else:
+        mode = "per_field"
+        results, embeddings = extract_fields(ocr_text, agent=agent)
+
+    metrics.observe(f"extraction.{mode}.latency", time.perf_counter() - start)
+    metrics.increment(f"extraction.{mode}.recipes")
+    metrics.increment(f"extraction.{mode}.prompt_tokens", agent.usage["prompt_tokens"])
+    metrics.increment(f"extraction.{mode}.completion_tokens", agent.usage["completion_tokens"])
+    for field in ("time", "servings"):
+        if not results[field].strip().replace("-", "").isdigit():
+            metrics.increment(f"extraction.{mode}.{field}_parse_failures")
+    return results, embeddings
@@ -0,0 +1,110 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+import metrics
+from agents.limits import DeadlineExceededError, remaining
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", default="false").lower() == "true"
+# a duplicate request is sent once the first has taken longer than this percentile of recent latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", default=95))
+# delay used until HEDGE_MIN_SAMPLES latencies have been seen
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", default=2))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", default=20))
+# share of recent calls allowed to hedge, caps the extra load hedging puts on the provider
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", default=0.05))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", default=200))
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", default=16))
+
+executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+
+class Hedger:
+    """
+    Deadline bound calls to one provider operation, optionally hedged.
+
+    A hedged call sends a duplicate once the first has been outstanding longer than the
+    HEDGE_PERCENTILE latency and returns whichever answers first; the loser runs to
+    completion in the background and is discarded.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._latencies = deque(maxlen=HEDGE_WINDOW)
+        self._hedged = deque(maxlen=HEDGE_WINDOW)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return HEDGE_DEFAULT_DELAY
+            return float(np.percentile(self._latencies, HEDGE_PERCENTILE))
+
+    def rate(self):
+        """Share of recent calls that sent a hedge."""
+        with self._lock:
+            return sum(self._hedged) / len(self._hedged) if self._hedged else 0.0
+
+    def _record(self, latency, hedged):
+        with self._lock:
+            self._latencies.append(latency)
+            self._hedged.append(hedged)
+        metrics.increment(f"hedge.{self.name}.calls")
+        metrics.observe(f"hedge.{self.name}.latency", latency)
+
+    def call(self, fn, hedge=None):
+        """
+        :param fn: the provider call, run under the caller's context so it sees the same deadline
+        :param hedge: send a duplicate request when the first is slow, defaults to HEDGE_ENABLED
+        :raises DeadlineExceededError: if the deadline passes before any request answers
+        """
+        hedge = HEDGE_ENABLED if hedge is None else hedge
+        left = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceededError(f"{self.name}: deadline passed before the call")
+        start = time.monotonic()
+        if not hedge:
+            result = fn()
+            self._record(time.monotonic() - start, False)
+            return result
+
+        futures = [executor.submit(contextvars.copy_context().run, fn)]
+        done, _ = wait(futures, timeout=self.delay() if left is None else min(self.delay(), left))
+        hedged = False
+        if not done and self.rate() < HEDGE_MAX_RATE and (remaining() is None or remaining() > 0):
+            hedged = True
+            metrics.increment(f"hedge.{self.name}.hedged")
+            futures.append(executor.submit(contextvars.copy_context().run, fn))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(), return_when=FIRST_COMPLETED)
+            if not done:
+                self._record(time.monotonic() - start, hedged)
+                raise DeadlineExceededError(f"{self.name}: no answer before the deadline")
+            for future in done:
+                if future.exception() is None:
+                    if hedged and future is futures[1]:
+                        metrics.increment(f"hedge.{self.name}.wins")
+                    self._record(time.monotonic() - start, hedged)
+                    return future.result()
+                error = future.exception()
+        self._record(time.monotonic() - start, hedged)
+        raise error
+
+
+_hedgers = {}
+_hedgers_lock = threading.Lock()
+
+
+def hedger(name):
+    with _hedgers_lock:
+        if name not in _hedgers:
+            _hedgers[name] = Hedger(name)
+        return _hedgers[name]
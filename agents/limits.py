@@ -0,0 +1,210 @@
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+from openai import APIConnectionError, APIStatusError
+
+import metrics
+
+# concurrent calls allowed per model before the first response, grown and shrunk from there
+LIMITER_INITIAL_CONCURRENCY = int(os.getenv("LIMITER_INITIAL_CONCURRENCY", default=8))
+LIMITER_MAX_CONCURRENCY = int(os.getenv("LIMITER_MAX_CONCURRENCY", default=64))
+LIMITER_ATTEMPTS = int(os.getenv("LIMITER_ATTEMPTS", default=5))
+LIMITER_BACKOFF_BASE = float(os.getenv("LIMITER_BACKOFF_BASE", default=0.5))
+LIMITER_BACKOFF_MAX = float(os.getenv("LIMITER_BACKOFF_MAX", default=30))
+# longest a call waits for a free slot before giving up as rate limited
+LIMITER_ACQUIRE_TIMEOUT = float(os.getenv("LIMITER_ACQUIRE_TIMEOUT", default=120))
+
+# monotonic time by which the current request wants its answer, None when it has no deadline
+_deadline = ContextVar("deadline", default=None)
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class ProviderError(Exception):
+    """A provider call that still failed after every retry."""
+
+
+class RateLimitedError(ProviderError):
+    """The provider kept rejecting calls for exceeding its rate limit."""
+
+
+class DeadlineExceededError(ProviderError):
+    """The request's deadline passed before the provider answered."""
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Budget provider calls made in the block, pool tasks submitted with its context inherit it.
+
+    A nested deadline can only shorten the outer one, None leaves it as it is.
+    """
+    if seconds is None:
+        yield
+        return
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, None without one."""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+def parse_duration(value):
+    """Seconds in a rate limit reset header such as 20ms, 1s or 6m0s."""
+    if not value:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in _DURATION.findall(value))
+
+
+def retry_after(headers):
+    """Seconds the provider asked to wait before retrying, if it said."""
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def classify(error):
+    """:return: (retryable, rate limited, response headers or None)"""
+    if isinstance(error, APIStatusError):
+        status, headers = error.status_code, error.response.headers
+    elif isinstance(error, requests.HTTPError) and error.response is not None:
+        status, headers = error.response.status_code, error.response.headers
+    elif isinstance(error, (APIConnectionError, requests.ConnectionError, requests.Timeout)):
+        return True, False, None
+    else:
+        return False, False, None
+    return status == 429 or status == 408 or status >= 500, status == 429, headers
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit for one provider model, adjusted additive increase, multiplicative decrease.
+
+    Every success raises the limit by 1 / limit, so roughly by one per limit's worth of calls,
+    and every 429 halves it. Calls also wait out any pause the provider asks for, either in
+    retry-after on a 429 or by reporting no remaining requests or tokens in its rate limit headers.
+    """
+
+    def __init__(self, name, initial=LIMITER_INITIAL_CONCURRENCY, maximum=LIMITER_MAX_CONCURRENCY):
+        self.name = name
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=LIMITER_ACQUIRE_TIMEOUT):
+        start = time.monotonic()
+        left = remaining()
+        error = RateLimitedError
+        if left is not None and left < timeout:
+            timeout, error = max(left, 0), DeadlineExceededError
+        deadline = start + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise error(f"{self.name}: no capacity within {timeout:.1f}s")
+                if self.paused_until > now:
+                    wait = self.paused_until - now
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    wait = deadline - now
+                self._condition.wait(min(wait, deadline - now))
+            self.in_flight += 1
+        metrics.observe(f"limiter.{self.name}.wait", time.monotonic() - start)
+
+    def release(self, headers=None, outcome="ok"):
+        """:param outcome: ok, throttled for a 429, or failed for any other error"""
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif outcome == "throttled":
+                self.limit = max(1.0, self.limit / 2)
+                metrics.increment(f"limiter.{self.name}.throttled")
+            pause = self._pause(headers, outcome == "throttled")
+            if pause:
+                self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self._condition.notify_all()
+
+    @staticmethod
+    def _pause(headers, throttled):
+        if not headers:
+            return None
+        if throttled:
+            return retry_after(headers)
+        pauses = [parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                  for kind in ("requests", "tokens") if headers.get(f"x-ratelimit-remaining-{kind}") == "0"]
+        return max(pauses, default=None)
+
+    def call(self, fn, attempts=LIMITER_ATTEMPTS):
+        """
+        Run fn under the limit, retrying rate limits, timeouts and server errors with jittered backoff.
+
+        Errors that retrying can't fix, such as a bad request, are raised unchanged.
+
+        :param fn: makes the call and returns (result, response headers)
+        :raises RateLimitedError: if the last attempt was still rate limited
+        :raises ProviderError: if the last attempt failed for another retryable reason
+        :raises DeadlineExceededError: if the request deadline leaves no time for a retry
+        """
+        for attempt in range(attempts):
+            self.acquire()
+            try:
+                result, headers = fn()
+            except Exception as e:
+                retryable, throttled, headers = classify(e)
+                self.release(headers, outcome="throttled" if throttled else "failed")
+                if not retryable:
+                    raise
+                error = RateLimitedError if throttled else ProviderError
+                if attempt == attempts - 1:
+                    raise error(f"{self.name} failed after {attempts} attempts: {e}") from e
+                metrics.increment(f"limiter.{self.name}.retries")
+                delay = retry_after(headers) if throttled else None
+                if delay is None:
+                    # full jitter keeps retries from a burst of callers from landing together
+                    delay = random.uniform(0, min(LIMITER_BACKOFF_MAX, LIMITER_BACKOFF_BASE * 2 ** attempt))
+                left = remaining()
+                if left is not None and left <= delay:
+                    raise DeadlineExceededError(f"{self.name}: deadline passed while retrying: {e}") from e
+                print(f"{self.name} call failed, retrying in {delay:.2f}s: {e}")
+                time.sleep(delay)
+                continue
+            self.release(headers)
+            return result
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(name):
+    """The worker wide limiter for a provider model."""
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name)
+        return _limiters[name]
@@ -0,0 +1,188 @@
+import io
+import os
+import shutil
+import subprocess
+
+from PIL import Image, ImageOps
+
+import metrics
+
+try:
+    # phones upload HEIC, which Pillow only decodes with this plugin, it is in requirements.txt but optional
+    # so a build without its native wheel still starts
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+# the vision model scales high detail images to fit 2048 x 2048 and then to 768 on the short side,
+# anything sent beyond that is upload and encoding time for pixels it never sees
+OCR_IMAGE_SHORT_SIDE = int(os.getenv("OCR_IMAGE_SHORT_SIDE", default=768))
+OCR_IMAGE_LONG_SIDE = int(os.getenv("OCR_IMAGE_LONG_SIDE", default=2048))
+OCR_IMAGE_GRAYSCALE = os.getenv("OCR_IMAGE_GRAYSCALE", default="true").lower() == "true"
+OCR_IMAGE_QUALITY = int(os.getenv("OCR_IMAGE_QUALITY", default=80))
+OCR_IMAGE_CROP = os.getenv("OCR_IMAGE_CROP", default="false").lower() == "true"
+# pages whose decoded size would be above this are sent as uploaded, jpegs are counted after the reduced
+# scale decode so only large pngs and heics reach it, 24 million pixels is about 72 MB of rgb
+OCR_MAX_DECODE_PIXELS = int(os.getenv("OCR_MAX_DECODE_PIXELS", default=24_000_000))
+# pixels darker than this after autocontrast count as ink when cropping to the text
+CROP_INK_THRESHOLD = 96
+CROP_MARGIN = 0.02
+# what ImageOps.exif_transpose does for each EXIF orientation, applied here after the page is scaled down
+EXIF_TRANSPOSE = {2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+                  4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE, 6: Image.Transpose.ROTATE_270,
+                  7: Image.Transpose.TRANSVERSE, 8: Image.Transpose.ROTATE_90}
+
+AUDIO_PREPROCESS = os.getenv("AUDIO_PREPROCESS", default="false").lower() == "true"
+# mono 16 kHz at 32 kbps is all speech recognition needs, phone recordings are usually 44.1 kHz stereo
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", default=16000))
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", default="32k")
+AUDIO_SILENCE_THRESHOLD = os.getenv("AUDIO_SILENCE_THRESHOLD", default="-45dB")
+AUDIO_PREPROCESS_TIMEOUT = float(os.getenv("AUDIO_PREPROCESS_TIMEOUT", default=20))
+# silenceremove only trims the start, so the audio is reversed to trim the end the same way
+TRIM_SILENCE_FILTER = (f"silenceremove=start_periods=1:start_threshold={AUDIO_SILENCE_THRESHOLD},areverse,"
+                       f"silenceremove=start_periods=1:start_threshold={AUDIO_SILENCE_THRESHOLD},areverse")
+
+# extensions the transcription endpoint recognises, it goes by the filename rather than the content type
+AUDIO_EXTENSIONS = {"audio/mp4": ".m4a", "audio/x-m4a": ".m4a", "audio/m4a": ".m4a", "audio/mpeg": ".mp3",
+                    "audio/mp3": ".mp3", "audio/webm": ".webm", "video/webm": ".webm", "audio/wav": ".wav",
+                    "audio/x-wav": ".wav", "audio/wave": ".wav", "audio/ogg": ".ogg", "audio/flac": ".flac",
+                    "video/mp4": ".mp4"}
+
+# formats the vision endpoint accepts as they are
+VISION_MIME_TYPES = {"JPEG": "image/jpeg", "MPO": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp",
+                     "GIF": "image/gif"}
+# leading bytes of the image formats uploads come in, for pages that can't be decoded
+IMAGE_SIGNATURES = ((b"\xff\xd8\xff", "image/jpeg"), (b"\x89PNG\r\n\x1a\n", "image/png"), (b"GIF8", "image/gif"),
+                    (b"BM", "image/bmp"), (b"II*\x00", "image/tiff"), (b"MM\x00*", "image/tiff"))
+HEIF_BRANDS = {b"heic": "image/heic", b"heix": "image/heic", b"mif1": "image/heif", b"msf1": "image/heif",
+               b"avif": "image/avif"}
+
+
+def sniff_mime_type(content):
+    """Mime type of an image from its leading bytes, application/octet-stream when it isn't recognised."""
+    head = bytes(content[:16])
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return HEIF_BRANDS[head[8:12]]
+    return "application/octet-stream"
+
+
+def text_bounds(image):
+    """Bounding box of the dark text on a light page, or None when it covers most of the image anyway."""
+    gray = ImageOps.autocontrast(image.convert("L"))
+    ink = gray.point(lambda value: 255 if value < CROP_INK_THRESHOLD else 0)
+    box = ink.getbbox()
+    if box is None:
+        return None
+    margin_x, margin_y = int(image.width * CROP_MARGIN), int(image.height * CROP_MARGIN)
+    box = (max(box[0] - margin_x, 0), max(box[1] - margin_y, 0),
+           min(box[2] + margin_x, image.width), min(box[3] + margin_y, image.height))
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    return box if area < 0.9 * image.width * image.height else None
+
+
+def ocr_size(size):
+    """Size a page of size is scaled down to, it is never scaled up."""
+    scale = min(1.0, OCR_IMAGE_LONG_SIDE / max(size), OCR_IMAGE_SHORT_SIDE / min(size))
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def prepare_for_ocr(content, grayscale=OCR_IMAGE_GRAYSCALE, crop=OCR_IMAGE_CROP):
+    """
+    Shrink an uploaded page to what the vision model can use.
+
+    The page is decoded whatever its format, optionally cropped to the text, scaled down to the
+    model's effective resolution, turned upright from its EXIF orientation and recompressed as jpeg.
+    Jpegs are decoded at a reduced scale and straight to grayscale, so a phone photo never exists
+    in memory at full size. The original is returned unchanged when it can't be decoded or would
+    decode to more than OCR_MAX_DECODE_PIXELS, or when it is already smaller, upright, uncropped
+    and in a format the endpoint accepts.
+
+    :param content: uploaded image bytes
+    :return: (image bytes, mime type)
+    """
+    try:
+        image = Image.open(io.BytesIO(content))
+        original_format = image.format
+        size = ocr_size(image.size)
+        # a no-op for everything but jpeg, a crop needs the full resolution to scale the text back up from
+        image.draft("L" if grayscale else "RGB", None if crop else size)
+        if image.width * image.height > OCR_MAX_DECODE_PIXELS:
+            raise ValueError(f"{image.width} x {image.height} is over {OCR_MAX_DECODE_PIXELS} pixels")
+        image.load()
+    except Exception as e:
+        print(f"could not decode page, sending it as uploaded: {e}")
+        metrics.increment("ocr_image.passthrough")
+        return content, sniff_mime_type(content)
+    orientation = image.getexif().get(0x0112, 1)
+    rotated = orientation != 1
+
+    box = text_bounds(image) if crop else None
+    if box:
+        image = image.crop(box)
+        size = ocr_size(image.size)
+    if size != image.size:
+        image = image.resize(size, Image.LANCZOS)
+    if orientation in EXIF_TRANSPOSE:
+        image = image.transpose(EXIF_TRANSPOSE[orientation])
+    image = image.convert("L" if grayscale else "RGB")
+
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=OCR_IMAGE_QUALITY, optimize=True)
+    prepared = out.getvalue()
+
+    if len(prepared) >= len(content) and not rotated and not box and original_format in VISION_MIME_TYPES:
+        prepared, mime_type = content, VISION_MIME_TYPES[original_format]
+    else:
+        mime_type = "image/jpeg"
+    saved = len(content) - len(prepared)
+    print(f"prepared {original_format} page for ocr: {len(content)} -> {len(prepared)} bytes, saved {saved}")
+    metrics.increment("ocr_image.pages")
+    metrics.increment("ocr_image.bytes_in", len(content))
+    metrics.increment("ocr_image.bytes_saved", saved)
+    return prepared, mime_type
+
+
+def audio_filename(filename, mimetype=None):
+    """Upload filename with an extension the transcription endpoint recognises, m4a if nothing says otherwise."""
+    stem, extension = os.path.splitext(filename or "")
+    if extension.lower() in AUDIO_EXTENSIONS.values():
+        return filename
+    return f"{stem or 'audio'}{AUDIO_EXTENSIONS.get(mimetype, '.m4a')}"
+
+
+def prepare_for_transcription(content, filename, mimetype=None, enabled=AUDIO_PREPROCESS):
+    """
+    Trim leading and trailing silence and downmix and resample to speech quality mp3.
+
+    Runs ffmpeg over pipes, so nothing touches the disk. The recording is sent as uploaded when
+    preprocessing is off, ffmpeg isn't installed or fails (an m4a with its index at the end can't
+    be read from a pipe), or the result isn't smaller.
+
+    :param content: recording bytes
+    :return: (filename, bytes, mimetype) to send for transcription
+    """
+    filename = audio_filename(filename, mimetype)
+    if not enabled or shutil.which("ffmpeg") is None:
+        return filename, content, mimetype
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-af", TRIM_SILENCE_FILTER,
+             "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-b:a", AUDIO_BITRATE, "-f", "mp3", "pipe:1"],
+            input=content, capture_output=True, timeout=AUDIO_PREPROCESS_TIMEOUT, check=True)
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"could not preprocess {filename}, sending it as uploaded: {e}")
+        metrics.increment("transcription_audio.passthrough")
+        return filename, content, mimetype
+    prepared = result.stdout
+    if not prepared or len(prepared) >= len(content):
+        return filename, content, mimetype
+    print(f"prepared {filename} for transcription: {len(content)} -> {len(prepared)} bytes")
+    metrics.increment("transcription_audio.bytes_in", len(content))
+    metrics.increment("transcription_audio.bytes_saved", len(content) - len(prepared))
+    return f"{os.path.splitext(filename)[0]}.mp3", prepared, "audio/mpeg"
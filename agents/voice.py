@@ -0,0 +1,179 @@
+import asyncio
+import base64
+import json
+import os
+import queue
+import threading
+import time
+
+import websockets
+
+import clients
+import metrics
+
+ELEVENLABS_API_KEY = os.getenv("ELEVEN_LABS_KEY")
+VOICE_ID = '21m00Tcm4TlvDq8ikWAM'
+# text chunks waiting for the tts websocket and audio chunks waiting for the client, a full queue
+# pauses the stage feeding it so a slow listener doesn't buffer a whole narration in memory
+VOICE_TEXT_QUEUE_SIZE = int(os.getenv("VOICE_TEXT_QUEUE_SIZE", default=32))
+VOICE_AUDIO_QUEUE_SIZE = int(os.getenv("VOICE_AUDIO_QUEUE_SIZE", default=16))
+# longest wait for the next audio chunk before the stream is abandoned
+VOICE_STAGE_TIMEOUT = float(os.getenv("VOICE_STAGE_TIMEOUT", default=30))
+# how often a receiver blocked on a full audio queue checks for room
+VOICE_BACKPRESSURE_POLL = 0.005
+
+_END = object()
+_loop = None
+_loop_lock = threading.Lock()
+
+
+async def text_chunker(chunks):
+    """Split text into chunks, ensuring to not break sentences."""
+    splitters = (".", ",", "?", "!", ";", ":", "—", "-", "(", ")", "[", "]", "}", " ")
+    buffer = ""
+
+    async for text in chunks:
+        if buffer.endswith(splitters):
+            yield buffer + " "
+            buffer = text
+        elif text.startswith(splitters):
+            yield buffer + text[0] + " "
+            buffer = text[1:]
+        else:
+            buffer += text
+
+    if buffer:
+        yield buffer + " "
+
+
+def event_loop():
+    """Event loop shared by every speech stream in this worker, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="voice-loop", daemon=True).start()
+        return _loop
+
+
+class SpeechStream:
+    """
+    Narrate a chat completion, yielding mp3 chunks while the completion is still being written.
+
+    The completion, the tts websocket sender and its receiver run as tasks on the shared event
+    loop, connected by bounded queues. The audio queue is a thread safe one so the request
+    thread can block on it; close, called by werkzeug when the client goes away, cancels the
+    pipeline.
+    """
+
+    def __init__(self, query, voice_id=VOICE_ID, model='gpt-4'):
+        self.query = query
+        self.voice_id = voice_id
+        self.model = model
+        self._start = time.perf_counter()
+        self._finished = False
+        self._audio = queue.Queue(maxsize=VOICE_AUDIO_QUEUE_SIZE)
+        self._seen = set()
+        self._future = asyncio.run_coroutine_threadsafe(self._run(), event_loop())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        try:
+            chunk = self._audio.get(timeout=VOICE_STAGE_TIMEOUT)
+        except queue.Empty:
+            self._stop("voice.timeouts")
+            raise TimeoutError(f"no audio within {VOICE_STAGE_TIMEOUT}s")
+        if chunk is _END:
+            self._finished = True
+            metrics.observe("voice.total", time.perf_counter() - self._start)
+            raise StopIteration
+        if isinstance(chunk, Exception):
+            self._finished = True
+            metrics.increment("voice.failed")
+            raise chunk
+        return chunk
+
+    def close(self):
+        self._stop("voice.cancelled")
+
+    def _stop(self, metric):
+        """Cancel the pipeline, counted under metric unless it had already finished."""
+        if not self._finished:
+            self._finished = True
+            metrics.increment(metric)
+            self._future.cancel()
+
+    def _observe_first(self, stage):
+        if stage not in self._seen:
+            self._seen.add(stage)
+            metrics.observe(f"voice.first_{stage}", time.perf_counter() - self._start)
+
+    async def _run(self):
+        try:
+            await self._pipeline()
+            await self._put_audio(_END)
+        except asyncio.CancelledError:
+            print("speech stream cancelled")
+        except Exception as e:
+            await self._put_audio(e)
+
+    async def _put_audio(self, item):
+        while True:
+            try:
+                self._audio.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(VOICE_BACKPRESSURE_POLL)
+
+    async def _pipeline(self):
+        text = asyncio.Queue(maxsize=VOICE_TEXT_QUEUE_SIZE)
+        uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{self.voice_id}/stream-input?model_id=eleven_monolingual_v1"
+        async with websockets.connect(uri) as websocket:
+            await websocket.send(json.dumps({
+                "text": " ",
+                "voice_settings": {"stability": 0.5, "similarity_boost": 0.8},
+                "xi_api_key": ELEVENLABS_API_KEY,
+            }))
+            tasks = [asyncio.create_task(self._complete(text)),
+                     asyncio.create_task(self._send(websocket, text)),
+                     asyncio.create_task(self._receive(websocket))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    async def _complete(self, text):
+        response = await clients.async_openai.chat.completions.create(
+            model=self.model, messages=[{'role': 'user', 'content': self.query}], temperature=1, stream=True)
+
+        async def tokens():
+            async for chunk in response:
+                content = chunk.choices[0].delta.content
+                if content:
+                    self._observe_first("token")
+                    yield content
+
+        async for chunk in text_chunker(tokens()):
+            await text.put(chunk)
+        await text.put(_END)
+
+    async def _send(self, websocket, text):
+        while (chunk := await text.get()) is not _END:
+            await websocket.send(json.dumps({"text": chunk, "try_trigger_generation": True}))
+        # an empty text tells the provider the input is complete
+        await websocket.send(json.dumps({"text": ""}))
+
+    async def _receive(self, websocket):
+        async for message in websocket:
+            data = json.loads(message)
+            if data.get("audio"):
+                self._observe_first("audio")
+                # waits here while the client is behind, which in turn stops reading the websocket
+                await self._put_audio(base64.b64decode(data["audio"]))
+            if data.get("isFinal"):
+                break
@@ -24,6 +24,8 @@ def create_api():
     app.config[
         'SQLALCHEMY_DATABASE_URI'] = f'postgresql://{db_params["user"]}:{db_params["password"]}@{db_params["host"]}:{db_params["port"]}/{db_params["dbname"]}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # bounds the pages a single request can hold in memory, larger uploads get a 413
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_SUBMISSION_BYTES", default=64 * 1024 * 1024))
     app.config['JWT_SECRET_KEY'] = os.getenv("JWT_SECRET_KEY")
     app.config['GOOGLE_CLIENT_ID'] = os.getenv('GOOGLE_CLIENT_ID')
     app.config['GOOGLE_CLIENT_SECRET'] = os.getenv('GOOGLE_CLIENT_SECRET')
@@ -37,6 +39,17 @@ def create_api():
     jwt = JWTManager(app)
 
     oauth = OAuth(app)
+    oauth.register(
+        name='google',
+        client_id=os.getenv('GOOGLE_CLIENT_ID'),
+        client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
+        access_token_url='https://accounts.google.com/o/oauth2/token',
+        access_token_params=None,
+        authorize_url='https://accounts.google.com/o/oauth2/auth',
+        authorize_params=None,
+        api_base_url='https://www.googleapis.com/oauth2/v1/',
+        client_kwargs={'scope': 'openid email profile'}
+    )
 
     # Import routes after db to avoid circular imports
     from api.v1.routes import init_api_v1
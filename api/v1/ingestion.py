@@ -0,0 +1,145 @@
+import io
+import os
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+import metrics
+from data.models import db, IngestionJob, IngestionJobItem, Recipe
+
+# background ingestion threads per process, 0 disables them (e.g. serverless deploys)
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", default=2))
+INGESTION_POLL_INTERVAL = float(os.getenv("INGESTION_POLL_INTERVAL", default=2))
+INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", default=3))
+# running items older than this are assumed to belong to a dead worker and are claimed again
+INGESTION_STALE_SECONDS = int(os.getenv("INGESTION_STALE_SECONDS", default=15 * 60))
+
+
+def enqueue_job(recipes):
+    """
+    Persist a job with one queued item per recipe.
+
+    :param recipes: list of recipes, each a list of uploaded page files
+    :return: IngestionJob
+    """
+    job = IngestionJob()
+    db.session.add(job)
+    for position, files in enumerate(recipes):
+        pages = []
+        for file in files:
+            file.stream.seek(0)
+            pages.append(file.read())
+        db.session.add(IngestionJobItem(job=job, position=position, status='queued',
+                                        filenames=[secure_filename(file.filename) for file in files], pages=pages))
+    db.session.commit()
+    print(f"queued ingestion job {job.id} with {len(recipes)} recipes")
+    return job
+
+
+def claim_next_item():
+    """Atomically mark the oldest claimable item running, SKIP LOCKED lets every worker poll the same table."""
+    params = {"stale": INGESTION_STALE_SECONDS, "max_attempts": INGESTION_MAX_ATTEMPTS}
+    # a worker that died during the last attempt would otherwise leave its item, and so its job, running forever
+    db.session.execute(text("""
+        UPDATE ingestion_job_item
+        SET status = 'failed', finished_at = NOW(), pages = NULL,
+            error = COALESCE(error || '; ', '') || 'worker stopped during the last attempt'
+        WHERE status = 'running' AND started_at < NOW() - make_interval(secs => :stale)
+        AND attempts >= :max_attempts;
+    """), params)
+    row = db.session.execute(text("""
+        UPDATE ingestion_job_item SET status = 'running', started_at = NOW(), attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM ingestion_job_item
+            WHERE (status = 'queued' OR (status = 'running' AND started_at < NOW() - make_interval(secs => :stale)))
+            AND attempts < :max_attempts
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id;
+    """), params).first()
+    db.session.commit()
+    return db.session.get(IngestionJobItem, row.id) if row else None
+
+
+def finish_item(item, status, recipe_id=None, error=None):
+    item.status = status
+    item.recipe_id = recipe_id
+    item.error = error
+    item.finished_at = datetime.utcnow()
+    item.pages = None
+    db.session.commit()
+
+
+def retry_or_fail(item, error):
+    """Queue an item whose attempt raised for another attempt, or fail it once it has used them all."""
+    if item.attempts >= INGESTION_MAX_ATTEMPTS:
+        finish_item(item, 'failed', error=str(error))
+    else:
+        item.status = 'queued'
+        item.error = str(error)
+        db.session.commit()
+
+
+@metrics.rss_high_water_growth("ingestion.rss_high_water_growth_bytes")
+def process_item(item):
+    # imported here because the routes module imports this one
+    from api.v1.routes import read_and_md5_recipe_request_images, ingest_recipe
+
+    files = [FileStorage(stream=io.BytesIO(page), filename=filename)
+             for page, filename in zip(item.pages, item.filenames)]
+    pages, md5 = read_and_md5_recipe_request_images(files)
+
+    existing = db.session.query(Recipe).filter(Recipe.submission_md5 == md5).first()
+    if existing:
+        finish_item(item, 'duplicate', recipe_id=existing.duplicate_of or existing.id)
+        return
+
+    try:
+        recipe, created = ingest_recipe(pages, md5)
+    except IntegrityError:
+        # the same pages were ingested by another worker while this one was extracting
+        db.session.rollback()
+        existing = db.session.query(Recipe).filter(Recipe.submission_md5 == md5).first()
+        finish_item(item, 'duplicate', recipe_id=existing.id if existing else None)
+        return
+    finish_item(item, 'completed' if created else 'duplicate', recipe_id=recipe.id)
+
+
+def worker_loop(app):
+    with app.app_context():
+        while True:
+            item = None
+            try:
+                item = claim_next_item()
+                if item is None:
+                    time.sleep(INGESTION_POLL_INTERVAL)
+                    continue
+                print(f"ingesting job {item.job_id} item {item.position}, attempt {item.attempts}")
+                process_item(item)
+            except Exception as e:
+                traceback.print_exc()
+                db.session.rollback()
+                if item is None:
+                    time.sleep(INGESTION_POLL_INTERVAL)
+                    continue
+                try:
+                    retry_or_fail(item, e)
+                except Exception:
+                    # left running, the item is claimed again once it goes stale
+                    traceback.print_exc()
+                    db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+def start_ingestion_workers(app, workers=INGESTION_WORKERS):
+    for i in range(workers):
+        threading.Thread(target=worker_loop, args=(app,), name=f"ingestion-{i}", daemon=True).start()
@@ -1,58 +1,57 @@
-import asyncio
-import base64
 import hashlib
 import io
-import json
 import os
-import tempfile
+import re
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
-import requests
-import websockets
 from botocore.exceptions import NoCredentialsError
-from elevenlabs import generate, stream, set_api_key
-from flask import Blueprint, request, jsonify, send_file, stream_with_context, Response, url_for, redirect
+from flask import Blueprint, request, jsonify, send_file, Response, url_for, redirect
 from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required
-from openai import AsyncOpenAI
 from psycopg2.extras import NumericRange
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 import time
-from authlib.integrations.flask_client import OAuth
 from flask import current_app
 
+import clients
 import extract
-from agents import baseAgent
+import metrics
+from agents import baseAgent, extraction, preprocess, voice
+from api.v1 import ingestion
 from sqlalchemy import text
 from werkzeug.utils import secure_filename
 
 from agents.baseAgent import Agent
-from data.models import db, Recipe, DescriptionEmbeddings, IngredientsEmbeddings, Message, User
+from agents.cache import narration_cache, pitch_cache
+from agents.limits import ProviderError, deadline
+from data import dedup, localIndex, search
+from data.models import db, Recipe, DescriptionEmbeddings, IngredientsEmbeddings, IngestionJob, Message, PageOcr, \
+    User, VECTOR_TYPE
 
 WEBRTC_SERVER_URL = os.getenv('WEBRTC_SERVER_URL')  # Replace with your WebRTC server endpoint
 
 bp = Blueprint('bp', __name__)
-ELEVENLABS_API_KEY = os.getenv("ELEVEN_LABS_KEY")
-set_api_key(os.getenv("ELEVEN_LABS_KEY"))
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-aclient = AsyncOpenAI(api_key=OPENAI_API_KEY)
-VOICE_ID = '21m00Tcm4TlvDq8ikWAM'
-
-
-# Initialize Google OAuth in the Blueprint
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", default=4))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", default=4))
+# bytes read from the tts provider per chunk forwarded to the client
+TTS_CHUNK_SIZE = int(os.getenv("TTS_CHUNK_SIZE", default=16 * 1024))
+# cached narrations never change, their url is a hash of everything that went into them
+NARRATION_MAX_AGE = 7 * 24 * 60 * 60
+SPEAK_VOICE_ID = 'ErXwobaYiN019PkySvjV'  # Antoni
+# seconds of provider calls each latency critical route may spend before answering
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", default=20))
+AUDIO_OPTIONS_DEADLINE = float(os.getenv("AUDIO_OPTIONS_DEADLINE", default=30))
+ocr_executor = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="s3-upload")
+
+
+# Google OAuth client registered on the app
 def get_google_oauth_client():
-    return OAuth(current_app).register(
-        name='google',
-        client_id=os.getenv('GOOGLE_CLIENT_ID'),
-        client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-        access_token_url='https://accounts.google.com/o/oauth2/token',
-        access_token_params=None,
-        authorize_url='https://accounts.google.com/o/oauth2/auth',
-        authorize_params=None,
-        api_base_url='https://www.googleapis.com/oauth2/v1/',
-        client_kwargs={'scope': 'openid email profile'}
-    )
+    # registered once per app in create_api
+    return current_app.extensions['authlib.integrations.flask_client'].create_client('google')
 
 
 def is_only_whitespace(s):
@@ -67,41 +66,105 @@ def audio_get_recipe_options():
     if file.filename == '':
         return "No selected file", 400
     if file:
+        start = time.perf_counter()
         try:
             print(f"attempting to process audio")
             # todo save input and output to s3
-            with tempfile.NamedTemporaryFile(suffix='.m4a', delete=False) as tmp:
-                file.save(tmp.name)
-                tmp_path = tmp.name
-                # OpenAI API call with the converted .mp3 file
-                with open(tmp_path, 'rb') as tmp_file:
-                    agent = baseAgent.Agent()
-                    recipe_request = agent.get_transcript(tmp_file)
-                    print(f"Recipe request: {recipe_request}")
-                    closest_embeddings = get_nearest_recipes(recipe_request)
-                    numbered_recipes = "\n".join(
-                        [f"{i + 1}. Title: {item['title']}, Description: {item['description']}" for i, item in
-                         enumerate(closest_embeddings)])
-
-                    # generate a response based on user
-                    response = agent.generate_response(
-                        f"You are a culinary assistant and your job is to pitch recipes for the user to make for their next meal.Your response will be read directly by a narrator so make it cohesive and don't label the options with numbers. if any recipe looks incomplete or has `sorry` in it you must not give that option. Address the user's recipe request by describing and pitching the following recipes: {numbered_recipes}",
-                        recipe_request)
-                    print(f"recommendations: {response}")
-                    audio_bytes = agent.text_to_speech(response)
-                    CHUNK_SIZE = 1024
-                    chunks = b''
-                    for chunk in audio_bytes.iter_content(chunk_size=CHUNK_SIZE):
-                        if chunk:
-                            chunks += chunk
-                    out_bytes = io.BytesIO(chunks)
-                    return send_file(out_bytes, mimetype='audio/wav', as_attachment=True, download_name='narration'
-                                                                                                        '.mp3')
+            # the upload is transcribed from werkzeug's in memory or spooled stream, never a file of our own
+            filename, content, mimetype = preprocess.prepare_for_transcription(
+                file.read(), secure_filename(file.filename), file.mimetype)
+            with deadline(AUDIO_OPTIONS_DEADLINE):
+                agent = baseAgent.Agent()
+                recipe_request = agent.get_transcript(content, filename=filename, mimetype=mimetype)
+                print(f"Recipe request: {recipe_request}")
+                # a pitch from the pitch cache repeats word for word, so its narration is a cache hit too
+                response = pitch_recipes(recipe_request)
+                print(f"recommendations: {response}")
+                key, file, chunks = agent.narrate(response, chunk_size=TTS_CHUNK_SIZE)
+                return narration_response(key, file, chunks, start, "audio_recipe_options.ttfb",
+                                          buffered=request.args.get('stream', default='true').lower() == 'false')
+        except ProviderError as e:
+            return str(e), 503
         except Exception as e:
             return str(e), 500
     return str("no file"), 400
 
 
+def stream_audio(chunks, start, metric):
+    """Forward tts audio as it arrives, without a content length the response goes out chunked."""
+    first = True
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if first:
+                metrics.observe(metric, time.perf_counter() - start)
+                first = False
+            yield chunk
+    finally:
+        chunks.close()
+
+
+def send_narration(file, key, **kwargs):
+    """Send an open cached narration, answering range and conditional GETs, the key doubles as its etag."""
+    size = os.fstat(file.fileno()).st_size
+    response = send_file(file, mimetype='audio/mpeg', etag=key, **kwargs)
+    response.content_length = size
+    # send_file only knows the length of files it opens itself, which ranges need
+    return response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+
+
+def narration_response(key, file, chunks, start, metric, buffered=False):
+    """
+    Send a narration from Agent.narrate, from the cache file on a hit or streamed from the provider on a miss.
+
+    Content-Location points at the cached copy, which GET supports range requests on.
+    """
+    headers = {'Content-Location': url_for('bp.get_narration', key=key)}
+    if file is None and not buffered:
+        response = Response(stream_audio(chunks, start, metric), mimetype='audio/mpeg', headers={
+            **headers,
+            'Content-Disposition': 'attachment; filename=narration.mp3',
+            'X-Accel-Buffering': 'no',
+        })
+        # stream_audio's finally never runs if the response is closed before it starts
+        response.call_on_close(chunks.close)
+        return response
+    if file is None:
+        try:
+            response = send_file(io.BytesIO(b''.join(chunks)), mimetype='audio/mpeg', as_attachment=True,
+                                 download_name='narration.mp3')
+        finally:
+            chunks.close()
+    else:
+        response = send_narration(file, key, as_attachment=True, download_name='narration.mp3')
+    metrics.observe(metric, time.perf_counter() - start)
+    response.headers.update(headers)
+    return response
+
+
+@bp.route('/narrations/<key>', methods=['GET'])
+def get_narration(key):
+    if not re.fullmatch(r"[0-9a-f]{64}", key):
+        return jsonify({'message': 'Narration not found'}), 404
+    file = narration_cache.get(key)
+    if file is None:
+        return jsonify({'message': 'Narration not found'}), 404
+    return send_narration(file, key, max_age=NARRATION_MAX_AGE)
+
+
+@bp.errorhandler(ProviderError)
+def provider_unavailable(e):
+    # the provider stayed rate limited or down through every retry, the client should back off too
+    return jsonify({'message': str(e)}), 503
+
+
+@bp.route('/metrics', methods=['GET'])
+@jwt_required()
+def get_metrics():
+    return jsonify(metrics.snapshot())
+
+
 @bp.route("/eleven-labs", methods=['GET'])
 def eleven_labs():
     return os.getenv("ELEVEN_LABS_KEY")
@@ -127,7 +190,7 @@ def apple_authorize():
         'grant_type': 'authorization_code',
         'redirect_uri': url_for('apple_authorize', _external=True)
     }
-    response = requests.post('https://appleid.apple.com/auth/token', headers=headers, data=data)
+    response = clients.session('apple').post('https://appleid.apple.com/auth/token', headers=headers, data=data)
     response_data = response.json()
 
     # Decode ID token to get user info
@@ -242,15 +305,7 @@ def persistedChat(conversation_id):
     classifier_result = classify(most_recent_msg)
     if classifier_result == 'get_recipe':
         print(f"Chat request: {msg}")
-        closest_embeddings = get_nearest_recipes(msg)
-        numbered_recipes = "\n".join(
-            [f"{i + 1}. Title: {item['title']}, Description: {item['description']}" for i, item in
-             enumerate(closest_embeddings)])
-        # generate a response based on user
-        agent = baseAgent.Agent()
-        response = agent.generate_response(
-            f"You are a culinary assistant and your job is to pitch recipes for the user to make for their next meal.Your response will be read directly by a narrator so make it cohesive and don't label the options with numbers. if any recipe looks incomplete or has `sorry` in it you must not give that option. Address the user's recipe request by describing and pitching the following recipes: {numbered_recipes}",
-            msg)
+        response = pitch_recipes(msg)
         # todo persist this message
         print(f"recommendations: {response}")
         return jsonify({"content": response})
@@ -269,20 +324,31 @@ def chat():
     # todo run classifier for recommendation, response, technique and
     # persist messages and use history in request
     print(f"Chat request: {msg}")
-    closest_embeddings = get_nearest_recipes(msg)
+    with deadline(CHAT_DEADLINE):
+        response = pitch_recipes(msg)
+    print(f"recommendations: {response}")
+    return jsonify({"content": response})
+
+
+def pitch_recipes(msg):
+    """
+    Pitch the recipes nearest a chat or spoken request, reusing the pitch written for an earlier request
+    when it retrieved the same recipes and was worded alike.
+    """
+    agent = baseAgent.Agent()
+    embeddings = agent.get_embedding(msg)
+    closest_embeddings = get_nearest_recipes(msg, embeddings=embeddings)
     numbered_recipes = "\n".join(
         [f"{i + 1}. Title: {item['title']}, Description: {item['description']}" for i, item in
          enumerate(closest_embeddings)])
     # generate a response based on user
-    agent = baseAgent.Agent()
-    response = agent.generate_response(
+    return pitch_cache.get_or_create(closest_embeddings, embeddings, lambda: agent.generate_response(
         f"You are a culinary assistant and your job is to pitch recipes for the user to make for their next meal.Your response will be read directly by a narrator so make it cohesive and don't label the options with numbers. if any recipe looks incomplete or has `sorry` in it you must not give that option. Address the user's recipe request by describing and pitching the following recipes: {numbered_recipes}",
-        msg)
-    print(f"recommendations: {response}")
-    return jsonify({"content": response})
+        msg, cached=False))
 
 
 @bp.route('/', methods=['POST'])
+@metrics.rss_high_water_growth("submit_recipe.rss_high_water_growth_bytes")
 def submit_recipe():
     print(f"insert req received for recipe file")
     if 'recipe' not in request.files:
@@ -290,25 +356,50 @@ def submit_recipe():
 
     files = request.files.getlist('recipe')
 
-    ocr_text_from_request = request.form.get('ocr_text', '')
-
     if not files or any(file.filename == '' for file in files):
         return 'No selected file', 400
-    ocr_text, md5 = ocr_and_md5_recipe_request_images(files)
-    if not is_only_whitespace(ocr_text_from_request):
-        # print(f"------ocr_text from req: {ocr_text_from_request}")
-        # print(ocr_text_from_request)
-        # ocr_text = ocr_text_from_request
-        pass
+    pages, md5 = read_and_md5_recipe_request_images(files)
     print(f"md5: {md5}")
-    # don't double process same image
+    # don't double process same image, checked before paying for ocr
     result = db.session.query(Recipe).filter(Recipe.submission_md5 == md5).first()
     if result:
-        return jsonify(result.to_dict())
+        return jsonify(dedup.canonical_recipe(result).to_dict())
 
     print("passed md5 check")
+    try:
+        recipe, created = ingest_recipe(pages, md5)
+    except OcrError as e:
+        return jsonify({'message': 'Failed to transcribe pages', 'pages': e.failures}), 502
+    return recipe.to_dict()
+
+
+def ingest_recipe(pages, md5):
+    """
+    Transcribe, extract and save a submission that passed the md5 check, unless it is a near duplicate.
 
-    recipe, description_embeddings, ingredients_embeddings = generate_recipe_from_image(ocr_text, md5)
+    Near duplicates by ocr text are caught before extraction, near duplicates by description
+    embedding after it. Either way the submission is linked to the existing recipe instead of
+    adding another row to the vector tables.
+
+    :return: (recipe, created) where recipe is the existing recipe when created is False
+    """
+    ocr_text = ocr_recipe_pages(pages)
+    release_page_contents(pages)
+    signature = dedup.minhash_signature(ocr_text)
+    duplicate = dedup.find_text_duplicate(signature)
+    if duplicate is None:
+        recipe, description_embeddings, ingredients_embeddings = generate_recipe_from_image(ocr_text, md5)
+        recipe.page_md5s = [md5_hash for filename, file_content, md5_hash in pages]
+        duplicate = dedup.find_embedding_duplicate(description_embeddings)
+        if duplicate is None:
+            save_recipe(recipe, description_embeddings, ingredients_embeddings)
+            dedup.save_signature(recipe.id, signature)
+            return recipe, True
+    dedup.link_duplicate(duplicate, md5)
+    return duplicate, False
+
+
+def save_recipe(recipe, description_embeddings, ingredients_embeddings):
     db.session.add(recipe)
     db.session.commit()
     print("successfully added recipe")
@@ -321,7 +412,39 @@ def submit_recipe():
     print("added ingredients embeddings")
     db.session.commit()
     print("successfully added recipe with embeddings")
-    return recipe.to_dict()
+    localIndex.sync_local_index(recipe_ids=[recipe_id])
+    return recipe
+
+
+@bp.route('/jobs', methods=['POST'])
+@metrics.rss_high_water_growth("submit_recipe_job.rss_high_water_growth_bytes")
+def submit_recipe_job():
+    """
+    Queue one or many recipes for background ingestion.
+
+    Every file field whose name starts with `recipe` is one recipe and its files are that recipe's
+    pages, e.g. `recipe` alone for a single recipe or `recipe0`, `recipe1`, ... for a cookbook.
+    """
+    print("job req received for recipe files")
+    fields = sorted((key for key in request.files.keys() if key.startswith('recipe')),
+                    key=lambda key: (len(key), key))
+    if not fields:
+        return 'No file part', 400
+
+    recipes = [request.files.getlist(key) for key in fields]
+    if any(not files or any(file.filename == '' for file in files) for files in recipes):
+        return 'No selected file', 400
+
+    job = ingestion.enqueue_job(recipes)
+    return jsonify({"job_id": job.id, "status_url": url_for('bp.get_recipe_job', job_id=job.id)}), 202
+
+
+@bp.route('/jobs/<int:job_id>', methods=['GET'])
+def get_recipe_job(job_id):
+    job = db.session.get(IngestionJob, job_id)
+    if not job:
+        return jsonify({'message': 'Job not found'}), 404
+    return jsonify(job.to_dict())
 
 
 def upload_to_s3(local_file, md5):
@@ -332,9 +455,7 @@ def upload_to_s3(local_file, md5):
     :param md5: md5 for filename
     :return: True if file was uploaded, else False
     """
-    # Create an S3 client
-    s3 = boto3.client('s3', aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-                      aws_secret_access_key=os.getenv("AWS_SECRET_KEY_ID"), region_name="us-west-2")
+    s3 = clients.s3()
 
     try:
         s3.upload_fileobj(local_file, os.getenv("IMAGE_BUCKET_NAME"), f"{md5}.png")
@@ -348,98 +469,144 @@ def upload_to_s3(local_file, md5):
         return False
 
 
-def ocr_and_md5_recipe_request_images(files):
-    all_ocr_text = ''
-    md5s = []
+class OcrError(Exception):
+    def __init__(self, failures):
+        # list of {"page", "filename", "error"} for every page that could not be transcribed
+        self.failures = failures
+        super().__init__(", ".join(f"page {failure['page']} ({failure['filename']}): {failure['error']}"
+                                   for failure in failures))
+
+
+# how vision replies open when they decline or fail to transcribe instead of returning the page's text
+OCR_REFUSAL = re.compile(r"^\W*(<none>\W*$|none\W*$|(i'?m sorry|i am sorry|sorry|unfortunately|i can'?t|i cannot|"
+                         r"i'?m unable|i am unable|i'?m not able)\b)", re.IGNORECASE)
+
+
+def is_refusal(ocr_text):
+    """Whether a transcription is empty or the model declining, which must not be cached for the page."""
+    return not ocr_text.strip() or bool(OCR_REFUSAL.match(ocr_text.replace("\u2019", "'")))
+
+
+def ocr_page(file_content):
+    # only the copy sent for ocr is shrunk, s3 keeps the page as uploaded
+    content, mime_type = preprocess.prepare_for_ocr(file_content)
+    agent = Agent()
+    return agent.generate_vision_response(content,
+                                          "Extract all the text in this image of a recipe. Skip the pleasantries and just return only the transcribed text.",
+                                          mime_type=mime_type)
+
+
+def log_upload_result(md5_hash):
+    def callback(future):
+        if future.exception() is not None:
+            print(f"error uploading {md5_hash}.png: {future.exception()}")
+    return callback
+
+
+def read_and_md5_recipe_request_images(files):
+    """
+    Read and hash every uploaded page without any provider calls so duplicates can be rejected first.
+
+    :return: (list of (filename, content, md5) per page, md5 of the whole submission)
+    """
+    pages = []
     for file in files:
         filename = secure_filename(file.filename)
         file.stream.seek(0)
         file_content = file.read()
-        md5_hash = extract.calculate_md5(io.BytesIO(file_content))
+        md5_hash = extract.calculate_md5(file_content)
         print(f"req received for recipe file {filename}: {md5_hash}")
-        # Reset the stream position after MD5 calculation
-        file_in_memory = io.BytesIO(file_content)
-        file.stream.seek(0)
-        uploaded = upload_to_s3(file_in_memory, md5_hash)
-
-        file_in_memory_1 = io.BytesIO(file_content)
-        file.stream.seek(0)  # Reset stream pointer
-        agent = Agent()
-        ocr_text = agent.generate_vision_response(file_in_memory_1,
-                                                  "Extract all the text in this image of a recipe. Skip the pleasantries and just return only the transcribed text.")
-        all_ocr_text += ocr_text + "\n"  # Concatenate text from each file
-        md5s.append(md5_hash)
-    concatenated_md5s = ''.join(md5s)
-    print(f"finished ocr'ing: {all_ocr_text}")
+        pages.append((filename, file_content, md5_hash))
 
     # Compute MD5 of the concatenated string of individual hashes
+    concatenated_md5s = ''.join(md5_hash for filename, file_content, md5_hash in pages)
     combined_md5 = hashlib.md5(concatenated_md5s.encode()).hexdigest()
-    return all_ocr_text, combined_md5
+    return pages, combined_md5
+
+
+def ocr_recipe_pages(pages):
+    """
+    Transcribe pages in order, reusing the stored text of any page that has been transcribed before.
+
+    :param pages: list of (filename, content, md5) from read_and_md5_recipe_request_images
+    :return: concatenated ocr text
+    """
+    page_md5s = {md5_hash for filename, file_content, md5_hash in pages}
+    cached = {page.md5: page.ocr_text for page in PageOcr.query.filter(PageOcr.md5.in_(page_md5s)).all()}
+    metrics.increment("page_ocr_cache.hits", sum(1 for page in pages if page[2] in cached))
+    misses = {}
+    for filename, file_content, md5_hash in pages:
+        if md5_hash not in cached and md5_hash not in misses:
+            misses[md5_hash] = (filename, file_content)
+    metrics.increment("page_ocr_cache.misses", len(misses))
+
+    # uploads are only archival, they overlap with ocr and nothing waits on them. cached pages were uploaded
+    # when they were first transcribed. BytesIO over bytes shares the buffer rather than copying it
+    for md5_hash, (filename, file_content) in misses.items():
+        upload_executor.submit(upload_to_s3, io.BytesIO(file_content), md5_hash).add_done_callback(
+            log_upload_result(md5_hash))
+
+    ocr_futures = {ocr_executor.submit(ocr_page, file_content): md5_hash
+                   for md5_hash, (filename, file_content) in misses.items()}
+    ocr_texts = dict(cached)
+    errors = {}
+    for future in as_completed(ocr_futures):
+        md5_hash = ocr_futures[future]
+        try:
+            ocr_texts[md5_hash] = future.result()
+        except Exception as e:
+            errors[md5_hash] = str(e)
+            continue
+        # stored as each page finishes, so a retry after another page failed only pays for that page
+        if is_refusal(ocr_texts[md5_hash]):
+            print(f"not caching refused ocr of page {md5_hash}: {ocr_texts[md5_hash][:100]}")
+            metrics.increment("page_ocr_cache.refusals")
+            continue
+        db.session.execute(insert(PageOcr).values(
+            md5=md5_hash, ocr_text=ocr_texts[md5_hash], created_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['md5']))
+        db.session.commit()
+    if errors:
+        raise OcrError([{"page": page, "filename": filename, "error": errors[md5_hash]}
+                        for page, (filename, file_content, md5_hash) in enumerate(pages) if md5_hash in errors])
+
+    # Concatenate text from each file in page order
+    all_ocr_text = "".join(ocr_texts[md5_hash] + "\n" for filename, file_content, md5_hash in pages)
+    print(f"finished ocr'ing: {all_ocr_text}")
+    return all_ocr_text
+
+
+def release_page_contents(pages):
+    """Drop the page bytes once transcribed so a long extraction doesn't keep every upload alive."""
+    pages[:] = [(filename, None, md5_hash) for filename, file_content, md5_hash in pages]
+
+
+def ocr_and_md5_recipe_request_images(files):
+    pages, combined_md5 = read_and_md5_recipe_request_images(files)
+    return ocr_recipe_pages(pages), combined_md5
 
 
 def generate_recipe_from_image(ocr_text, md5):
-    agent = baseAgent.Agent()
-    ingredients = agent.generate_response(
-        f"You are an food recipe ingredients extraction agent. Your goal is to extract the ingredients from the "
-        f"recipe provided by the user. You must use the exact wordage of the ingredient and measurement in the "
-        f"recipe, but return a bulleted list of all ingredients needed. If the provided text is unintelligible return <none>.",
-        ocr_text)
-    steps = agent.generate_response(
-        f"You are an food recipe steps extraction agent. Your goal is to extract the steps from the recipe provided "
-        f"by the user. You must use the exact wordage of the steps in the recipe, but return a bulletted list of all "
-        f"steps. If the provided text is unintelligible return <none>.",
-        ocr_text)
-    equipment = agent.generate_response(
-        f"You are an food recipe equipment extraction agent. Your goal is to extract the equipment from the recipe "
-        f"provided by the user. You must use the exact wordage of the equipment in the recipe, but return a bulletted "
-        f"list of all equipment. If the provided text is unintelligible return <none>.",
-        ocr_text)
-    servings = parse_numeric_range_or_null(agent.generate_response(
-        f"""You are an food recipe servings extraction agent. Your goal is to extract the servings from the recipe provided by the user. You must use the exact wordage of the servings in the recipe, if amount fo servings not specified than make an educated guess. You must only return a number range e.g. `2-4`
-            Example:
-            [user]: How many servings is this dish given the following information: This recipe serves a family of 2-4, but can be stretched to feed more by scaling.
-            [assistant]: 2-4
-            """,
-        "How many servings is this dish given the following information: " +
-        ocr_text))
-    time = parse_int_or_null(agent.generate_response(
-        f"""You are a recipe time extraction and estimation agent. Your goal is to return the total number of minutes it will take to complete the recipe. You must use the exact minutes estimate if provided, but if none is provided do your best to accurately estimate the time it will take. You must only return the number of minutes e.g. `35`
-            Example:
-            [user]: How much minutes will it take to make this dish given the following information: This recipe takes 15 minutes of prep time and 20 minutes of cooking time.
-            [assistant]: 35
-            [user]: How much minutes will it take to make this dish given the following information: The estimated total time for this Zesty Lemon Garlic Shrimp Pasta recipe is 45 minutes.
-            [assistant]: 45
-            """,
-        "How many minutes will it take to make this dish given the following information: " +
-        ocr_text))
-    description = agent.generate_response(
-        f"You are a recipe description agent. Your goal is to return a very descriptive 15-30 word description of the "
-        f"dish in the recipe. You must describe the type of food it is, taste, cuisine (e.g. italian), seasonality, "
-        f"ingredients, and ease. If the provided text is unintelligible return <none>.",
-        ocr_text)
-    title = agent.generate_response(
-        f"You are a recipe titling agent. Your goal is to return a succinct yet descriptive title for a dish. The title must be accurate. If the provided text is unintelligible return <none>.",
-        ocr_text)
-    author = agent.generate_response("Extract the author or writer of the recipe. If there is none return <none>",
-                                     ocr_text)
-
-    description_embeddings = agent.get_embedding(description)
-    ingredients_embeddings = agent.get_embedding(ingredients)
+    fields, embeddings = extraction.extract_recipe(ocr_text)
+    description = fields["description"]
     print("all agents run")
     print(f"description: {description}")
     if description == "<none>":
         raise Exception
     # todo if refusal fail loudly
-    return Recipe(ingredients=ingredients,
-                  steps=steps,
-                  equipment=equipment,
-                  time=time,
-                  description=description,
-                  servings=servings,
-                  title=title,
-                  author=author,
-                  submission_md5=md5
-                  ), description_embeddings, ingredients_embeddings
+    recipe = Recipe(submission_md5=md5)
+    set_recipe_fields(recipe, fields)
+    return recipe, embeddings["description"], embeddings["ingredients"]
+
+
+def set_recipe_fields(recipe, fields):
+    """Copy raw extracted text onto a recipe, parsing the fields stored as numbers."""
+    for field, value in fields.items():
+        if field == "time":
+            value = parse_int_or_null(value)
+        elif field == "servings":
+            value = parse_numeric_range_or_null(value)
+        setattr(recipe, field, value)
 
 
 def parse_int_or_null(input_string):
@@ -501,20 +668,22 @@ def delete_recipe(recipe_id):
         print(f"deleting recipe: {recipe_id}")
         recipe = db.session.query(Recipe).filter_by(id=recipe_id).first()
         if recipe:
-            sql_query = text("""
-                DELETE FROM description_embeddings WHERE recipe_id = :recipe_id;
-            """)
-
-            query_params = {"recipe_id": recipe_id}
-
-            result = db.session.execute(sql_query, query_params)
-            sql_query = text("""
-                            DELETE FROM ingredients_embeddings WHERE recipe_id = :recipe_id;
-                        """)
-            result = db.session.execute(sql_query, query_params)
+            # submissions linked as near duplicates would otherwise resolve to nothing, and ones linked by
+            # cluster --apply still have their own signature rows, so their children go first
+            duplicate_ids = [row.id for row in db.session.execute(
+                text("SELECT id FROM recipe WHERE duplicate_of = :recipe_id;"), {"recipe_id": recipe_id})]
+            query_params = {"recipe_id": recipe_id, "recipe_ids": [recipe_id] + duplicate_ids}
+            # ingestion_job_item rows keep their history, their recipe_id is set null by the foreign key
+            for sql_query in (text("DELETE FROM description_embeddings WHERE recipe_id = ANY(:recipe_ids);"),
+                              text("DELETE FROM ingredients_embeddings WHERE recipe_id = ANY(:recipe_ids);"),
+                              text("DELETE FROM recipe_signature WHERE recipe_id = ANY(:recipe_ids);"),
+                              text("DELETE FROM recipe_lsh_band WHERE recipe_id = ANY(:recipe_ids);"),
+                              text("DELETE FROM recipe WHERE duplicate_of = :recipe_id;")):
+                db.session.execute(sql_query, query_params)
             db.session.commit()
             db.session.delete(recipe)
             db.session.commit()
+            localIndex.sync_local_index(recipe_ids=[recipe_id] + duplicate_ids)
             return jsonify({'message': 'Parent and its children deleted successfully'}), 200
         else:
             print(f"error not found when deleting recipe: {recipe_id}")
@@ -526,6 +695,7 @@ def delete_recipe(recipe_id):
 
 
 @bp.route('/recipes/<int:recipe_id>', methods=['PUT'])
+@metrics.rss_high_water_growth("modify_recipe.rss_high_water_growth_bytes")
 def modify_recipe(recipe_id):
     print(f"update req received for recipe file(s)")
     if 'recipe' not in request.files:
@@ -535,39 +705,65 @@ def modify_recipe(recipe_id):
 
     if not files or any(file.filename == '' for file in files):
         return 'No selected file', 400
-    ocr_text, md5 = ocr_and_md5_recipe_request_images(files)
-    recipe, description_embeddings, ingredients_embeddings = generate_recipe_from_image(ocr_text, md5)
-    recipe.recipe_id = recipe_id
+    recipe = db.session.get(Recipe, recipe_id)
+    if not recipe:
+        return jsonify({'message': 'Recipe not found'}), 404
+
+    pages, md5 = read_and_md5_recipe_request_images(files)
+    new_md5s = [md5_hash for filename, file_content, md5_hash in pages]
+    if recipe.page_md5s is not None and recipe.page_md5s == new_md5s:
+        print(f"pages unchanged for recipe {recipe_id}")
+        return jsonify(recipe.to_dict())
+    try:
+        ocr_text = ocr_recipe_pages(pages)
+    except OcrError as e:
+        return jsonify({'message': 'Failed to transcribe pages', 'pages': e.failures}), 502
+    release_page_contents(pages)
+
+    if recipe.page_md5s is None:
+        # stored before page md5s were recorded, nothing to diff against
+        fields = list(extraction.FIELD_PROMPTS.keys())
+    else:
+        changed = set(recipe.page_md5s) ^ set(new_md5s)
+        page_texts = {page.md5: page.ocr_text for page in PageOcr.query.filter(PageOcr.md5.in_(changed)).all()}
+        fields = extraction.fields_affected_by_pages(recipe.page_md5s, new_md5s, page_texts)
+    print(f"re-extracting {fields} for recipe {recipe_id}")
+
+    results, embeddings = extraction.extract_fields(ocr_text, fields=fields,
+                                                    previous={"description": recipe.description,
+                                                              "ingredients": recipe.ingredients})
+    if results.get("description") == "<none>":
+        return jsonify({'message': 'Could not extract a recipe from the pages'}), 422
     try:
-        description_embeddings_record = DescriptionEmbeddings.query.filter_by(recipe_id=recipe_id).first()
-        description_embeddings_record.embeddings = description_embeddings
-        ingredients_embeddings_record = IngredientsEmbeddings.query.filter_by(recipe_id=recipe_id).first()
-        ingredients_embeddings_record.embeddings = ingredients_embeddings
-        db.session.add(description_embeddings_record)
-        db.session.add(ingredients_embeddings_record)
+        # fields, embeddings and signature are written in one transaction
+        set_recipe_fields(recipe, results)
+        recipe.submission_md5 = md5
+        recipe.page_md5s = new_md5s
+        for field, embedding in embeddings.items():
+            model = {"description": DescriptionEmbeddings, "ingredients": IngredientsEmbeddings}[field]
+            # replaced rather than updated, a new row id is how other replicas' local indexes see the change
+            model.query.filter_by(recipe_id=recipe_id).delete()
+            db.session.add(model(recipe_id=recipe_id, embeddings=embedding))
+        dedup.save_signature(recipe_id, dedup.minhash_signature(ocr_text), commit=False)
         db.session.commit()
-        return jsonify(recipe)
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'message': 'These pages were already submitted as another recipe'}), 409
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': str(e)}), 500
+    localIndex.sync_local_index(recipe_ids=[recipe_id])
+    return jsonify(recipe.to_dict())
 
 
-def get_nearest_recipes(query):
-    agent = baseAgent.Agent()
-    embeddings = agent.get_embedding(query)
-    sql_query = text("""
-            SELECT recipe.* FROM recipe
-            JOIN description_embeddings ON recipe.id = description_embeddings.recipe_id
-            ORDER BY description_embeddings.embeddings <-> CAST(:embeddings AS vector)
-            LIMIT 5;
-        """)
-
-    query_params = {"embeddings": embeddings}
-
-    result = db.session.execute(sql_query, query_params)
-
-    # Retrieve the rows from the result
-    rows = result.fetchall()
+def get_nearest_recipes(query, mode=None, candidate_multiplier=None, backend=None, hybrid=None, field="description",
+                        ingredients_weight=None, embeddings=None):
+    """:param embeddings: of the query, when the caller already has them"""
+    if embeddings is None:
+        embeddings = baseAgent.Agent().get_embedding(query)
+    rows = search.nearest_recipes(embeddings, mode=mode, candidate_multiplier=candidate_multiplier,
+                                  backend=backend, query=query, hybrid=hybrid, field=field,
+                                  ingredients_weight=ingredients_weight)
 
     return [
         {"id": row.id, "author": row.author, "title": row.title, "description": row.description} for row in
@@ -582,8 +778,45 @@ def search_for_recipe():
     if not query_string:
         return jsonify({"error": "No query string provided"}), 400
 
+    mode = request.args.get('mode', None)
+    if mode is not None and mode not in search.SEARCH_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(search.SEARCH_MODES)}"}), 400
+
+    field = request.args.get('field', 'description')
+    if field not in search.SEARCH_FIELDS:
+        return jsonify({"error": f"field must be one of {', '.join(search.SEARCH_FIELDS)}"}), 400
+    if field != 'description' and (mode or search.SEARCH_MODE) != 'exact':
+        return jsonify({"error": "only exact mode can search fields other than description"}), 400
+
+    backend = request.args.get('backend', None)
+    if backend is not None and backend not in search.SEARCH_BACKENDS:
+        return jsonify({"error": f"backend must be one of {', '.join(search.SEARCH_BACKENDS)}"}), 400
+
+    numbers = {}
+    for name, type_, minimum, maximum in (("candidates", int, 1, search.MAX_CANDIDATE_MULTIPLIER),
+                                          ("lexical_weight", float, 0, search.MAX_HYBRID_WEIGHT),
+                                          ("vector_weight", float, 0, search.MAX_HYBRID_WEIGHT),
+                                          ("lexical_limit", int, 1, search.MAX_HYBRID_LIMIT),
+                                          ("vector_limit", int, 1, search.MAX_HYBRID_LIMIT),
+                                          ("ingredients_weight", float, 0, 1)):
+        # type= would quietly drop a value that doesn't parse, it's rejected like one out of range
+        value = request.args.get(name, None)
+        try:
+            numbers[name] = None if value is None else type_(value)
+        except ValueError:
+            numbers[name] = float("nan")
+        # nan fails both comparisons
+        if numbers[name] is not None and not minimum <= numbers[name] <= maximum:
+            return jsonify({"error": f"{name} must be between {minimum} and {maximum}"}), 400
+
+    hybrid = {name: numbers[name] for name in ("lexical_weight", "vector_weight", "lexical_limit", "vector_limit")}
+
     # Serialize the results
-    closest_embeddings = get_nearest_recipes(query_string)
+    closest_embeddings = get_nearest_recipes(query_string, mode=mode,
+                                             candidate_multiplier=numbers["candidates"],
+                                             backend=backend, hybrid=hybrid,
+                                             field=field,
+                                             ingredients_weight=numbers["ingredients_weight"])
     return jsonify({"dishes": closest_embeddings})
 
 
@@ -619,11 +852,11 @@ def search_pantry():
         return jsonify({"error": "No query string provided"}), 400
 
     embeddings = agent.get_embedding(query_string)
-    sql_query = text("""
+    sql_query = text(f"""
         SELECT * FROM pantry_items
         WHERE id IN (
         SELECT pantry_item_id FROM pantry_item_embeddings
-        ORDER BY embeddings <-> CAST(:embeddings AS vector)
+        ORDER BY embeddings <-> CAST(:embeddings AS {VECTOR_TYPE})
         LIMIT 5) AND deleted = FALSE AND NOW() < expiration 
     """)
 
@@ -643,111 +876,38 @@ def search_pantry():
     return jsonify(closest_embeddings)
 
 
-def generate_example_text(text):
-    yield "Hello world"
-    yield "this is a test"
-    yield text
-
-
 @bp.route("/speak", methods=["POST"])
 def speak():
-    audio = generate(
-        text=generate_example_text(request.args.get('text', 'goodbye world')),
-        voice="Antoni",
-        model="eleven_multilingual_v2",
-        stream=True
-    )
-    stream(audio)
+    start = time.perf_counter()
+    agent = baseAgent.Agent()
+    key, file, chunks = agent.narrate(request.args.get('text', 'goodbye world'), voice_id=SPEAK_VOICE_ID,
+                                      chunk_size=TTS_CHUNK_SIZE)
+    return narration_response(key, file, chunks, start, "speak.ttfb")
 
 
-# Async route for text-to-speech conversion
 @bp.route('/tts', methods=['POST'])
-async def tts():
+def tts():
     print("TTS req")
     data = request.json
     user_query = data['query']
     print(f"user_query: {user_query}")
-    audio_stream = asyncio.create_task(chat_completion(user_query))
-    print(f"audio_stream: {audio_stream}")
-    return Response(stream_with_context(audio_stream_generator(audio_stream)), mimetype='audio/mpeg')
-
-
-# Your existing async functions (chat_completion, text_to_speech_input_streaming, etc.)
-# ...
-
-async def text_chunker(chunks):
-    """Split text into chunks, ensuring to not break sentences."""
-    splitters = (".", ",", "?", "!", ";", ":", "—", "-", "(", ")", "[", "]", "}", " ")
-    buffer = ""
-
-    async for text in chunks:
-        if buffer.endswith(splitters):
-            yield buffer + " "
-            buffer = text
-        elif text.startswith(splitters):
-            yield buffer + text[0] + " "
-            buffer = text[1:]
-        else:
-            buffer += text
-
-    if buffer:
-        yield buffer + " "
-
-
-async def chat_completion(query):
-    """Retrieve text from OpenAI and pass it to the text-to-speech function."""
-    response = await aclient.chat.completions.create(model='gpt-4', messages=[{'role': 'user', 'content': query}],
-                                                     temperature=1, stream=True)
-
-    async def text_iterator():
-        async for chunk in response:
-            delta = chunk.choices[0].delta
-            print(delta.content)
-            yield delta.content
-
-    await text_to_speech_input_streaming(VOICE_ID, text_iterator())
-
-
-async def text_to_speech_input_streaming(voice_id, text_iterator):
-    """Send text to ElevenLabs API and stream the returned audio."""
-    uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream-input?model_id=eleven_monolingual_v1"
-
-    async with websockets.connect(uri) as websocket:
-        await websocket.send(json.dumps({
-            "text": " ",
-            "voice_settings": {"stability": 0.5, "similarity_boost": 0.8},
-            "xi_api_key": ELEVENLABS_API_KEY,
-        }))
-
-        async def listen():
-            """Listen to the websocket for audio data and yield it."""
-            while True:
-                try:
-                    message = await websocket.recv()
-                    data = json.loads(message)
-                    if data.get("audio"):
-                        yield base64.b64decode(data["audio"])
-                    elif data.get('isFinal'):
-                        break
-                except websockets.exceptions.ConnectionClosed:
-                    print("Connection closed")
-                    break
-
-        listen_generator = listen()
-
-        async for text in text_chunker(text_iterator):
-            await websocket.send(json.dumps({"text": text, "try_trigger_generation": True}))
-
-        await websocket.send(json.dumps({"text": ""}))
-
-        # Instead of creating a separate task, return the generator itself
-        return listen_generator
+    speech = voice.SpeechStream(user_query)
+    try:
+        # wait for the first chunk so a failed pipeline is still an error status
+        first = next(speech)
+    except StopIteration:
+        return "No audio generated", 502
+    except Exception as e:
+        return str(e), 502
+    return Response(prepend_chunk(first, speech), mimetype='audio/mpeg', headers={'X-Accel-Buffering': 'no'})
 
 
-# Generator function to adapt the audio stream for Flask Response
-async def audio_stream_generator(audio_stream):
-    async for chunk in audio_stream:
-        yield chunk
+def prepend_chunk(first, chunks):
+    try:
+        yield first
+        yield from chunks
+    finally:
+        chunks.close()
 
 
 # todo recommend recipe based on my pantry
@@ -0,0 +1,71 @@
+import os
+import threading
+
+import boto3
+import httpx
+import requests
+from botocore.config import Config
+from openai import AsyncOpenAI, OpenAI
+from requests.adapters import HTTPAdapter
+
+# keep-alive connections held per provider, size them to the busiest thread pool that calls it
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", default=16))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", default=5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", default=120))
+S3_REGION = os.getenv("S3_REGION", default="us-west-2")
+
+_lock = threading.Lock()
+_sessions = {}
+_s3 = None
+
+
+def _openai_http_client():
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+
+
+# retries are left to the adaptive limiters in agents.limits
+openai = OpenAI(max_retries=0, http_client=_openai_http_client())
+# only used from the voice event loop, httpx async pools can't be shared between loops
+async_openai = AsyncOpenAI(
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)))
+
+
+class _TimeoutSession(requests.Session):
+    """Session that applies the default timeouts to calls that don't pass their own."""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+
+def session(provider):
+    """
+    Keep-alive requests session for a provider, e.g. openai, elevenlabs or apple.
+
+    One per provider and worker, so calls reuse pooled tcp and tls connections.
+    """
+    with _lock:
+        if provider not in _sessions:
+            http = _TimeoutSession()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            http.mount("https://", adapter)
+            http.mount("http://", adapter)
+            _sessions[provider] = http
+        return _sessions[provider]
+
+
+def s3():
+    """Shared S3 client, boto3 clients are thread safe and pool their connections."""
+    global _s3
+    with _lock:
+        if _s3 is None:
+            _s3 = boto3.client('s3', aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                               aws_secret_access_key=os.getenv("AWS_SECRET_KEY_ID"), region_name=S3_REGION,
+                               config=Config(max_pool_connections=HTTP_POOL_SIZE,
+                                             connect_timeout=HTTP_CONNECT_TIMEOUT,
+                                             read_timeout=HTTP_READ_TIMEOUT))
+        return _s3
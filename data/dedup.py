@@ -0,0 +1,185 @@
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+from sqlalchemy import text, tuple_
+
+from data.localIndex import sync_local_index
+from data.models import db, Recipe, RecipeLshBand, RecipeSignature, VECTOR_TYPE
+
+MINHASH_PERMUTATIONS = 128
+# 32 bands of 4 rows puts recipes above ~0.5 jaccard similarity in a shared bucket most of the time,
+# candidates are then checked against NEAR_DUPLICATE_JACCARD on the full signature
+LSH_BANDS = 32
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+SHINGLE_WORDS = 3
+# estimated jaccard similarity of ocr shingles at which a submission is treated as the same recipe
+NEAR_DUPLICATE_JACCARD = float(os.getenv("NEAR_DUPLICATE_JACCARD", default=0.8))
+# cosine similarity of description embeddings at which a submission is treated as the same recipe
+NEAR_DUPLICATE_COSINE = float(os.getenv("NEAR_DUPLICATE_COSINE", default=0.97))
+
+_PRIME = (1 << 31) - 1
+_random = np.random.RandomState(1)
+_A = _random.randint(1, _PRIME, MINHASH_PERMUTATIONS).astype(np.uint64)
+_B = _random.randint(0, _PRIME, MINHASH_PERMUTATIONS).astype(np.uint64)
+
+
+def shingles(value, size=SHINGLE_WORDS):
+    # ocr of the same page differs in punctuation, casing and line breaks far more than in words
+    words = re.findall(r"[a-z0-9]+", value.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash_signature(value):
+    """MinHash of the word shingles of value, a list of MINHASH_PERMUTATIONS ints."""
+    hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=4).digest(), "little")
+                       for shingle in shingles(value)], dtype=np.uint64)
+    # a * h + b stays below 2^63 because a, b < 2^31 and h < 2^32
+    permuted = (np.outer(hashes, _A) + _B) % _PRIME
+    return permuted.min(axis=0).astype(np.int64).tolist()
+
+
+def estimated_jaccard(signature, other):
+    return float(np.mean(np.array(signature) == np.array(other)))
+
+
+def lsh_buckets(signature):
+    return [(band, hashlib.md5(str(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]).encode()).hexdigest())
+            for band in range(LSH_BANDS)]
+
+
+def save_signature(recipe_id, signature, commit=True):
+    """Store the signature and its lsh bands, replacing any earlier ones for the recipe."""
+    RecipeSignature.query.filter_by(recipe_id=recipe_id).delete()
+    RecipeLshBand.query.filter_by(recipe_id=recipe_id).delete()
+    db.session.add(RecipeSignature(recipe_id=recipe_id, minhash=signature))
+    for band, bucket in lsh_buckets(signature):
+        db.session.add(RecipeLshBand(recipe_id=recipe_id, band=band, bucket=bucket))
+    if commit:
+        db.session.commit()
+
+
+def find_text_duplicate(signature, threshold=NEAR_DUPLICATE_JACCARD):
+    """
+    Find an existing recipe whose ocr text is a near duplicate of the signature's.
+
+    :return: the canonical recipe of the most similar one above threshold, or None
+    """
+    buckets = lsh_buckets(signature)
+    candidates = db.session.query(RecipeSignature).join(
+        RecipeLshBand, RecipeLshBand.recipe_id == RecipeSignature.recipe_id).filter(
+        tuple_(RecipeLshBand.band, RecipeLshBand.bucket).in_(buckets)).distinct().all()
+
+    best, best_similarity = None, threshold
+    for candidate in candidates:
+        similarity = estimated_jaccard(signature, candidate.minhash)
+        if similarity >= best_similarity:
+            best, best_similarity = candidate, similarity
+    if best is None:
+        return None
+    print(f"text near duplicate of recipe {best.recipe_id}: {best_similarity:.2f}")
+    # recipes linked by cluster --apply keep their signatures, new submissions link to what they point at
+    return canonical_recipe(db.session.get(Recipe, best.recipe_id))
+
+
+def find_embedding_duplicate(description_embeddings, threshold=NEAR_DUPLICATE_COSINE):
+    """
+    Find an existing recipe whose description embedding is nearly identical, using the vector index.
+
+    Embeddings are unit length so cosine similarity is 1 - d^2 / 2 for euclidean distance d.
+
+    :return: Recipe or None
+    """
+    row = db.session.execute(text(f"""
+        SELECT recipe_id, embeddings <-> CAST(:embeddings AS {VECTOR_TYPE}) AS distance
+        FROM description_embeddings
+        ORDER BY distance
+        LIMIT 1;
+    """), {"embeddings": description_embeddings}).first()
+    if row is None or 1 - row.distance ** 2 / 2 < threshold:
+        return None
+    print(f"embedding near duplicate of recipe {row.recipe_id}: {1 - row.distance ** 2 / 2:.3f}")
+    return db.session.get(Recipe, row.recipe_id)
+
+
+def canonical_recipe(recipe):
+    return db.session.get(Recipe, recipe.duplicate_of) if recipe.duplicate_of else recipe
+
+
+def link_duplicate(canonical, md5):
+    """Record a submission as a duplicate so resubmitting the same pages short circuits on md5."""
+    db.session.add(Recipe(submission_md5=md5, duplicate_of=canonical.id))
+    db.session.commit()
+
+
+def cluster_existing_duplicates(threshold=NEAR_DUPLICATE_COSINE, neighbours=5, apply=False):
+    """
+    Cluster recipes already in the table by description embedding similarity.
+
+    Each recipe's nearest neighbours come from the vector index and pairs above threshold are
+    merged with union find. With apply, every recipe in a cluster except the oldest is linked
+    to the oldest and loses its embeddings, so it stops showing up in search, and anything linked to
+    it is re-linked to the oldest.
+
+    :return: list of clusters, each a sorted list of recipe ids
+    """
+    recipe_ids = [row.recipe_id for row in db.session.execute(text("""
+        SELECT description_embeddings.recipe_id FROM description_embeddings
+        JOIN recipe ON recipe.id = description_embeddings.recipe_id
+        WHERE recipe.deleted = FALSE AND recipe.duplicate_of IS NULL;
+    """))]
+    parents = {recipe_id: recipe_id for recipe_id in recipe_ids}
+
+    def find(recipe_id):
+        while parents[recipe_id] != recipe_id:
+            parents[recipe_id] = parents[parents[recipe_id]]
+            recipe_id = parents[recipe_id]
+        return recipe_id
+
+    for recipe_id in recipe_ids:
+        # a scalar subquery rather than a join, the index can't order by distance to another row's column
+        rows = db.session.execute(text("""
+            SELECT recipe_id, embeddings <-> (
+                SELECT embeddings FROM description_embeddings WHERE recipe_id = :recipe_id
+            ) AS distance
+            FROM description_embeddings
+            WHERE recipe_id != :recipe_id
+            ORDER BY distance
+            LIMIT :neighbours;
+        """), {"recipe_id": recipe_id, "neighbours": neighbours})
+        for row in rows:
+            if row.recipe_id in parents and 1 - row.distance ** 2 / 2 >= threshold:
+                parents[find(row.recipe_id)] = find(recipe_id)
+
+    clusters = {}
+    for recipe_id in recipe_ids:
+        clusters.setdefault(find(recipe_id), []).append(recipe_id)
+    clusters = [sorted(cluster) for cluster in clusters.values() if len(cluster) > 1]
+
+    if apply:
+        for cluster in clusters:
+            canonical, duplicates = cluster[0], cluster[1:]
+            params = {"canonical": canonical, "duplicates": duplicates}
+            # submissions already linked to a duplicate move with it, canonical_recipe only follows one link
+            db.session.execute(
+                text("UPDATE recipe SET duplicate_of = :canonical WHERE duplicate_of = ANY(:duplicates);"), params)
+            db.session.execute(text("UPDATE recipe SET duplicate_of = :canonical WHERE id = ANY(:duplicates);"),
+                               params)
+            for table in ("description_embeddings", "ingredients_embeddings"):
+                db.session.execute(text(f"DELETE FROM {table} WHERE recipe_id = ANY(:duplicates);"), params)
+            db.session.commit()
+            sync_local_index(recipe_ids=duplicates)
+    return clusters
+
+
+if __name__ == "__main__":
+    from api.api import create_api
+
+    app = create_api()
+    with app.app_context():
+        for cluster in cluster_existing_duplicates(apply="--apply" in sys.argv):
+            print(cluster)
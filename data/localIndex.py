@@ -0,0 +1,271 @@
+import fcntl
+import os
+import threading
+import time
+import traceback
+
+import numpy as np
+from sqlalchemy import text
+
+from data.models import db, EMBEDDING_DIMENSIONS
+
+# postgres or local, local serves recipe search from memory mapped matrices exported by export_local_index
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", default="postgres")
+SEARCH_BACKENDS = ("postgres", "local")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", default="/tmp/recipe-index")
+# float16 halves the file and page cache footprint at a small recall cost
+LOCAL_INDEX_DTYPE = np.dtype(os.getenv("LOCAL_INDEX_DTYPE", default="float16"))
+
+FIELD_TABLES = {"description": "description_embeddings", "ingredients": "ingredients_embeddings"}
+# seconds between reconciling this host's files with postgres
+LOCAL_INDEX_SYNC_INTERVAL = float(os.getenv("LOCAL_INDEX_SYNC_INTERVAL", default=30))
+# rows converted to float32 per matrix-vector product, bounds the temporary copy for float16 files
+SEARCH_BLOCK_ROWS = 65536
+
+
+def _path(name):
+    return os.path.join(LOCAL_INDEX_DIR, name)
+
+
+class _Lock:
+    """
+    flock on the index directory. Appends and exports take it exclusively so they don't interleave,
+    readers take it shared so they never see one field's vectors swapped in without its ids.
+    """
+
+    def __init__(self, shared=False):
+        self._operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+    def __enter__(self):
+        os.makedirs(LOCAL_INDEX_DIR, exist_ok=True)
+        self._file = open(_path(".lock"), "a")
+        fcntl.flock(self._file, self._operation)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def _read_ids(name):
+    try:
+        return np.fromfile(_path(name), dtype=np.int64)
+    except FileNotFoundError:
+        return np.empty(0, dtype=np.int64)
+
+
+def _append(field, rows, dtype):
+    """Append embedding rows, each with id, recipe_id and embeddings. Callers hold the exclusive lock."""
+    with open(_path(f"{field}.vectors"), "ab") as vectors_file:
+        np.array([row.embeddings for row in rows], dtype=dtype).tofile(vectors_file)
+    with open(_path(f"{field}.rows"), "ab") as rows_file:
+        np.array([row.id for row in rows], dtype=np.int64).tofile(rows_file)
+    # ids are written last, readers only use rows that have one
+    with open(_path(f"{field}.ids"), "ab") as ids_file:
+        np.array([row.recipe_id for row in rows], dtype=np.int64).tofile(ids_file)
+
+
+def export_local_index(dtype=LOCAL_INDEX_DTYPE):
+    """
+    Write every description and ingredient embedding to contiguous matrix files.
+
+    Files are written next to the live ones and swapped in with os.replace while the lock is held,
+    so workers that have the old files mapped keep serving until their next refresh and never map
+    new vectors against old ids. This also compacts rows appended or tombstoned since the last export.
+    Postgres is read before the lock is taken, anything written meanwhile is picked up by the next sync.
+    """
+    for field, table in FIELD_TABLES.items():
+        rows = db.session.execute(text(f"""
+            SELECT {table}.id, {table}.recipe_id, {table}.embeddings::float4[] AS embeddings FROM {table}
+            JOIN recipe ON recipe.id = {table}.recipe_id
+            WHERE recipe.deleted = FALSE
+            ORDER BY {table}.id;
+        """)).fetchall()
+        ids = np.array([row.recipe_id for row in rows], dtype=np.int64)
+        row_ids = np.array([row.id for row in rows], dtype=np.int64)
+        vectors = np.array([row.embeddings for row in rows], dtype=dtype).reshape(len(rows), EMBEDDING_DIMENSIONS)
+
+        with _Lock():
+            vectors.tofile(_path(f"{field}.vectors.tmp"))
+            row_ids.tofile(_path(f"{field}.rows.tmp"))
+            ids.tofile(_path(f"{field}.ids.tmp"))
+            for name in ("vectors", "rows", "ids"):
+                os.replace(_path(f"{field}.{name}.tmp"), _path(f"{field}.{name}"))
+        print(f"exported {len(ids)} {field} embeddings to {LOCAL_INDEX_DIR}")
+    with _Lock():
+        open(_path("deleted.ids.tmp"), "wb").close()
+        os.replace(_path("deleted.ids.tmp"), _path("deleted.ids"))
+
+
+def local_index_exists():
+    # exports from before row ids were recorded can't be synced and are exported again
+    return all(os.path.exists(_path(f"{field}.{name}")) for field in FIELD_TABLES for name in ("ids", "rows"))
+
+
+def sync_local_index(recipe_ids=None, dtype=LOCAL_INDEX_DTYPE):
+    """
+    Reconcile this host's files with postgres, so recipes saved, re-extracted or deleted through any
+    replica show up in its searches.
+
+    Embedding rows are matched by their table id. Re-extracting a recipe replaces its embedding rows,
+    so the new ones are appended and outrank the old. Recipes that are no longer live are tombstoned.
+    Postgres is read before the lock is taken, searches on this host only wait for the file writes.
+
+    :param recipe_ids: only reconcile these recipes, e.g. the ones a request just wrote
+    """
+    if not local_index_exists():
+        return
+    # read before postgres, so a recipe missing from postgres below was deleted rather than not yet visible
+    with _Lock(shared=True):
+        local_rows = {field: set(_read_ids(f"{field}.rows").tolist()) for field in FIELD_TABLES}
+        local_ids = set(np.concatenate([_read_ids(f"{field}.ids") for field in FIELD_TABLES]).tolist())
+        local_ids -= set(_read_ids("deleted.ids").tolist())
+    if recipe_ids is not None:
+        local_ids &= set(recipe_ids)
+
+    live_ids = set()
+    missing = {}
+    for field, table in FIELD_TABLES.items():
+        live = db.session.execute(text(f"""
+            SELECT {table}.id, {table}.recipe_id FROM {table}
+            JOIN recipe ON recipe.id = {table}.recipe_id
+            WHERE recipe.deleted = FALSE
+            AND (CAST(:recipe_ids AS integer[]) IS NULL OR recipe.id = ANY(:recipe_ids));
+        """), {"recipe_ids": recipe_ids}).fetchall()
+        live_ids.update(row.recipe_id for row in live)
+        missing_rows = sorted({row.id for row in live} - local_rows[field])
+        if missing_rows:
+            missing[field] = db.session.execute(text(f"""
+                SELECT id, recipe_id, embeddings::float4[] AS embeddings FROM {table}
+                WHERE id = ANY(:row_ids)
+                ORDER BY id;
+            """), {"row_ids": missing_rows}).fetchall()
+    stale = sorted(local_ids - live_ids)
+
+    with _Lock():
+        for field, rows in missing.items():
+            # another worker on this host may have appended some of them, or an export compacted them in
+            known = set(_read_ids(f"{field}.rows").tolist())
+            rows = [row for row in rows if row.id not in known]
+            if rows:
+                _append(field, rows, dtype)
+                print(f"synced {len(rows)} {field} embeddings into {LOCAL_INDEX_DIR}")
+        if stale:
+            with open(_path("deleted.ids"), "ab") as deleted_file:
+                np.array(stale, dtype=np.int64).tofile(deleted_file)
+            print(f"tombstoned {len(stale)} recipes in {LOCAL_INDEX_DIR}")
+
+
+def sync_loop(app):
+    with app.app_context():
+        while True:
+            time.sleep(LOCAL_INDEX_SYNC_INTERVAL)
+            try:
+                sync_local_index()
+            except Exception:
+                traceback.print_exc()
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+def start_local_index_sync(app):
+    threading.Thread(target=sync_loop, args=(app,), name="local-index-sync", daemon=True).start()
+
+
+class LocalVectorIndex:
+    """
+    Read side of one exported field, re-mapped whenever another worker appends or re-exports.
+
+    Distances are squared L2, matching the ordering of pgvector's <-> operator.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        """(inode, size) of the vectors, ids and deleted files, (None, 0) for a file that doesn't exist."""
+        signature = []
+        for name in (f"{self.field}.vectors", f"{self.field}.ids", "deleted.ids"):
+            try:
+                stat = os.stat(_path(name))
+                signature.append((stat.st_ino, stat.st_size))
+            except FileNotFoundError:
+                signature.append((None, 0))
+        return tuple(signature)
+
+    def _refresh(self):
+        # the mapping outlives the lock, a later os.replace leaves the mapped inode in place
+        with _Lock(shared=True):
+            signature = self._file_signature()
+            if signature == self._signature:
+                return
+            (vectors_inode, vectors_size), _, _ = signature
+            ids = _read_ids(f"{self.field}.ids")
+            # a missing or empty file is an empty index, memmap can't map zero bytes
+            if vectors_size:
+                vectors = np.memmap(_path(f"{self.field}.vectors"), dtype=LOCAL_INDEX_DTYPE, mode="r")
+            else:
+                vectors = np.empty(0, dtype=LOCAL_INDEX_DTYPE)
+            deleted = _read_ids("deleted.ids")
+        # a worker killed mid-append can leave a vector without its id
+        rows = min(len(ids), vectors.shape[0] // EMBEDDING_DIMENSIONS)
+        ids = ids[:rows]
+        vectors = vectors[:rows * EMBEDDING_DIMENSIONS].reshape(rows, EMBEDDING_DIMENSIONS)
+
+        # keep only the newest row for each recipe
+        _, last_from_end = np.unique(ids[::-1], return_index=True)
+        valid = np.zeros(rows, dtype=bool)
+        valid[rows - 1 - last_from_end] = True
+        valid &= ~np.isin(ids, deleted)
+
+        # appends only add rows at the end of the same file, so the norms already computed still hold
+        known = 0
+        if self._signature is not None and self._signature[0][0] == vectors_inode:
+            known = min(len(self._norms), rows)
+        norms = np.empty(rows, dtype=np.float32)
+        if known:
+            norms[:known] = self._norms[:known]
+        for start in range(known, rows, SEARCH_BLOCK_ROWS):
+            block = vectors[start:start + SEARCH_BLOCK_ROWS].astype(np.float32)
+            norms[start:start + SEARCH_BLOCK_ROWS] = np.einsum("ij,ij->i", block, block)
+
+        self._ids, self._vectors, self._valid, self._norms = ids, vectors, valid, norms
+        self._signature = signature
+
+    def search(self, query, k=5):
+        """
+        :param query: query embedding
+        :param k: number of results
+        :return: recipe ids ordered by distance
+        """
+        with self._lock:
+            self._refresh()
+            ids, vectors, valid, norms = self._ids, self._vectors, self._valid, self._norms
+
+        query = np.asarray(query, dtype=np.float32)
+        distances = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), SEARCH_BLOCK_ROWS):
+            block = vectors[start:start + SEARCH_BLOCK_ROWS].astype(np.float32, copy=False)
+            distances[start:start + SEARCH_BLOCK_ROWS] = block @ query
+        # |x - q|^2 without the constant |q|^2 term
+        distances = norms - 2 * distances
+        distances[~valid] = np.inf
+
+        k = min(k, int(valid.sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(distances, k - 1)[:k]
+        return ids[top[np.argsort(distances[top])]].tolist()
+
+
+local_indexes = {field: LocalVectorIndex(field) for field in FIELD_TABLES}
+
+
+if __name__ == "__main__":
+    from api.api import create_api
+
+    app = create_api()
+    with app.app_context():
+        export_local_index()
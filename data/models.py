@@ -1,10 +1,26 @@
+import os
+
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Boolean, ForeignKey, DateTime, event, text
-from sqlalchemy.dialects.postgresql import ARRAY, INT4RANGE
+from sqlalchemy import Boolean, Computed, ForeignKey, DateTime, Index, UniqueConstraint, event, text
+from sqlalchemy.dialects.postgresql import ARRAY, INT4RANGE, TSVECTOR
 from datetime import datetime
 
 db = SQLAlchemy()
 
+EMBEDDING_DIMENSIONS = 3072
+# vector stores float32 and cannot be indexed above 2000 dimensions, halfvec stores float16 and gets an hnsw index
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", default="vector")
+VECTOR_TYPE = f"{VECTOR_STORAGE}({EMBEDDING_DIMENSIONS})"
+EMBEDDING_TABLES = ("description_embeddings", "ingredients_embeddings", "pantry_item_embeddings")
+
+# weighted so title and author matches outrank a passing mention in the ingredients
+RECIPE_SEARCH_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(author, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(ingredients, '')), 'C')"
+)
+
 
 class Recipe(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -19,6 +35,13 @@ class Recipe(db.Model):
     author = db.Column(db.Text, nullable=True)
     submission_md5 = db.Column(db.Text, unique=True)
     deleted = db.Column(Boolean, nullable=False, default=False)
+    # set on submissions found to be near duplicates, they keep their md5 but have no fields or embeddings
+    duplicate_of = db.Column(db.Integer, ForeignKey('recipe.id'), nullable=True)
+    # md5 of each submitted page in order, lets updates diff against what was already extracted
+    page_md5s = db.Column(ARRAY(db.Text), nullable=True)
+    search_vector = db.Column(TSVECTOR, Computed(RECIPE_SEARCH_VECTOR, persisted=True))
+
+    __table_args__ = (Index('recipe_search_vector_idx', 'search_vector', postgresql_using='gin'),)
 
     def to_dict(self):
         return {
@@ -33,7 +56,8 @@ class Recipe(db.Model):
             "title": self.title,
             "author": self.author,
             'created_at': self.created_at,
-            'deleted': self.deleted
+            'deleted': self.deleted,
+            'duplicate_of': self.duplicate_of
         }
 
 
@@ -103,6 +127,145 @@ class PantryItemEmbeddings(db.Model):
         }
 
 
+class IngestionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    items = db.relationship('IngestionJobItem', backref='job', order_by='IngestionJobItem.position')
+
+    def to_dict(self):
+        counts = {}
+        for item in self.items:
+            counts[item.status] = counts.get(item.status, 0) + 1
+        finished = counts.get('completed', 0) + counts.get('duplicate', 0) + counts.get('failed', 0)
+        if finished == len(self.items):
+            status = 'completed'
+        elif counts.get('queued', 0) == len(self.items):
+            status = 'queued'
+        else:
+            status = 'running'
+        return {
+            'id': self.id,
+            'created_at': self.created_at,
+            'status': status,
+            'counts': counts,
+            'items': [item.to_dict() for item in self.items],
+        }
+
+
+class IngestionJobItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, ForeignKey('ingestion_job.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    # queued, running, completed, duplicate or failed
+    status = db.Column(db.Text, nullable=False, default='queued', index=True)
+    filenames = db.Column(ARRAY(db.Text), nullable=False)
+    # uploaded page bytes, cleared once the item finishes
+    pages = db.Column(ARRAY(db.LargeBinary), nullable=True)
+    # kept when the recipe is deleted so the job's history survives, the item just loses its link
+    recipe_id = db.Column(db.Integer, ForeignKey('recipe.id', ondelete='SET NULL'), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(DateTime, nullable=True)
+    finished_at = db.Column(DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'position': self.position,
+            'status': self.status,
+            'filenames': self.filenames,
+            'recipe_id': self.recipe_id,
+            'error': self.error,
+            'attempts': self.attempts,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class RecipeSignature(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipe_id = db.Column(db.Integer, ForeignKey('recipe.id'), unique=True)
+    minhash = db.Column(ARRAY(db.Integer), nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'recipe_id': self.recipe_id,
+            'minhash': self.minhash,
+        }
+
+
+class RecipeLshBand(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipe_id = db.Column(db.Integer, ForeignKey('recipe.id'), nullable=False)
+    band = db.Column(db.Integer, nullable=False)
+    bucket = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (Index('recipe_lsh_band_bucket_idx', 'band', 'bucket'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'recipe_id': self.recipe_id,
+            'band': self.band,
+            'bucket': self.bucket,
+        }
+
+
+class PageOcr(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    md5 = db.Column(db.Text, unique=True, nullable=False)
+    ocr_text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'md5': self.md5,
+            'ocr_text': self.ocr_text,
+            'created_at': self.created_at,
+        }
+
+
+class EmbeddingCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.Text, nullable=False)
+    text_hash = db.Column(db.Text, nullable=False)
+    embeddings = db.Column(ARRAY(db.Float))  # vector of the model's dimension
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('model', 'text_hash'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'model': self.model,
+            'text_hash': self.text_hash,
+            'created_at': self.created_at,
+        }
+
+
+class ResponseCache(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.Text, nullable=False)
+    prompt_hash = db.Column(db.Text, nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (UniqueConstraint('model', 'prompt_hash'),)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'model': self.model,
+            'prompt_hash': self.prompt_hash,
+            'response': self.response,
+            'created_at': self.created_at,
+            'last_used_at': self.last_used_at,
+        }
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.Text, unique=True, nullable=False)
@@ -157,9 +320,37 @@ class Message(db.Model):
             'deleted': self.deleted,
         }
 
+def migrate_recipe_columns():
+    """Add columns and constraints introduced after the recipe tables were first created."""
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            "ALTER TABLE recipe ADD COLUMN IF NOT EXISTS duplicate_of INTEGER REFERENCES recipe (id);"))
+        connection.execute(text("ALTER TABLE recipe ADD COLUMN IF NOT EXISTS page_md5s TEXT[];"))
+        # created without ON DELETE, which made recipes that a job ingested impossible to delete
+        connection.execute(text("""
+            DO $$ BEGIN
+                IF EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE conname = 'ingestion_job_item_recipe_id_fkey' AND confdeltype <> 'n') THEN
+                    ALTER TABLE ingestion_job_item DROP CONSTRAINT ingestion_job_item_recipe_id_fkey,
+                    ADD CONSTRAINT ingestion_job_item_recipe_id_fkey FOREIGN KEY (recipe_id) REFERENCES recipe (id)
+                    ON DELETE SET NULL;
+                END IF;
+            END $$;
+        """))
+
+
+def embedding_column_statements(table, storage=VECTOR_STORAGE):
+    vector_type = f"{storage}({EMBEDDING_DIMENSIONS})"
+    statements = [f"ALTER TABLE {table} ALTER COLUMN embeddings TYPE {vector_type} USING embeddings::{vector_type};"]
+    if storage == "halfvec":
+        statements.append(
+            f"CREATE INDEX IF NOT EXISTS {table}_embeddings_hnsw ON {table} USING hnsw (embeddings halfvec_l2_ops);")
+    return statements
+
+
 def after_description_create_listener(target, connection, **kw):
-    connection.execute(text(
-        "ALTER TABLE description_embeddings ALTER COLUMN embeddings TYPE vector(3072) USING embeddings::vector(3072);"))
+    for statement in embedding_column_statements("description_embeddings"):
+        connection.execute(text(statement))
 
 
 @event.listens_for(DescriptionEmbeddings.__table__, 'after_create')
@@ -168,8 +359,8 @@ def after_description_create(target, connection, **kw):
 
 
 def after_ingredient_create_listener(target, connection, **kw):
-    connection.execute(text(
-        "ALTER TABLE ingredients_embeddings ALTER COLUMN embeddings TYPE vector(3072) USING embeddings::vector(3072);"))
+    for statement in embedding_column_statements("ingredients_embeddings"):
+        connection.execute(text(statement))
 
 
 @event.listens_for(IngredientsEmbeddings.__table__, 'after_create')
@@ -178,10 +369,21 @@ def after_ingredient_create(target, connection, **kw):
 
 
 def after_pantry_create_listener(target, connection, **kw):
-    connection.execute(text(
-        "ALTER TABLE pantry_item_embeddings ALTER COLUMN embeddings TYPE vector(3072) USING embeddings::vector(3072);"))
+    for statement in embedding_column_statements("pantry_item_embeddings"):
+        connection.execute(text(statement))
 
 
 @event.listens_for(PantryItemEmbeddings.__table__, 'after_create')
 def after_pantry_create(target, connection, **kw):
     after_pantry_create_listener(target, connection, **kw)
+
+
+def after_embedding_cache_create_listener(target, connection, **kw):
+    # untyped vector so entries from models with different dimensions can share the table
+    connection.execute(text(
+        "ALTER TABLE embedding_cache ALTER COLUMN embeddings TYPE vector USING embeddings::vector;"))
+
+
+@event.listens_for(EmbeddingCache.__table__, 'after_create')
+def after_embedding_cache_create(target, connection, **kw):
+    after_embedding_cache_create_listener(target, connection, **kw)
@@ -0,0 +1,182 @@
+import os
+
+from sqlalchemy import text
+
+from data.localIndex import FIELD_TABLES, SEARCH_BACKEND, SEARCH_BACKENDS, local_indexes
+from data.models import db, EMBEDDING_DIMENSIONS, RECIPE_SEARCH_VECTOR, VECTOR_TYPE, Recipe
+
+# exact, binary or hybrid, overridable per request
+SEARCH_MODE = os.getenv("SEARCH_MODE", default="exact")
+# how many hamming-distance candidates binary search pulls per requested result before re-ranking
+BINARY_CANDIDATE_MULTIPLIER = int(os.getenv("BINARY_CANDIDATE_MULTIPLIER", default=10))
+# per request overrides above this would re-rank most of the table
+MAX_CANDIDATE_MULTIPLIER = 100
+# reciprocal rank fusion of the full text and vector legs in hybrid mode
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", default=1.0))
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", default=1.0))
+HYBRID_LEXICAL_LIMIT = int(os.getenv("HYBRID_LEXICAL_LIMIT", default=50))
+HYBRID_VECTOR_LIMIT = int(os.getenv("HYBRID_VECTOR_LIMIT", default=50))
+RRF_K = int(os.getenv("RRF_K", default=60))
+# bounds of per request overrides of the hybrid settings
+MAX_HYBRID_LIMIT = 1000
+MAX_HYBRID_WEIGHT = 100
+# share of the combined distance that comes from the ingredients embedding
+INGREDIENTS_WEIGHT = float(os.getenv("INGREDIENTS_WEIGHT", default=0.5))
+# nearest neighbours pulled from each embedding table before combined scoring
+MULTI_VECTOR_CANDIDATES = int(os.getenv("MULTI_VECTOR_CANDIDATES", default=100))
+
+SEARCH_MODES = ("exact", "binary", "hybrid")
+# which embeddings exact mode scores against, combined is a weighted distance and max_sim the closer of the two
+SEARCH_FIELDS = ("description", "ingredients", "combined", "max_sim")
+
+BIT_TYPE = f"bit({EMBEDDING_DIMENSIONS})"
+
+
+def recipe_search_query(mode, limit=5, candidate_multiplier=None, hybrid=None, field="description",
+                        ingredients_weight=None):
+    """
+    Build the embedding search for a mode.
+
+    :param hybrid: overrides for the HYBRID_* settings, keyed lexical_weight, vector_weight,
+        lexical_limit and vector_limit
+    :param field: one of SEARCH_FIELDS, only exact mode searches anything but the description
+    :param ingredients_weight: combined field weight of the ingredients distance, defaults to INGREDIENTS_WEIGHT
+    :return: (sql, params) where params still needs the query embeddings, and the query text in hybrid mode
+    """
+    if mode == "hybrid":
+        # both legs run in one statement, each ranked on its own and fused by 1 / (k + rank)
+        sql = text(f"""
+            WITH lexical AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank FROM (
+                    SELECT id, ts_rank_cd(search_vector, websearch_to_tsquery('english', :query)) AS score
+                    FROM recipe
+                    WHERE search_vector @@ websearch_to_tsquery('english', :query) AND deleted = FALSE
+                    ORDER BY score DESC
+                    LIMIT :lexical_limit
+                ) matches
+            ), semantic AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY distance) AS rank FROM (
+                    SELECT recipe_id AS id, embeddings <-> CAST(:embeddings AS {VECTOR_TYPE}) AS distance
+                    FROM description_embeddings
+                    JOIN recipe ON recipe.id = description_embeddings.recipe_id
+                    WHERE recipe.deleted = FALSE
+                    ORDER BY distance
+                    LIMIT :vector_limit
+                ) neighbours
+            ), fused AS (
+                SELECT id, SUM(score) AS score FROM (
+                    SELECT id, CAST(:lexical_weight AS float8) / (:rrf_k + rank) AS score FROM lexical
+                    UNION ALL
+                    SELECT id, CAST(:vector_weight AS float8) / (:rrf_k + rank) AS score FROM semantic
+                ) scores
+                GROUP BY id
+            )
+            SELECT recipe.* FROM fused
+            JOIN recipe ON recipe.id = fused.id
+            ORDER BY fused.score DESC
+            LIMIT :limit;
+        """)
+        params = {
+            "lexical_weight": HYBRID_LEXICAL_WEIGHT,
+            "vector_weight": HYBRID_VECTOR_WEIGHT,
+            "lexical_limit": HYBRID_LEXICAL_LIMIT,
+            "vector_limit": HYBRID_VECTOR_LIMIT,
+            **{key: value for key, value in (hybrid or {}).items() if value is not None},
+        }
+        return sql, {**params, "rrf_k": RRF_K, "limit": limit}
+
+    if mode == "binary":
+        candidate_multiplier = candidate_multiplier or BINARY_CANDIDATE_MULTIPLIER
+        # the inner query walks the binary quantized hnsw index, the outer one re-ranks against the full vectors
+        sql = text(f"""
+            SELECT recipe.* FROM (
+                SELECT recipe_id, embeddings FROM description_embeddings
+                ORDER BY binary_quantize(embeddings)::{BIT_TYPE}
+                    <~> binary_quantize(CAST(:embeddings AS {VECTOR_TYPE}))::{BIT_TYPE}
+                LIMIT :candidates
+            ) candidates
+            JOIN recipe ON recipe.id = candidates.recipe_id
+            ORDER BY candidates.embeddings <-> CAST(:embeddings AS {VECTOR_TYPE})
+            LIMIT :limit;
+        """)
+        return sql, {"limit": limit, "candidates": limit * candidate_multiplier}
+
+    if field in ("combined", "max_sim"):
+        # the query vector is bound in every ORDER BY rather than read from a cte, pgvector only walks an index
+        # when the other operand has no column references
+        query = f"CAST(:embeddings AS {VECTOR_TYPE})"
+        if field == "combined":
+            score = (f"(1 - CAST(:ingredients_weight AS float8)) * (d.embeddings <-> {query})"
+                     f" + CAST(:ingredients_weight AS float8) * (i.embeddings <-> {query})")
+        else:
+            score = f"LEAST(d.embeddings <-> {query}, i.embeddings <-> {query})"
+        # each table's own index finds its nearest neighbours, the union is then scored on both vectors
+        sql = text(f"""
+            WITH candidates AS (
+                (SELECT recipe_id FROM description_embeddings
+                 ORDER BY embeddings <-> {query} LIMIT :candidates)
+                UNION
+                (SELECT recipe_id FROM ingredients_embeddings
+                 ORDER BY embeddings <-> {query} LIMIT :candidates)
+            )
+            SELECT recipe.* FROM candidates
+            JOIN recipe ON recipe.id = candidates.recipe_id
+            JOIN description_embeddings d ON d.recipe_id = candidates.recipe_id
+            JOIN ingredients_embeddings i ON i.recipe_id = candidates.recipe_id
+            ORDER BY {score}
+            LIMIT :limit;
+        """)
+        weight = INGREDIENTS_WEIGHT if ingredients_weight is None else ingredients_weight
+        return sql, {"limit": limit, "candidates": max(MULTI_VECTOR_CANDIDATES, limit),
+                     "ingredients_weight": weight}
+
+    table = FIELD_TABLES[field]
+    sql = text(f"""
+        SELECT recipe.* FROM recipe
+        JOIN {table} ON recipe.id = {table}.recipe_id
+        ORDER BY {table}.embeddings <-> CAST(:embeddings AS {VECTOR_TYPE})
+        LIMIT :limit;
+    """)
+    return sql, {"limit": limit}
+
+
+def recipes_by_ids(ids):
+    """Load recipes keeping the order of ids."""
+    recipes = {recipe.id: recipe for recipe in Recipe.query.filter(Recipe.id.in_(ids)).all()}
+    return [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes]
+
+
+def nearest_recipes(embeddings, mode=None, limit=5, candidate_multiplier=None, backend=None, query=None,
+                    hybrid=None, field="description", ingredients_weight=None):
+    """
+    Find the recipes whose embeddings are closest to embeddings.
+
+    :param embeddings: query embedding
+    :param mode: one of SEARCH_MODES, defaults to SEARCH_MODE
+    :param limit: number of recipes to return
+    :param candidate_multiplier: binary mode candidate pool size per result
+    :param backend: one of SEARCH_BACKENDS, defaults to SEARCH_BACKEND
+    :param query: query text for the full text leg of hybrid mode
+    :param hybrid: hybrid mode weight and limit overrides, see recipe_search_query
+    :param field: one of SEARCH_FIELDS
+    :param ingredients_weight: combined field weight of the ingredients distance
+    :return: recipe rows ordered by distance
+    """
+    mode = mode or SEARCH_MODE
+    if (backend or SEARCH_BACKEND) == "local" and mode != "hybrid" and field in local_indexes:
+        return recipes_by_ids(local_indexes[field].search(embeddings, k=limit))
+
+    sql, params = recipe_search_query(mode, limit=limit, candidate_multiplier=candidate_multiplier, hybrid=hybrid,
+                                      field=field, ingredients_weight=ingredients_weight)
+    return db.session.execute(sql, {**params, "embeddings": embeddings, "query": query or ""}).fetchall()
+
+
+def migrate_full_text_search():
+    """Add the generated search_vector column and its gin index to a recipe table created before them."""
+    with db.engine.begin() as connection:
+        connection.execute(text(f"""
+            ALTER TABLE recipe ADD COLUMN IF NOT EXISTS search_vector tsvector
+            GENERATED ALWAYS AS ({RECIPE_SEARCH_VECTOR}) STORED;
+        """))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS recipe_search_vector_idx ON recipe USING gin (search_vector);"))
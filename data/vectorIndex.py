@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+
+from sqlalchemy import text
+
+from data.models import db, EMBEDDING_TABLES, VECTOR_STORAGE, VECTOR_TYPE, embedding_column_statements
+from data.search import BIT_TYPE, recipe_search_query
+
+# build the binary quantized description index used by the binary search mode
+BINARY_QUANTIZED_INDEX = os.getenv("BINARY_QUANTIZED_INDEX", default="false").lower() == "true"
+
+
+def current_storage(connection, table):
+    """Return the embeddings column type of table, e.g. vector(3072) or halfvec(3072)."""
+    return connection.execute(text("""
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = CAST(:table AS regclass) AND attname = 'embeddings';
+    """), {"table": table}).scalar()
+
+
+def pending_storage_migrations(storage=VECTOR_STORAGE):
+    """Embedding tables whose column isn't in the configured storage type yet."""
+    with db.engine.connect() as connection:
+        return [table for table in EMBEDDING_TABLES
+                if _needs_migration(current_storage(connection, table), storage)]
+
+
+def _needs_migration(existing, storage):
+    return existing is not None and not existing.startswith(f"{storage}(")
+
+
+def migrate_embedding_storage(storage=VECTOR_STORAGE):
+    """
+    Convert existing embedding tables to the configured storage type and build their indexes.
+
+    Rows are rewritten in place by ALTER COLUMN ... USING, so this takes an ACCESS EXCLUSIVE lock
+    on each table for the duration of the rewrite and blocks every query against it. It is run
+    as its own deploy step, python -m data.vectorIndex migrate, never from the web workers.
+    Tables already in the target type are skipped.
+    """
+    with db.engine.begin() as connection:
+        # two deploy steps started together would both rewrite the tables, the second waits here
+        # and then finds them already migrated
+        connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('migrate_embedding_storage'));"))
+        for table in EMBEDDING_TABLES:
+            existing = current_storage(connection, table)
+            if not _needs_migration(existing, storage):
+                continue
+            print(f"migrating {table} from {existing} to {storage}")
+            if storage != "halfvec":
+                connection.execute(text(f"DROP INDEX IF EXISTS {table}_embeddings_hnsw;"))
+            for statement in embedding_column_statements(table, storage=storage):
+                connection.execute(text(statement))
+
+        if BINARY_QUANTIZED_INDEX:
+            connection.execute(text(f"""
+                CREATE INDEX IF NOT EXISTS description_embeddings_binary_hnsw ON description_embeddings
+                USING hnsw ((binary_quantize(embeddings)::{BIT_TYPE}) bit_hamming_ops);
+            """))
+
+
+def index_footprint():
+    """Size in bytes of the description embedding table and each of its indexes."""
+    with db.engine.connect() as connection:
+        rows = connection.execute(text("""
+            SELECT indexrelid::regclass::text AS name, pg_relation_size(indexrelid) AS bytes FROM pg_index
+            WHERE indrelid = CAST('description_embeddings' AS regclass);
+        """)).fetchall()
+        table_bytes = connection.execute(
+            text("SELECT pg_total_relation_size(CAST('description_embeddings' AS regclass));")).scalar()
+    return {"table": table_bytes, "indexes": {row.name: row.bytes for row in rows}}
+
+
+def compare_with_exact_scan(mode="exact", sample_size=50, k=5, candidate_multiplier=None):
+    """
+    Measure recall@k and latency of an indexed description search against an exact scan.
+
+    Stored description embeddings are used as probe queries. mode is a data.search mode, exact
+    compares the plain vector index against a sequential scan of the same query.
+
+    :return: dict with recall and average latencies in milliseconds
+    """
+    exact_sql, exact_params = recipe_search_query("exact", limit=k)
+    search_sql, search_params = recipe_search_query(mode, limit=k, candidate_multiplier=candidate_multiplier)
+    with db.engine.connect() as connection:
+        probes = connection.execute(text("""
+            SELECT embeddings::float4[] AS embeddings FROM description_embeddings
+            ORDER BY random() LIMIT :sample_size;
+        """), {"sample_size": sample_size}).fetchall()
+        connection.commit()
+
+        hits = 0
+        total = 0
+        exact_seconds = 0.0
+        indexed_seconds = 0.0
+        for probe in probes:
+            embeddings = list(probe.embeddings)
+
+            with connection.begin():
+                connection.execute(text("SET LOCAL enable_indexscan = off;"))
+                start = time.perf_counter()
+                exact = {row.id for row in connection.execute(exact_sql, {**exact_params, "embeddings": embeddings})}
+                exact_seconds += time.perf_counter() - start
+
+            with connection.begin():
+                start = time.perf_counter()
+                indexed = {row.id for row in
+                           connection.execute(search_sql, {**search_params, "embeddings": embeddings})}
+                indexed_seconds += time.perf_counter() - start
+
+            hits += len(exact & indexed)
+            total += len(exact)
+
+    count = max(len(probes), 1)
+    return {
+        "storage": VECTOR_TYPE,
+        "mode": mode,
+        "queries": len(probes),
+        "k": k,
+        "recall": hits / total if total else None,
+        "exact_ms": exact_seconds / count * 1000,
+        "indexed_ms": indexed_seconds / count * 1000,
+        "footprint_bytes": index_footprint(),
+    }
+
+
+if __name__ == "__main__":
+    from api.api import create_api
+
+    app = create_api()
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+            migrate_embedding_storage()
+        else:
+            print(compare_with_exact_scan(mode=sys.argv[1] if len(sys.argv) > 1 else "exact"))
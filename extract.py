@@ -3,6 +3,10 @@ import hashlib
 
 def calculate_md5(file_data):
     md5_hash = hashlib.md5()
+    if isinstance(file_data, (bytes, bytearray, memoryview)):
+        # hashed in place, iterating a BytesIO over it would copy it line by line
+        md5_hash.update(memoryview(file_data))
+        return md5_hash.hexdigest()
     for chunk in file_data:
         md5_hash.update(chunk)
     return md5_hash.hexdigest()
@@ -2,19 +2,37 @@ import os
 from sqlalchemy import text
 
 from api.api import create_api
-from data.models import db
+from api.v1.ingestion import start_ingestion_workers
+from data.models import db, migrate_recipe_columns, VECTOR_STORAGE
+from data.localIndex import SEARCH_BACKEND, export_local_index, local_index_exists, start_local_index_sync
+from data.search import migrate_full_text_search
+from data.vectorIndex import pending_storage_migrations
 
 app = create_api()
 
 with app.app_context():
-    db.create_all()
     try:
+        # the embedding tables are altered to vector types as they are created, so the extension must exist first
         db.session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
         db.session.commit()
         print("pg_similarity extension created successfully.")
     except Exception as e:
         db.session.rollback()
         print(f"Error creating pg_similarity extension: {str(e)}")
+    db.create_all()
+    # rewriting the tables locks them, so converting storage is a deploy step rather than part of boot
+    pending = pending_storage_migrations()
+    if pending:
+        print(f"{', '.join(pending)} not stored as {VECTOR_STORAGE}, run python -m data.vectorIndex migrate")
+    migrate_full_text_search()
+    migrate_recipe_columns()
+    if SEARCH_BACKEND == "local" and not local_index_exists():
+        export_local_index()
+
+# started after the tables exist so the workers' first poll doesn't fail
+start_ingestion_workers(app)
+if SEARCH_BACKEND == "local":
+    start_local_index_sync(app)
 
 if __name__ == '__main__':
     app.run(debug=True, port=os.getenv("PORT", default=5000))
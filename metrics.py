@@ -0,0 +1,63 @@
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+@contextmanager
+def rss_high_water_growth(name):
+    """
+    Record how far the block raised this worker's resident memory high-water mark, in bytes.
+
+    This is not the block's own memory use. ru_maxrss is one high-water mark for the whole process,
+    so growth during concurrent requests lands on whichever block saw it, and a block that stays
+    under an earlier peak records 0, which most do once the worker has served a large request.
+    Usable as a decorator.
+    """
+    # ru_maxrss is in kilobytes on linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        yield
+    finally:
+        observe(name, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024)
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    """Counters and timings recorded by this worker since it started."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "timings": {name: {**timing, "avg": timing["total"] / timing["count"]}
+                        for name, timing in _timings.items()},
+        }
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the modules read their settings from the environment at import time
+os.environ.setdefault("PGPORT", "5432")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ELEVEN_LABS_KEY", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,153 @@
+import os
+from unittest import mock
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from data import dedup
+from data.models import db, DescriptionEmbeddings, EMBEDDING_DIMENSIONS, IngredientsEmbeddings, Recipe
+
+RECIPE = """Classic Banana Bread
+3 ripe bananas, mashed
+1/3 cup melted butter
+1 teaspoon baking soda
+pinch of salt
+3/4 cup sugar
+1 large egg, beaten
+1 teaspoon vanilla extract
+1 1/2 cups all-purpose flour
+Preheat the oven to 350F and butter a 4x8 inch loaf pan. Mix the butter into the mashed bananas,
+then the baking soda and salt. Stir in the sugar, egg and vanilla, then the flour. Pour into the pan
+and bake for an hour, until a tester comes out clean. Cool on a rack before slicing.
+"""
+
+# the same page scanned again: different casing, punctuation and line breaks, one misread word
+RESCANNED = RECIPE.upper().replace(",", "").replace("\n", " ").replace("TESTER", "TOSTER")
+
+OTHER_RECIPE = """Weeknight Chicken Curry
+2 tablespoons oil, 1 onion, 3 cloves garlic, 1 tablespoon curry powder, 1 can coconut milk,
+1 pound chicken thighs. Soften the onion in the oil, add the garlic and curry powder, then the
+chicken and coconut milk. Simmer for twenty minutes and serve over rice.
+"""
+
+
+def test_shingles_ignore_case_and_punctuation():
+    assert dedup.shingles("Mix the Flour, then BAKE!") == dedup.shingles("mix the flour then bake")
+
+
+def test_short_text_is_one_shingle():
+    assert dedup.shingles("Banana bread") == {"banana bread"}
+
+
+def test_signature_is_deterministic():
+    signature = dedup.minhash_signature(RECIPE)
+
+    assert len(signature) == dedup.MINHASH_PERMUTATIONS
+    assert signature == dedup.minhash_signature(RECIPE)
+
+
+def test_rescanned_page_is_a_near_duplicate():
+    similarity = dedup.estimated_jaccard(dedup.minhash_signature(RECIPE), dedup.minhash_signature(RESCANNED))
+
+    assert similarity >= dedup.NEAR_DUPLICATE_JACCARD
+
+
+def test_different_recipe_is_not_a_near_duplicate():
+    similarity = dedup.estimated_jaccard(dedup.minhash_signature(RECIPE), dedup.minhash_signature(OTHER_RECIPE))
+
+    assert similarity < 0.2
+
+
+def test_near_duplicates_share_an_lsh_bucket():
+    buckets = set(dedup.lsh_buckets(dedup.minhash_signature(RECIPE)))
+
+    assert buckets & set(dedup.lsh_buckets(dedup.minhash_signature(RESCANNED)))
+    assert not buckets & set(dedup.lsh_buckets(dedup.minhash_signature(OTHER_RECIPE)))
+
+
+def test_lsh_has_one_bucket_per_band():
+    buckets = dedup.lsh_buckets(dedup.minhash_signature(RECIPE))
+
+    assert [band for band, bucket in buckets] == list(range(dedup.LSH_BANDS))
+
+
+def test_text_duplicate_resolves_to_the_canonical_recipe():
+    signature = dedup.minhash_signature(RECIPE)
+    candidate = mock.Mock(recipe_id=2, minhash=dedup.minhash_signature(RESCANNED))
+    canonical = Recipe(id=1)
+    linked = Recipe(id=2, duplicate_of=1)
+    recipes = {1: canonical, 2: linked}
+
+    with mock.patch.object(dedup, "db") as db:
+        db.session.query.return_value.join.return_value.filter.return_value.distinct.return_value.all.return_value = [
+            candidate]
+        db.session.get.side_effect = lambda model, recipe_id: recipes[recipe_id]
+
+        assert dedup.find_text_duplicate(signature) is canonical
+
+
+def test_no_text_duplicate_below_threshold():
+    candidate = mock.Mock(recipe_id=3, minhash=dedup.minhash_signature(OTHER_RECIPE))
+
+    with mock.patch.object(dedup, "db") as db:
+        db.session.query.return_value.join.return_value.filter.return_value.distinct.return_value.all.return_value = [
+            candidate]
+
+        assert dedup.find_text_duplicate(dedup.minhash_signature(RECIPE)) is None
+
+
+@pytest.fixture
+def database():
+    """Recipe and embedding tables in the postgres database at TEST_DATABASE_URL."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+    tables = [Recipe.__table__, DescriptionEmbeddings.__table__, IngredientsEmbeddings.__table__]
+    with app.app_context():
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        db.session.commit()
+        db.metadata.drop_all(db.engine, tables=tables)
+        db.metadata.create_all(db.engine, tables=tables)
+        yield db.session
+        db.session.remove()
+        db.metadata.drop_all(db.engine, tables=tables)
+
+
+def unit(*values):
+    return list(values) + [0.0] * (EMBEDDING_DIMENSIONS - len(values))
+
+
+def test_cluster_apply_relinks_submissions_linked_to_a_duplicate(database):
+    database.add_all([Recipe(id=1), Recipe(id=2), Recipe(id=3, duplicate_of=2), Recipe(id=4)])
+    database.flush()
+    database.add_all([DescriptionEmbeddings(recipe_id=1, embeddings=unit(1.0)),
+                      DescriptionEmbeddings(recipe_id=2, embeddings=unit(0.999, 0.04)),
+                      DescriptionEmbeddings(recipe_id=4, embeddings=unit(0.0, 1.0))])
+    database.commit()
+
+    with mock.patch.object(dedup, "sync_local_index") as sync:
+        assert dedup.cluster_existing_duplicates(apply=True) == [[1, 2]]
+
+    sync.assert_called_once_with(recipe_ids=[2])
+    database.expire_all()
+    assert database.get(Recipe, 2).duplicate_of == 1
+    assert database.get(Recipe, 3).duplicate_of == 1
+    assert dedup.canonical_recipe(database.get(Recipe, 3)).id == 1
+    # what delete_recipe runs for the canonical recipe, an old link left on 3 would violate the foreign key
+    database.execute(text("DELETE FROM recipe WHERE duplicate_of = 1;"))
+    database.commit()
+
+
+def test_cluster_without_apply_changes_nothing(database):
+    database.add_all([Recipe(id=1), Recipe(id=2)])
+    database.flush()
+    database.add_all([DescriptionEmbeddings(recipe_id=1, embeddings=unit(1.0)),
+                      DescriptionEmbeddings(recipe_id=2, embeddings=unit(1.0))])
+    database.commit()
+
+    assert dedup.cluster_existing_duplicates() == [[1, 2]]
+    assert database.get(Recipe, 2).duplicate_of is None
@@ -0,0 +1,71 @@
+from agents.extraction import FIELD_SIGNALS, fields_affected_by_pages
+
+TITLE_PAGE = """Weeknight Lasagne
+By Marcella Rossi
+
+Ingredients
+2 cups ricotta
+1 lb ground beef
+3 cloves garlic
+Serves 6
+"""
+
+STEPS_PAGE = """Method
+1. Preheat the oven to 375F.
+2. Brown the beef in a skillet, then add the garlic.
+3. Layer the noodles and bake for 45 minutes.
+Cook time: 45 minutes
+"""
+
+EDITED_STEPS_PAGE = STEPS_PAGE.replace("375F", "400F")
+
+STORY_PAGE = """My grandmother would add a little of everything from the garden and cook it for hours.
+She made this dish by heart, and we always ate it from the same chipped bowl.
+"""
+
+
+def affected(old_pages, new_pages):
+    texts = {f"md5-{name}": page for name, page in {**old_pages, **new_pages}.items()}
+    return fields_affected_by_pages([f"md5-{name}" for name in old_pages], [f"md5-{name}" for name in new_pages],
+                                    texts)
+
+
+def test_unchanged_pages_affect_nothing():
+    assert affected({"title": TITLE_PAGE, "steps": STEPS_PAGE}, {"title": TITLE_PAGE, "steps": STEPS_PAGE}) == []
+
+
+def test_editing_the_steps_page_reextracts_a_subset():
+    fields = affected({"title": TITLE_PAGE, "steps": STEPS_PAGE}, {"title": TITLE_PAGE, "edited": EDITED_STEPS_PAGE})
+
+    assert {"steps", "equipment", "time", "description"} <= set(fields)
+    assert not {"ingredients", "servings", "title", "author"} & set(fields)
+
+
+def test_replacing_the_first_page_reextracts_title_and_author():
+    edited = TITLE_PAGE.replace("2 cups ricotta", "500 g ricotta")
+    fields = affected({"title": TITLE_PAGE, "steps": STEPS_PAGE}, {"edited": edited, "steps": STEPS_PAGE})
+
+    assert {"title", "author", "ingredients", "servings"} <= set(fields)
+    assert "steps" not in fields
+
+
+def test_reordering_pages_reextracts_steps():
+    fields = affected({"title": TITLE_PAGE, "steps": STEPS_PAGE, "story": STORY_PAGE},
+                      {"title": TITLE_PAGE, "story": STORY_PAGE, "steps": STEPS_PAGE})
+
+    assert "steps" in fields
+    assert "ingredients" not in fields
+
+
+def test_common_words_in_prose_are_not_signals():
+    assert [field for field, signal in FIELD_SIGNALS.items() if signal.search(STORY_PAGE)] == []
+
+
+def test_signals_match_the_shape_of_their_field():
+    assert FIELD_SIGNALS["ingredients"].search("- 200g flour")
+    assert FIELD_SIGNALS["ingredients"].search("1 ½ tbsp olive oil")
+    assert FIELD_SIGNALS["steps"].search("intro\n  Step 2: Whisk the eggs")
+    assert FIELD_SIGNALS["servings"].search("Makes about 24 cookies")
+    assert FIELD_SIGNALS["time"].search("Prep time: 15 mins")
+    assert FIELD_SIGNALS["author"].search("Adapted from Julia Child")
+    assert not FIELD_SIGNALS["author"].search("a recipe passed down by word of mouth")
@@ -0,0 +1,117 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+import metrics
+from agents import hedging
+from agents.hedging import Hedger
+from agents.limits import DeadlineExceededError, deadline, remaining
+
+
+@pytest.fixture(autouse=True)
+def short_delay():
+    with mock.patch.object(hedging, "HEDGE_DEFAULT_DELAY", 0.05):
+        yield
+
+
+def slow_then_fast(slow=1.0):
+    """The first call takes slow seconds, later ones answer at once."""
+    calls = []
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            calls.append(None)
+            first = len(calls) == 1
+        if first:
+            time.sleep(slow)
+            return "first"
+        return "hedge"
+
+    fn.calls = calls
+    return fn
+
+
+def test_unhedged_call_runs_once_in_the_caller():
+    caller = threading.current_thread()
+    fn = mock.Mock(side_effect=lambda: threading.current_thread())
+
+    assert Hedger("test").call(fn, hedge=False) is caller
+    fn.assert_called_once()
+
+
+def test_hedge_wins_when_the_first_request_is_slow():
+    hedger = Hedger("hedge-wins")
+    fn = slow_then_fast()
+    wins = metrics.get("hedge.hedge-wins.wins")
+
+    assert hedger.call(fn, hedge=True) == "hedge"
+    assert len(fn.calls) == 2
+    assert metrics.get("hedge.hedge-wins.wins") == wins + 1
+    assert hedger.rate() == 1.0
+
+
+def test_fast_first_request_is_not_hedged():
+    hedger = Hedger("test")
+    fn = mock.Mock(return_value="first")
+
+    assert hedger.call(fn, hedge=True) == "first"
+    fn.assert_called_once()
+    assert hedger.rate() == 0.0
+
+
+def test_hedging_stops_at_the_max_rate():
+    hedger = Hedger("test")
+    hedger._hedged.extend([True] * 10)
+    fn = slow_then_fast(slow=0.2)
+
+    assert hedger.call(fn, hedge=True) == "first"
+    assert len(fn.calls) == 1
+
+
+def test_delay_is_the_latency_percentile_once_there_are_enough_samples():
+    hedger = Hedger("test")
+    assert hedger.delay() == hedging.HEDGE_DEFAULT_DELAY
+
+    hedger._latencies.extend([0.1] * 99 + [5.0])
+    assert hedger.delay() == pytest.approx(0.1, abs=0.1)
+
+
+def test_deadline_already_passed_raises_before_calling():
+    fn = mock.Mock()
+
+    with deadline(0), pytest.raises(DeadlineExceededError):
+        Hedger("test").call(fn, hedge=True)
+    fn.assert_not_called()
+
+
+def test_deadline_passing_while_waiting_raises():
+    with deadline(0.2), pytest.raises(DeadlineExceededError):
+        Hedger("test").call(lambda: time.sleep(1), hedge=True)
+
+
+def test_requests_see_the_callers_deadline():
+    seen = []
+
+    def fn():
+        seen.append(remaining())
+        return "ok"
+
+    with deadline(5):
+        Hedger("test").call(fn, hedge=True)
+    assert seen and 0 < seen[0] <= 5
+
+
+def test_error_is_raised_when_every_request_fails():
+    def fn():
+        time.sleep(0.1)
+        raise ValueError("bad")
+
+    with pytest.raises(ValueError):
+        Hedger("test").call(fn, hedge=True)
+
+
+def test_hedger_registry_shares_one_hedger_per_name():
+    assert hedging.hedger("registry-test") is hedging.hedger("registry-test")
@@ -0,0 +1,125 @@
+import os
+from unittest import mock
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from api.v1 import ingestion
+from data.models import db, IngestionJob, IngestionJobItem, Recipe
+
+
+def job_item(status="queued", attempts=1, position=0):
+    return IngestionJobItem(position=position, status=status, filenames=["page.png"], pages=[b"page"],
+                            attempts=attempts)
+
+
+@pytest.fixture
+def session():
+    with mock.patch.object(ingestion, "db") as fake_db:
+        yield fake_db.session
+
+
+def test_failed_attempt_with_attempts_left_is_requeued(session):
+    item = job_item(status="running", attempts=1)
+
+    ingestion.retry_or_fail(item, RuntimeError("ocr timed out"))
+
+    assert item.status == "queued"
+    assert item.error == "ocr timed out"
+    assert item.pages == [b"page"]
+    session.commit.assert_called_once()
+
+
+def test_failed_last_attempt_fails_the_item(session):
+    item = job_item(status="running", attempts=ingestion.INGESTION_MAX_ATTEMPTS)
+
+    ingestion.retry_or_fail(item, RuntimeError("ocr timed out"))
+
+    assert item.status == "failed"
+    assert item.error == "ocr timed out"
+    assert item.pages is None
+    assert item.finished_at is not None
+
+
+@pytest.mark.parametrize("statuses, expected", [
+    (["queued", "queued"], "queued"),
+    (["running", "queued"], "running"),
+    (["completed", "queued"], "running"),
+    (["completed", "duplicate", "failed"], "completed"),
+])
+def test_job_status_follows_its_items(statuses, expected):
+    job = IngestionJob(items=[job_item(status=status, position=position)
+                              for position, status in enumerate(statuses)])
+
+    assert job.to_dict()["status"] == expected
+
+
+@pytest.fixture
+def database():
+    """Tables the claim query touches, in the postgres database at TEST_DATABASE_URL."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+    tables = [Recipe.__table__, IngestionJob.__table__, IngestionJobItem.__table__]
+    with app.app_context():
+        db.metadata.drop_all(db.engine, tables=tables)
+        db.metadata.create_all(db.engine, tables=tables)
+        yield db.session
+        db.session.remove()
+        db.metadata.drop_all(db.engine, tables=tables)
+
+
+def add_items(session, *items):
+    job = IngestionJob(items=list(items))
+    session.add(job)
+    session.commit()
+    return job
+
+
+def started(session, item, seconds_ago):
+    # by the database clock, which is what the claim query compares against
+    session.execute(text("UPDATE ingestion_job_item SET started_at = NOW() - make_interval(secs => :ago) "
+                         "WHERE id = :id;"), {"ago": seconds_ago, "id": item.id})
+    session.commit()
+
+
+def test_claim_takes_the_oldest_queued_item(database):
+    job = add_items(database, job_item(attempts=0), job_item(attempts=0, position=1))
+
+    item = ingestion.claim_next_item()
+
+    assert item.id == job.items[0].id
+    assert item.status == "running"
+    assert item.attempts == 1
+
+
+def test_claim_skips_items_running_in_live_workers(database):
+    job = add_items(database, job_item(status="running", attempts=1))
+    started(database, job.items[0], 0)
+
+    assert ingestion.claim_next_item() is None
+
+
+def test_claim_retakes_stale_items_with_attempts_left(database):
+    job = add_items(database, job_item(status="running", attempts=1))
+    started(database, job.items[0], ingestion.INGESTION_STALE_SECONDS + 60)
+
+    item = ingestion.claim_next_item()
+
+    assert item.id == job.items[0].id
+    assert item.attempts == 2
+
+
+def test_claim_fails_stale_items_out_of_attempts(database):
+    job = add_items(database, job_item(status="running", attempts=ingestion.INGESTION_MAX_ATTEMPTS))
+    started(database, job.items[0], ingestion.INGESTION_STALE_SECONDS + 60)
+
+    assert ingestion.claim_next_item() is None
+    database.expire_all()
+    assert job.items[0].status == "failed"
+    assert "worker stopped" in job.items[0].error
+    assert job.to_dict()["status"] == "completed"
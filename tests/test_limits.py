@@ -0,0 +1,183 @@
+import threading
+import time
+from unittest import mock
+
+import httpx
+import openai
+import pytest
+import requests
+
+from agents import limits
+from agents.limits import AdaptiveLimiter, DeadlineExceededError, ProviderError, RateLimitedError, deadline, remaining
+
+
+def api_error(status, headers=None):
+    response = httpx.Response(status, headers=headers or {}, request=httpx.Request("POST", "https://api.test"))
+    error = {429: openai.RateLimitError, 400: openai.BadRequestError}.get(status, openai.InternalServerError)
+    return error("error", response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def no_sleep():
+    with mock.patch.object(limits.time, "sleep") as sleep:
+        yield sleep
+
+
+@pytest.mark.parametrize("value, seconds", [("20ms", 0.02), ("1s", 1), ("6m0s", 360), ("1h2m", 3720)])
+def test_parse_duration(value, seconds):
+    assert limits.parse_duration(value) == pytest.approx(seconds)
+
+
+def test_parse_duration_of_nothing():
+    assert limits.parse_duration("") is None
+
+
+def test_retry_after_prefers_milliseconds():
+    assert limits.retry_after({"retry-after-ms": "250", "retry-after": "3"}) == 0.25
+    assert limits.retry_after({"retry-after": "3"}) == 3
+    assert limits.retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+    assert limits.retry_after(None) is None
+
+
+def test_classify():
+    assert limits.classify(api_error(429))[:2] == (True, True)
+    assert limits.classify(api_error(500))[:2] == (True, False)
+    assert limits.classify(api_error(400))[:2] == (False, False)
+    assert limits.classify(requests.ConnectionError())[:2] == (True, False)
+    assert limits.classify(ValueError())[:2] == (False, False)
+
+
+def test_success_raises_the_limit_additively():
+    limiter = AdaptiveLimiter("test", initial=4)
+    limiter.acquire()
+    limiter.release()
+
+    assert limiter.limit == pytest.approx(4.25)
+
+
+def test_throttle_halves_the_limit_down_to_one():
+    limiter = AdaptiveLimiter("test", initial=4)
+    for expected in (2, 1, 1):
+        limiter.acquire()
+        limiter.release(outcome="throttled")
+        assert limiter.limit == expected
+
+
+def test_limit_is_capped_at_maximum():
+    limiter = AdaptiveLimiter("test", initial=2, maximum=2)
+    limiter.acquire()
+    limiter.release()
+
+    assert limiter.limit == 2
+
+
+def test_retry_after_on_429_pauses_new_calls():
+    limiter = AdaptiveLimiter("test")
+    limiter.acquire()
+    limiter.release({"retry-after": "5"}, outcome="throttled")
+
+    assert limiter.paused_until == pytest.approx(time.monotonic() + 5, abs=0.5)
+
+
+def test_exhausted_rate_limit_headers_pause_new_calls():
+    limiter = AdaptiveLimiter("test")
+    limiter.acquire()
+    limiter.release({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s",
+                     "x-ratelimit-remaining-tokens": "100", "x-ratelimit-reset-tokens": "30s"})
+
+    assert limiter.paused_until == pytest.approx(time.monotonic() + 2, abs=0.5)
+
+
+def test_acquire_waits_for_a_free_slot():
+    limiter = AdaptiveLimiter("test", initial=1)
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def second():
+        limiter.acquire()
+        acquired.set()
+
+    threading.Thread(target=second).start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(1)
+
+
+def test_acquire_gives_up_as_rate_limited():
+    limiter = AdaptiveLimiter("test", initial=1)
+    limiter.acquire()
+
+    with pytest.raises(RateLimitedError):
+        limiter.acquire(timeout=0.05)
+
+
+def test_call_retries_retryable_errors():
+    limiter = AdaptiveLimiter("test")
+    fn = mock.Mock(side_effect=[api_error(500), api_error(429), ("ok", {})])
+
+    assert limiter.call(fn, attempts=3) == "ok"
+    assert fn.call_count == 3
+    assert limiter.in_flight == 0
+
+
+def test_call_waits_the_retry_after_the_provider_asked_for(no_sleep):
+    limiter = AdaptiveLimiter("test")
+    fn = mock.Mock(side_effect=[api_error(429, {"retry-after-ms": "100"}), ("ok", {})])
+
+    limiter.call(fn, attempts=2)
+
+    no_sleep.assert_called_once_with(0.1)
+
+
+def test_call_raises_rate_limited_after_the_last_attempt():
+    limiter = AdaptiveLimiter("test")
+
+    with pytest.raises(RateLimitedError):
+        limiter.call(mock.Mock(side_effect=api_error(429)), attempts=2)
+    assert limiter.in_flight == 0
+
+
+def test_call_raises_provider_error_for_server_errors():
+    with pytest.raises(ProviderError) as raised:
+        AdaptiveLimiter("test").call(mock.Mock(side_effect=api_error(503)), attempts=2)
+    assert type(raised.value) is ProviderError
+
+
+def test_call_does_not_retry_bad_requests():
+    fn = mock.Mock(side_effect=api_error(400))
+
+    with pytest.raises(openai.BadRequestError):
+        AdaptiveLimiter("test").call(fn, attempts=3)
+    assert fn.call_count == 1
+
+
+def test_call_stops_retrying_when_the_backoff_would_pass_the_deadline():
+    fn = mock.Mock(side_effect=api_error(429, {"retry-after": "10"}))
+
+    with deadline(1), pytest.raises(DeadlineExceededError):
+        AdaptiveLimiter("test").call(fn, attempts=3)
+    assert fn.call_count == 1
+
+
+def test_acquire_gives_up_at_the_deadline():
+    limiter = AdaptiveLimiter("test", initial=1)
+    limiter.acquire()
+
+    with deadline(0.05), pytest.raises(DeadlineExceededError):
+        limiter.acquire()
+
+
+def test_nested_deadlines_only_shorten():
+    assert remaining() is None
+    with deadline(10):
+        with deadline(60):
+            assert remaining() <= 10
+        with deadline(1):
+            assert remaining() <= 1
+        with deadline(None):
+            assert 1 < remaining() <= 10
+    assert remaining() is None
+
+
+def test_limiter_registry_shares_one_limiter_per_name():
+    assert limits.limiter("registry-test") is limits.limiter("registry-test")
@@ -0,0 +1,226 @@
+import os
+import threading
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from data import localIndex
+from data.localIndex import LocalVectorIndex
+from data.models import db, DescriptionEmbeddings, EMBEDDING_DIMENSIONS, IngredientsEmbeddings, Recipe
+
+DIMENSIONS = 8
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    with mock.patch.object(localIndex, "LOCAL_INDEX_DIR", str(tmp_path)), \
+            mock.patch.object(localIndex, "LOCAL_INDEX_DTYPE", np.dtype("float32")), \
+            mock.patch.object(localIndex, "EMBEDDING_DIMENSIONS", DIMENSIONS):
+        yield tmp_path
+
+
+def append(rows, field="description"):
+    """rows of (recipe_id, vector), written the way a sync appends them."""
+    existing = len(localIndex._read_ids(f"{field}.rows"))
+    with localIndex._Lock():
+        localIndex._append(field, [SimpleNamespace(id=existing + i + 1, recipe_id=recipe_id, embeddings=vector)
+                                   for i, (recipe_id, vector) in enumerate(rows)], np.float32)
+
+
+def tombstone(*recipe_ids):
+    with open(os.path.join(localIndex.LOCAL_INDEX_DIR, "deleted.ids"), "ab") as deleted_file:
+        np.array(recipe_ids, dtype=np.int64).tofile(deleted_file)
+
+
+def test_search_matches_an_exact_scan(index_dir):
+    vectors = np.random.RandomState(0).standard_normal((300, DIMENSIONS)).astype(np.float32)
+    append(list(enumerate(vectors, start=1)))
+    query = np.random.RandomState(1).standard_normal(DIMENSIONS).astype(np.float32)
+
+    exact = (np.argsort(((vectors - query) ** 2).sum(axis=1))[:10] + 1).tolist()
+
+    assert LocalVectorIndex("description").search(query, k=10) == exact
+
+
+def test_search_over_several_blocks(index_dir):
+    vectors = np.random.RandomState(0).standard_normal((50, DIMENSIONS)).astype(np.float32)
+    append(list(enumerate(vectors, start=1)))
+    query = vectors[37]
+
+    with mock.patch.object(localIndex, "SEARCH_BLOCK_ROWS", 16):
+        assert LocalVectorIndex("description").search(query, k=1) == [38]
+
+
+def test_tombstoned_recipes_are_not_returned(index_dir):
+    append([(1, np.eye(DIMENSIONS)[0]), (2, np.eye(DIMENSIONS)[1])])
+    index = LocalVectorIndex("description")
+    assert index.search(np.eye(DIMENSIONS)[0], k=2) == [1, 2]
+
+    tombstone(1)
+
+    assert index.search(np.eye(DIMENSIONS)[0], k=2) == [2]
+
+
+def test_newest_row_for_a_recipe_wins(index_dir):
+    append([(1, np.eye(DIMENSIONS)[0]), (2, 0.9 * np.eye(DIMENSIONS)[0])])
+    append([(1, np.eye(DIMENSIONS)[2])])
+
+    index = LocalVectorIndex("description")
+
+    # recipe 1's first row would be the exact match, only its replacement counts
+    assert index.search(np.eye(DIMENSIONS)[0], k=5) == [2, 1]
+    assert index.search(np.eye(DIMENSIONS)[2], k=1) == [1]
+
+
+def test_append_only_refresh_reuses_the_computed_norms(index_dir):
+    append([(1, np.eye(DIMENSIONS)[0]), (2, np.eye(DIMENSIONS)[1])])
+    index = LocalVectorIndex("description")
+    index.search(np.eye(DIMENSIONS)[0])
+    # a norm the refresh would only keep if it didn't recompute it
+    index._norms[0] = 123.0
+
+    append([(3, 2 * np.eye(DIMENSIONS)[2])])
+    index.search(np.eye(DIMENSIONS)[0])
+
+    assert index._norms.tolist() == [123.0, 1.0, 4.0]
+
+
+def test_replaced_files_recompute_the_norms(index_dir):
+    append([(1, np.eye(DIMENSIONS)[0])])
+    index = LocalVectorIndex("description")
+    index.search(np.eye(DIMENSIONS)[0])
+    index._norms[0] = 123.0
+
+    for name in ("vectors", "rows", "ids"):
+        os.remove(index_dir / f"description.{name}")
+    append([(1, np.eye(DIMENSIONS)[0])])
+    index.search(np.eye(DIMENSIONS)[0])
+
+    assert index._norms.tolist() == [1.0]
+
+
+@pytest.mark.parametrize("files", [(), ("description.vectors", "description.ids")])
+def test_missing_or_empty_files_are_an_empty_index(index_dir, files):
+    for name in files:
+        open(index_dir / name, "wb").close()
+
+    assert LocalVectorIndex("description").search(np.eye(DIMENSIONS)[0]) == []
+
+
+def test_refresh_waits_for_an_export_in_progress(index_dir):
+    append([(1, np.eye(DIMENSIONS)[0])])
+    results = []
+
+    with localIndex._Lock():
+        reader = threading.Thread(target=lambda: results.append(
+            LocalVectorIndex("description").search(np.eye(DIMENSIONS)[0])))
+        reader.start()
+        reader.join(0.2)
+        assert reader.is_alive()
+    reader.join(1)
+
+    assert results == [[1]]
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Recipe and embedding tables in the postgres database at TEST_DATABASE_URL, and an empty index dir."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+    tables = [Recipe.__table__, DescriptionEmbeddings.__table__, IngredientsEmbeddings.__table__]
+    with app.app_context(), mock.patch.object(localIndex, "LOCAL_INDEX_DIR", str(tmp_path)):
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        db.session.commit()
+        db.metadata.drop_all(db.engine, tables=tables)
+        db.metadata.create_all(db.engine, tables=tables)
+        yield db.session
+        db.session.remove()
+        db.metadata.drop_all(db.engine, tables=tables)
+
+
+def unit(axis):
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    vector[axis] = 1.0
+    return vector
+
+
+def save(session, recipe_id, axis):
+    session.add(Recipe(id=recipe_id))
+    session.flush()
+    session.add_all([DescriptionEmbeddings(recipe_id=recipe_id, embeddings=unit(axis)),
+                     IngredientsEmbeddings(recipe_id=recipe_id, embeddings=unit(axis))])
+    session.commit()
+
+
+def test_sync_picks_up_recipes_saved_elsewhere(database):
+    save(database, 1, 0)
+    localIndex.export_local_index()
+    index = LocalVectorIndex("description")
+    assert index.search(unit(1)) == [1]
+
+    # saved through another replica, which only wrote its own host's files
+    save(database, 2, 1)
+    localIndex.sync_local_index()
+
+    assert index.search(unit(1)) == [2, 1]
+
+
+def test_sync_tombstones_recipes_deleted_elsewhere(database):
+    save(database, 1, 0)
+    save(database, 2, 1)
+    localIndex.export_local_index()
+    index = LocalVectorIndex("description")
+
+    database.execute(text("DELETE FROM description_embeddings WHERE recipe_id = 1;"))
+    database.execute(text("DELETE FROM ingredients_embeddings WHERE recipe_id = 1;"))
+    database.execute(text("DELETE FROM recipe WHERE id = 1;"))
+    database.commit()
+    localIndex.sync_local_index()
+
+    assert index.search(unit(0)) == [2]
+
+
+def test_sync_replaces_re_extracted_embeddings(database):
+    save(database, 1, 0)
+    save(database, 2, 1)
+    localIndex.export_local_index()
+    index = LocalVectorIndex("description")
+
+    DescriptionEmbeddings.query.filter_by(recipe_id=1).delete()
+    database.add(DescriptionEmbeddings(recipe_id=1, embeddings=unit(2)))
+    database.commit()
+    localIndex.sync_local_index()
+
+    assert index.search(unit(2), k=1) == [1]
+    assert index.search(unit(1), k=2) == [2, 1]
+
+
+def test_sync_appends_each_row_once(database):
+    save(database, 1, 0)
+    localIndex.export_local_index()
+    save(database, 2, 1)
+
+    localIndex.sync_local_index()
+    localIndex.sync_local_index(recipe_ids=[2])
+
+    assert localIndex._read_ids("description.ids").tolist() == [1, 2]
+    assert localIndex._read_ids("deleted.ids").tolist() == []
+
+
+def test_sync_of_some_recipes_leaves_the_rest_alone(database):
+    save(database, 1, 0)
+    localIndex.export_local_index()
+    save(database, 2, 1)
+    save(database, 3, 2)
+
+    localIndex.sync_local_index(recipe_ids=[2])
+
+    assert localIndex._read_ids("description.ids").tolist() == [1, 2]
@@ -0,0 +1,170 @@
+import os
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+from agents import baseAgent
+from agents.cache import NarrationCache
+
+CHUNKS = [b"a" * 100, b"b" * 100, b"c" * 100]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return NarrationCache(directory=str(tmp_path), max_bytes=1000, mirror=False)
+
+
+def store(cache, key, chunks=CHUNKS):
+    return b"".join(cache.store(key, iter(chunks)))
+
+
+def test_key_depends_on_text_voice_model_and_settings():
+    key = NarrationCache.key("hello", "voice", "model", {"stability": 0.5, "similarity_boost": 0.5})
+
+    assert key == NarrationCache.key("hello", "voice", "model", {"similarity_boost": 0.5, "stability": 0.5})
+    assert key != NarrationCache.key("hello", "other", "model", {"stability": 0.5, "similarity_boost": 0.5})
+    assert key != NarrationCache.key("hello", "voice", "model", {"stability": 0.9, "similarity_boost": 0.5})
+    assert key != NarrationCache.key("goodbye", "voice", "model", {"stability": 0.5, "similarity_boost": 0.5})
+
+
+def test_store_passes_chunks_through_and_caches_them(cache):
+    assert store(cache, "k") == b"".join(CHUNKS)
+
+    with cache.get("k") as file:
+        assert file.read() == b"".join(CHUNKS)
+    assert os.listdir(cache.directory) == ["k.mp3"]
+
+
+def test_abandoned_stream_leaves_no_entry(cache):
+    chunks = cache.store("k", iter(CHUNKS))
+    next(chunks)
+    chunks.close()
+
+    assert cache.get("k") is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_failed_stream_leaves_no_entry(cache):
+    def failing():
+        yield CHUNKS[0]
+        raise ConnectionError("provider went away")
+
+    with pytest.raises(ConnectionError):
+        b"".join(cache.store("k", failing()))
+
+    assert cache.get("k") is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_miss_returns_none(cache):
+    assert cache.get("missing") is None
+
+
+def test_eviction_removes_least_recently_used_first(cache):
+    for key in ("old", "used", "new"):
+        store(cache, key, [b"x" * 400])
+        os.utime(cache.path(key), (0, {"old": 1, "used": 2, "new": 3}[key]))
+    cache.get("used").close()
+
+    cache.evict()
+
+    assert sorted(os.listdir(cache.directory)) == ["new.mp3", "used.mp3"]
+
+
+def test_storing_past_max_bytes_evicts(cache):
+    for i in range(5):
+        store(cache, f"k{i}", [b"x" * 300])
+        if os.path.exists(cache.path(f"k{i}")):
+            os.utime(cache.path(f"k{i}"), (0, i + 1))
+
+    kept = sorted(os.listdir(cache.directory))
+    assert kept == ["k2.mp3", "k3.mp3", "k4.mp3"]
+
+
+def test_hit_survives_eviction_once_opened(cache):
+    store(cache, "k")
+    file = cache.get("k")
+    os.remove(cache.path("k"))
+
+    with file:
+        assert file.read() == b"".join(CHUNKS)
+
+
+class FakeResponse:
+    def __init__(self):
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        yield from CHUNKS
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def agent_cache(cache):
+    with mock.patch.object(baseAgent, "narration_cache", cache):
+        yield cache
+
+
+def test_narrate_caches_a_miss_and_serves_the_hit(agent_cache):
+    response = FakeResponse()
+    agent = baseAgent.Agent()
+    with mock.patch.object(baseAgent.Agent, "text_to_speech", return_value=response) as tts:
+        key, file, chunks = agent.narrate("hello")
+        assert file is None
+        assert b"".join(chunks) == b"".join(CHUNKS)
+        chunks.close()
+
+        hit_key, file, chunks = agent.narrate("hello")
+
+    assert hit_key == key and chunks is None
+    with file:
+        assert file.read() == b"".join(CHUNKS)
+    tts.assert_called_once()
+    assert response.closed
+
+
+def test_narration_closed_before_it_starts_closes_the_provider_response(agent_cache):
+    response = FakeResponse()
+    with mock.patch.object(baseAgent.Agent, "text_to_speech", return_value=response):
+        key, file, chunks = baseAgent.Agent().narrate("hello")
+    chunks.close()
+
+    assert response.closed
+    assert os.listdir(agent_cache.directory) == []
+
+
+@pytest.fixture
+def client(cache):
+    from api.v1 import routes
+
+    app = Flask(__name__)
+    app.register_blueprint(routes.bp, url_prefix='/v1')
+    with mock.patch.object(routes, "narration_cache", cache):
+        yield app.test_client()
+
+
+def test_cached_narration_supports_range_requests(cache, client):
+    key = "0" * 64
+    store(cache, key)
+
+    response = client.get(f"/v1/narrations/{key}", headers={"Range": "bytes=100-199"})
+
+    assert response.status_code == 206
+    assert response.data == CHUNKS[1]
+    assert response.headers["Content-Range"] == "bytes 100-199/300"
+
+
+def test_cached_narration_answers_conditional_requests(cache, client):
+    key = "0" * 64
+    store(cache, key)
+    etag = client.get(f"/v1/narrations/{key}").headers["ETag"]
+
+    assert client.get(f"/v1/narrations/{key}", headers={"If-None-Match": etag}).status_code == 304
+
+
+@pytest.mark.parametrize("key", ["0" * 64, "not-a-key"])
+def test_unknown_narration_is_not_found(client, key):
+    assert client.get(f"/v1/narrations/{key}").status_code == 404
@@ -0,0 +1,130 @@
+from unittest import mock
+
+import pytest
+
+import metrics
+from agents import cache as cache_module
+from agents.cache import PitchCache
+
+RECIPES = [
+    {"id": 1, "title": "Banana Bread", "description": "A moist loaf for overripe bananas."},
+    {"id": 2, "title": "Chicken Curry", "description": "A weeknight curry with coconut milk."},
+]
+
+VEGETARIAN = [1.0, 0.0, 0.0]
+PARAPHRASED = [0.95, 0.1, 0.0]
+QUICK = [0.0, 1.0, 0.0]
+
+
+@pytest.fixture
+def clock():
+    now = [1000.0]
+    with mock.patch.object(cache_module.time, "monotonic", side_effect=lambda: now[0]):
+        yield now
+
+
+@pytest.fixture
+def cache(clock):
+    return PitchCache(max_size=10, ttl=60, similarity=0.9, per_set=2)
+
+
+def pitch(text="pitch"):
+    return mock.Mock(return_value=text)
+
+
+def test_miss_writes_the_pitch(cache):
+    write = pitch()
+
+    assert cache.get_or_create(RECIPES, VEGETARIAN, write) == "pitch"
+    write.assert_called_once()
+
+
+def test_similar_request_for_the_same_recipes_reuses_the_pitch(cache):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("first"))
+    write = pitch("second")
+
+    assert cache.get_or_create(RECIPES, PARAPHRASED, write) == "first"
+    write.assert_not_called()
+
+
+def test_dissimilar_request_writes_a_new_pitch(cache):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("vegetarian"))
+
+    assert cache.get_or_create(RECIPES, QUICK, pitch("quick")) == "quick"
+    assert cache.get_or_create(RECIPES, VEGETARIAN, pitch()) == "vegetarian"
+    assert cache.get_or_create(RECIPES, QUICK, pitch()) == "quick"
+
+
+def test_recipe_order_does_not_matter(cache):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("first"))
+
+    assert cache.get_or_create(RECIPES[::-1], VEGETARIAN, pitch("second")) == "first"
+
+
+def test_embedding_scale_does_not_matter(cache):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("first"))
+
+    assert cache.get_or_create(RECIPES, [10.0, 0.0, 0.0], pitch("second")) == "first"
+
+
+@pytest.mark.parametrize("field", ["title", "description"])
+def test_edited_recipe_misses(cache, field):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("stale"))
+    edited = [dict(RECIPES[0], **{field: "Edited"}), RECIPES[1]]
+
+    assert cache.get_or_create(edited, VEGETARIAN, pitch("fresh")) == "fresh"
+
+
+def test_different_recipes_miss(cache):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("both"))
+
+    assert cache.get_or_create(RECIPES[:1], VEGETARIAN, pitch("one")) == "one"
+
+
+def test_pitch_expires_after_the_ttl(cache, clock):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("old"))
+    clock[0] += 59
+    assert cache.get_or_create(RECIPES, VEGETARIAN, pitch("new")) == "old"
+
+    clock[0] += 2
+    assert cache.get_or_create(RECIPES, VEGETARIAN, pitch("new")) == "new"
+
+
+def test_expired_pitch_is_dropped_when_a_new_one_is_added(cache, clock):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("vegetarian"))
+    clock[0] += 50
+    cache.get_or_create(RECIPES, QUICK, pitch("quick"))
+    clock[0] += 20
+
+    assert cache.get_or_create(RECIPES, QUICK, pitch()) == "quick"
+    assert cache.get_or_create(RECIPES, VEGETARIAN, pitch("vegetarian again")) == "vegetarian again"
+
+
+def test_only_the_newest_pitches_of_a_set_are_kept(cache):
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch("vegetarian"))
+    cache.get_or_create(RECIPES, QUICK, pitch("quick"))
+    cache.get_or_create(RECIPES, [0.0, 0.0, 1.0], pitch("spicy"))
+
+    assert cache.get_or_create(RECIPES, VEGETARIAN, pitch("rewritten")) == "rewritten"
+
+
+def test_failed_pitch_is_not_cached(cache):
+    with pytest.raises(RuntimeError):
+        cache.get_or_create(RECIPES, VEGETARIAN, mock.Mock(side_effect=RuntimeError("completion failed")))
+
+    assert cache.get_or_create(RECIPES, VEGETARIAN, pitch("retried")) == "retried"
+
+
+def saved():
+    return metrics.snapshot()["timings"].get("pitch_cache.saved", {}).get("count", 0)
+
+
+def test_hits_misses_and_saved_time_are_recorded(cache):
+    hits, misses, saves = metrics.get("pitch_cache.hits"), metrics.get("pitch_cache.misses"), saved()
+
+    cache.get_or_create(RECIPES, VEGETARIAN, pitch())
+    cache.get_or_create(RECIPES, PARAPHRASED, pitch())
+
+    assert metrics.get("pitch_cache.hits") == hits + 1
+    assert metrics.get("pitch_cache.misses") == misses + 1
+    assert saved() == saves + 1
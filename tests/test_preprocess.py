@@ -0,0 +1,90 @@
+import functools
+import io
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from agents import preprocess
+from agents.preprocess import prepare_for_ocr, sniff_mime_type
+
+
+@functools.lru_cache
+def photo(size=(4000, 3000), format="JPEG", orientation=None):
+    """A noisy page, which compresses about as badly as a phone photo of one."""
+    image = Image.merge("RGB", [Image.effect_noise(size, 64)] * 3)
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    out = io.BytesIO()
+    image.save(out, format=format, exif=exif)
+    return out.getvalue()
+
+
+def decoded(content):
+    return Image.open(io.BytesIO(content))
+
+
+def test_photo_is_scaled_to_the_models_resolution():
+    prepared, mime_type = prepare_for_ocr(photo(), grayscale=True)
+
+    assert mime_type == "image/jpeg"
+    assert decoded(prepared).size == (1024, 768)
+    assert decoded(prepared).mode == "L"
+
+
+def test_jpeg_is_decoded_at_a_reduced_scale():
+    resized = []
+    resize = Image.Image.resize
+
+    def spy(image, *args, **kwargs):
+        resized.append((image.size, image.mode))
+        return resize(image, *args, **kwargs)
+
+    with mock.patch.object(Image.Image, "resize", spy):
+        prepare_for_ocr(photo(), grayscale=True)
+
+    assert resized == [((2000, 1500), "L")]
+
+
+def test_exif_orientation_is_applied():
+    prepared, _ = prepare_for_ocr(photo(orientation=6), grayscale=True)
+
+    assert decoded(prepared).size == (768, 1024)
+
+
+def test_page_over_the_pixel_cap_is_sent_as_uploaded():
+    content = photo(size=(3000, 2000), format="PNG")
+
+    with mock.patch.object(preprocess, "OCR_MAX_DECODE_PIXELS", 5_000_000):
+        assert prepare_for_ocr(content) == (content, "image/png")
+
+
+def test_jpeg_under_the_cap_once_reduced_is_still_prepared():
+    with mock.patch.object(preprocess, "OCR_MAX_DECODE_PIXELS", 3_000_000):
+        prepared, _ = prepare_for_ocr(photo())
+
+    assert decoded(prepared).size == (1024, 768)
+
+
+def test_small_upright_jpeg_is_sent_as_uploaded():
+    content = photo(size=(600, 400))
+
+    assert prepare_for_ocr(content, grayscale=False) == (content, "image/jpeg")
+
+
+@pytest.mark.parametrize("content, mime_type", [
+    (b"\xff\xd8\xff\xe0rest", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\nrest", "image/png"),
+    (b"RIFF\x00\x00\x00\x00WEBPVP8 ", "image/webp"),
+    (b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00", "image/heic"),
+    (b"not an image", "application/octet-stream"),
+])
+def test_sniff_mime_type(content, mime_type):
+    assert sniff_mime_type(content) == mime_type
+
+
+def test_undecodable_page_is_sent_as_uploaded_with_its_real_type():
+    content = b"\x00\x00\x00\x18ftypheic" + b"\x00" * 64
+
+    assert prepare_for_ocr(content) == (content, "image/heic")
@@ -0,0 +1,123 @@
+import os
+from unittest import mock
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from api.v1 import routes
+from data import search
+from data.models import db, embedding_column_statements, DescriptionEmbeddings, EMBEDDING_DIMENSIONS, \
+    IngredientsEmbeddings, Recipe
+from data.search import nearest_recipes
+
+HALFVEC_TYPE = f"halfvec({EMBEDDING_DIMENSIONS})"
+
+
+@pytest.fixture
+def database():
+    """Recipe and embedding tables with hnsw indexes, in the postgres database at TEST_DATABASE_URL."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+    tables = [Recipe.__table__, DescriptionEmbeddings.__table__, IngredientsEmbeddings.__table__]
+    with app.app_context():
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        db.session.commit()
+        if db.session.execute(text("SELECT to_regtype('halfvec');")).scalar() is None:
+            pytest.skip("pgvector is older than 0.7 and can't index 3072 dimensions")
+        db.metadata.drop_all(db.engine, tables=tables)
+        db.metadata.create_all(db.engine, tables=tables)
+        with db.engine.begin() as connection:
+            for table in ("description_embeddings", "ingredients_embeddings"):
+                for statement in embedding_column_statements(table, storage="halfvec"):
+                    connection.execute(text(statement))
+        yield db.session
+        db.session.remove()
+        db.metadata.drop_all(db.engine, tables=tables)
+
+
+def plan(session, sql, params):
+    # an empty table is cheapest to scan, so rule sequential scans out to see whether the index is usable at all
+    session.execute(text("SET LOCAL enable_seqscan = off;"))
+    rows = session.execute(text(f"EXPLAIN {sql.text}"), {**params, "embeddings": [0.0] * EMBEDDING_DIMENSIONS})
+    return "\n".join(row[0] for row in rows)
+
+
+@pytest.mark.parametrize("field", ["combined", "max_sim"])
+def test_multi_vector_candidates_come_from_each_tables_index(database, field):
+    with mock.patch.object(search, "VECTOR_TYPE", HALFVEC_TYPE):
+        sql, params = search.recipe_search_query("exact", field=field)
+
+    explained = plan(database, sql, params)
+
+    assert "Index Scan using description_embeddings_embeddings_hnsw" in explained
+    assert "Index Scan using ingredients_embeddings_embeddings_hnsw" in explained
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(routes.bp, url_prefix='/v1')
+    with mock.patch.object(routes, "get_nearest_recipes", return_value=[]) as nearest:
+        client = app.test_client()
+        client.nearest = nearest
+        yield client
+
+
+@pytest.mark.parametrize("arg", ["lexical_limit=-1", "vector_limit=0", "vector_limit=ten", "lexical_limit=1001",
+                                 "lexical_weight=-0.5", "vector_weight=nan", "vector_weight=inf",
+                                 "ingredients_weight=2", "candidates=many"])
+def test_out_of_range_search_overrides_are_rejected(client, arg):
+    response = client.get(f"/v1/?query=soup&mode=hybrid&{arg}")
+
+    assert response.status_code == 400
+    assert arg.split("=")[0] in response.json["error"]
+    client.nearest.assert_not_called()
+
+
+def test_search_overrides_are_passed_through(client):
+    response = client.get("/v1/?query=soup&mode=hybrid&lexical_weight=0.5&vector_limit=20")
+
+    assert response.status_code == 200
+    kwargs = client.nearest.call_args.kwargs
+    assert kwargs["hybrid"] == {"lexical_weight": 0.5, "vector_weight": None, "lexical_limit": None,
+                                "vector_limit": 20}
+    assert kwargs["candidate_multiplier"] is None and kwargs["ingredients_weight"] is None
+
+
+@pytest.fixture
+def recipes():
+    """Recipe and embedding tables in the configured storage, in the postgres database at TEST_DATABASE_URL."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+    tables = [Recipe.__table__, DescriptionEmbeddings.__table__, IngredientsEmbeddings.__table__]
+    with app.app_context():
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        db.session.commit()
+        db.metadata.drop_all(db.engine, tables=tables)
+        db.metadata.create_all(db.engine, tables=tables)
+        yield db.session
+        db.session.remove()
+        db.metadata.drop_all(db.engine, tables=tables)
+
+
+def test_hybrid_search_leaves_out_deleted_recipes(recipes):
+    query = [1.0] + [0.0] * (EMBEDDING_DIMENSIONS - 1)
+    recipes.add_all([Recipe(id=1, title="Tomato soup", deleted=True), Recipe(id=2, title="Tomato soup")])
+    recipes.flush()
+    recipes.add_all([DescriptionEmbeddings(recipe_id=1, embeddings=query),
+                     DescriptionEmbeddings(recipe_id=2, embeddings=[0.0, 1.0] + [0.0] * (EMBEDDING_DIMENSIONS - 2))])
+    recipes.commit()
+
+    # neither leg may bring back the deleted recipe, whether it matches on text or is the nearest vector
+    for text_query in ("tomato soup", "pancakes"):
+        rows = nearest_recipes(query, mode="hybrid", query=text_query)
+        assert [row.id for row in rows] == [2]
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from data import vectorIndex
+from data.models import db, DescriptionEmbeddings, IngredientsEmbeddings, PantryItem, PantryItemEmbeddings, Recipe
+
+
+@pytest.fixture
+def database():
+    """The embedding tables, in the postgres database at TEST_DATABASE_URL."""
+    url = os.getenv("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    db.init_app(app)
+    tables = [Recipe.__table__, DescriptionEmbeddings.__table__, IngredientsEmbeddings.__table__,
+              PantryItem.__table__, PantryItemEmbeddings.__table__]
+    with app.app_context():
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        db.session.commit()
+        db.metadata.drop_all(db.engine, tables=tables)
+        db.metadata.create_all(db.engine, tables=tables)
+        yield db.session
+        db.session.remove()
+        db.metadata.drop_all(db.engine, tables=tables)
+
+
+def test_tables_created_in_the_configured_storage_need_no_migration(database):
+    assert vectorIndex.pending_storage_migrations() == []
+
+
+def test_tables_in_another_storage_are_pending(database):
+    assert vectorIndex.pending_storage_migrations(storage="halfvec") == list(vectorIndex.EMBEDDING_TABLES)
+
+
+def test_migrating_to_the_current_storage_changes_nothing(database):
+    vectorIndex.migrate_embedding_storage()
+
+    with db.engine.connect() as connection:
+        assert vectorIndex.current_storage(connection, "description_embeddings") == vectorIndex.VECTOR_TYPE
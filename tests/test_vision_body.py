@@ -0,0 +1,75 @@
+import base64
+import copy
+import json
+import os
+from unittest import mock
+
+import pytest
+import requests
+
+from agents import baseAgent
+from agents.baseAgent import Base64JsonBody, _IMAGE_PLACEHOLDER
+
+PAYLOAD = {"model": "gpt-4-vision-preview", "messages": [{"role": "user", "content": [
+    {"type": "text", "text": "Read this \"recipe\" page"},
+    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{_IMAGE_PLACEHOLDER}"}},
+]}]}
+
+
+@pytest.fixture(autouse=True)
+def small_chunks():
+    with mock.patch.object(baseAgent, "VISION_ENCODE_CHUNK", 3 * 4):
+        yield
+
+
+def sent_image(body):
+    url = json.loads(body)["messages"][0]["content"][1]["image_url"]["url"]
+    return base64.b64decode(url.removeprefix("data:image/jpeg;base64,"))
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 11, 12, 13, 1000])
+def test_body_is_the_payload_with_the_image_base64_encoded(size):
+    image = os.urandom(size)
+
+    body = Base64JsonBody(PAYLOAD, image).read()
+
+    assert sent_image(body) == image
+    expected = copy.deepcopy(PAYLOAD)
+    expected["messages"][0]["content"][1]["image_url"]["url"] = \
+        f"data:image/jpeg;base64,{base64.b64encode(image).decode()}"
+    assert body == json.dumps(expected).encode()
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 11, 12, 13, 1000])
+def test_length_is_the_length_of_the_body(size):
+    body = Base64JsonBody(PAYLOAD, os.urandom(size))
+
+    assert len(body) == len(body.read())
+
+
+@pytest.mark.parametrize("read_size", [1, 7, 12, 100])
+def test_reads_of_any_size_add_up_to_the_body(read_size):
+    image = os.urandom(1000)
+    body = Base64JsonBody(PAYLOAD, image)
+
+    pieces = []
+    while piece := body.read(read_size):
+        assert len(piece) <= read_size
+        pieces.append(piece)
+
+    assert b"".join(pieces) == Base64JsonBody(PAYLOAD, image).read()
+
+
+def test_image_is_read_from_a_shared_buffer():
+    image = bytearray(os.urandom(100))
+
+    assert sent_image(Base64JsonBody(PAYLOAD, memoryview(image)).read()) == bytes(image)
+
+
+def test_request_is_sent_with_a_content_length():
+    body = Base64JsonBody(PAYLOAD, os.urandom(1000))
+
+    prepared = requests.Request("POST", "https://api.openai.com/v1/chat/completions", data=body).prepare()
+
+    assert prepared.headers["Content-Length"] == str(len(Base64JsonBody(PAYLOAD, os.urandom(1000)).read()))
+    assert "Transfer-Encoding" not in prepared.headers